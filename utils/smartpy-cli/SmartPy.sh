@@ -66,6 +66,13 @@ files_to_install="
 smartpy.py
 smartpyio.py
 smartpy_cli.py
+compile_cache.py
+code_cache.py
+compile_daemon.py
+message_cache.py
+sexpr_binary.py
+michelson_cli.py
+michelson_cost.py
 browser.py
 version.py
 SmartPy.sh
@@ -144,6 +151,9 @@ case "$1" in
         shift
         export NODE_PATH=$smartpy_install_path/node_modules:$NODE_PATH
         python3 $install_path/smartpy_cli.py "$@" ;;
+    "michelson" )
+        shift
+        python3 $install_path/michelson_cli.py "$@" ;;
     "test-sandbox" )
         shift
         call_app run-smartpy-test-in-interpreter "$@"
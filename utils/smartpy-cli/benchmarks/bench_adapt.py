@@ -0,0 +1,111 @@
+## Time to adapt the blocks of a generated 20k line script, rewritten and from the caches. ##
+
+# The line based rewriter smartpyio.adaptBlocks used before it read tokens
+# is kept below as a reference: both give the same script on code without
+# blocks in strings or headers on several lines.
+
+import argparse
+import tempfile
+
+from common import smartpyio, timeit
+
+import compile_cache
+
+entry_point = """
+    @sp.entry_point
+    def step%(i)i(self, params):
+        sp.if params.value > self.data.value%(i)i:
+            self.data.value%(i)i = params.value
+        sp.else:
+            self.data.value%(i)i += 1
+        sp.for x in params.items:
+            sp.if x %% 2 == 0:
+                self.data.total += x
+        sp.while self.data.total > %(i)i:
+            self.data.total -= 1
+        sp.verify(self.data.total >= 0, message = "step%(i)i")
+"""
+
+
+def generated_script(lines, docstrings=False):
+    header = "import smartpy as sp\n\nclass Generated(sp.Contract):\n"
+    template = entry_point
+    if docstrings:
+        # Strings on several lines, which the rewriter skips
+        template = template.replace("(self, params):\n", '(self, params):\n        """Step %(i)i.\n\n        Updates value%(i)i and total.\n        """\n')
+    n = max(1, (lines - 3) // template.count("\n"))
+    init = "    def __init__(self):\n        self.init(total = 0, %s)\n" % ", ".join("value%i = 0" % i for i in range(n))
+    return header + init + "".join(template % {"i": i} for i in range(n))
+
+
+def line_based(code):
+    """Blocks rewritten line by line, with the line map."""
+    result = []
+    for line in code.split("\n") + [""]:
+        initialLine = line
+        indent = len(line) - len(line.lstrip(" "))
+        nline = line.strip(" \r")
+        p = nline[:-1].split(" ")
+        if line[indent:].startswith("sp.for "):
+            if nline[-1] == ":" and p[0] == "sp.for" and p[2] == "in":
+                line = "%swith sp.for_('%s', %s) as %s:" % (indent * " ", p[1], " ".join(p[3:]), p[1])
+        elif line[indent:].startswith("sp.if "):
+            if nline[-1] == ":" and p[0] == "sp.if":
+                line = "%swith sp.if_(%s):" % (indent * " ", " ".join(p[1:]))
+        elif line[indent:].startswith("sp.while "):
+            if nline[-1] == ":" and p[0] == "sp.while":
+                line = "%swith sp.while_(%s):" % (indent * " ", " ".join(p[1:]))
+        elif line[indent:].startswith("sp.else ") or line[indent:].startswith("sp.else:"):
+            if nline[-1] == ":":
+                line = "%swith sp.else_():" % (indent * " ")
+        if initialLine.endswith("\r") and not line.endswith("\r"):
+            line += "\r"
+        result.append(line)
+    lines = {str(i + 1): str(i + 1) for i in range(len(result))}
+    return "\n".join(result), lines
+
+
+def run(lines, repeat):
+    code = generated_script(lines)
+    documented = generated_script(lines, docstrings=True)
+    (reference, referenceLines) = line_based(code)
+
+    def rewrite():
+        smartpyio.adapted_sources.clear()
+        return smartpyio.adaptBlocks(code)
+
+    adapted = rewrite()
+    same = adapted == reference and all(smartpyio.reverseLines.get(k) == v for (k, v) in referenceLines.items())
+    same = same and len(smartpyio.reverseLines) == len(referenceLines)
+    # Compiled once, as the script would be
+    compile(adapted, "SmartPy Script", "exec")
+    print("%i lines, %i blocks, same output and line map: %s" % (code.count("\n") + 1, adapted.count("with sp."), same))
+    print("%-24s %10s" % ("adaptation", "time (ms)"))
+    print("%-24s %10.2f" % ("line based", 1000 * timeit(lambda: line_based(code), repeat)))
+    print("%-24s %10.2f" % ("single pass", 1000 * timeit(rewrite, repeat)))
+    same = smartpyio.rewrite_blocks(documented) == line_based(documented)[0]
+    print("%-24s %10.2f" % ("line based, docstrings", 1000 * timeit(lambda: line_based(documented), repeat)))
+    print("%-24s %10.2f %s" % ("single pass, docstrings", 1000 * timeit(lambda: smartpyio.rewrite_blocks(documented), repeat), "same" if same else "differs"))
+    print("%-24s %10.2f" % ("memory cache", 1000 * timeit(lambda: smartpyio.adaptBlocks(code), repeat)))
+    with tempfile.TemporaryDirectory() as directory:
+        store = compile_cache.CompileCache(directory)
+        store.suffix = ".py"
+        smartpyio.set_adapted_store(store)
+        try:
+            rewrite()
+
+            def stored():
+                smartpyio.adapted_sources.clear()
+                assert smartpyio.adaptBlocks(code) == adapted
+
+            print("%-24s %10.2f" % ("disk cache", 1000 * timeit(stored, repeat)))
+        finally:
+            smartpyio.set_adapted_store(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Block adaptation benchmark")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    run(args.lines, args.repeat)
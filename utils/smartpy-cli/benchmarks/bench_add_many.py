@@ -0,0 +1,63 @@
+## Scenario construction time of many calls, one by one or through Scenario.add_many. ##
+
+import argparse
+
+from common import load_script, smartpyio, timeit
+
+
+def setup(sp, RoundManager):
+    scenario = sp.test_scenario()
+    dao = sp.test_account("dao")
+    alice = sp.test_account("alice")
+    rm = RoundManager(dao.address, True)
+    scenario += rm
+    scenario += rm.createNewRound(
+        description="x", start=sp.timestamp(0), end=sp.timestamp(100000), totalSponsorship=sp.tez(1)
+    ).run(sender=dao)
+    scenario += rm.enterRound(description="p").run(sender=alice)
+    return scenario, rm, alice
+
+
+def one_by_one(sp, RoundManager, amounts):
+    scenario, rm, alice = setup(sp, RoundManager)
+    for amount in amounts:
+        scenario += rm.contribute(entryId=1).run(sender=alice, amount=amount)
+    return scenario.messages
+
+
+def bulk(sp, RoundManager, amounts):
+    scenario, rm, alice = setup(sp, RoundManager)
+    scenario.add_many(rm.contribute, params=dict(entryId=1), sender=alice, amount=amounts)
+    return scenario.messages
+
+
+def run(calls, repeat):
+    context = load_script()
+    sp = context["sp"]
+    RoundManager = context["RoundManager"]
+    amounts = [sp.mutez(i + 1) for i in range(calls)]
+    counters = smartpyio.counters()
+    results = {}
+
+    def measure(f):
+        def g():
+            smartpyio.set_counters(counters)
+            results[f.__name__] = f(sp, RoundManager, amounts)
+
+        return timeit(g, repeat)
+
+    oneByOne = measure(one_by_one)
+    bulkTime = measure(bulk)
+    print("%-12s %10s %10s %8s %6s" % ("calls", "run (s)", "add_many", "speedup", "same"))
+    print(
+        "%-12i %10.3f %10.3f %7.1fx %6s"
+        % (calls, oneByOne, bulkTime, oneByOne / bulkTime, results["one_by_one"] == results["bulk"])
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk scenario message benchmark")
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.calls, args.repeat)
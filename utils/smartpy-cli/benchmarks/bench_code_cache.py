@@ -0,0 +1,72 @@
+## Time to get the code object of main.py or of a generated script, adapted and compiled or from code_cache. ##
+
+# The CLI rows run smartpy_cli.py on main.py in a new process each time,
+# with its tests, so that they include what the code cache saves at start.
+
+import argparse
+import marshal
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_adapt import generated_script
+from common import cli_directory, main_script, smartpyio, timeit
+
+import code_cache
+
+
+def compiled(code):
+    smartpyio.adapted_sources.clear()
+    adaptedCode = smartpyio.adaptBlocks(code)
+    return adaptedCode, compile(adaptedCode, code_cache.script_filename, "exec")
+
+
+def run_cli(directory, repeat):
+    command = [sys.executable, os.path.join(cli_directory, "smartpy_cli.py"), main_script, "--scenario", os.path.join(directory, "scenario.json")]
+    env = dict(os.environ, SMARTPY_CACHE_DIR=os.path.join(directory, "cache"))
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(lines, repeat):
+    scripts = {"main.py": open(main_script).read(), "%i lines" % lines: generated_script(lines)}
+    print("%-14s %-14s %10s %6s" % ("script", "code object", "time (ms)", "same"))
+    with tempfile.TemporaryDirectory() as directory:
+        codes = code_cache.CodeCache(os.path.join(directory, "code"))
+        for name, code in scripts.items():
+            (adaptedCode, reference) = compiled(code)
+            codes.store(code, adaptedCode, reference)
+            (loadedCode, loaded) = codes.load(code)
+            same = loadedCode == adaptedCode and marshal.dumps(loaded) == marshal.dumps(reference)
+            print("%-14s %-14s %10.2f" % (name, "compiled", 1000 * timeit(lambda: compiled(code), repeat)))
+            print("%-14s %-14s %10.2f %6s" % (name, "code cache", 1000 * timeit(lambda: codes.load(code), repeat), same))
+        cold = run_cli(directory, 1)
+        warm = run_cli(directory, repeat)
+    with tempfile.TemporaryDirectory() as directory:
+        # Reads the library from disk
+        subprocess.run([sys.executable, os.path.join(cli_directory, "smartpy_cli.py"), "--version"], check=True, stdout=subprocess.DEVNULL)
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, os.path.join(cli_directory, "smartpy_cli.py"), main_script, "--no-cache", "--scenario", os.path.join(directory, "scenario.json")],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        uncached = time.perf_counter() - start
+    print("%-14s %-14s %10.2f" % ("main.py", "CLI, no cache", 1000 * uncached))
+    print("%-14s %-14s %10.2f" % ("main.py", "CLI, cold", 1000 * cold))
+    print("%-14s %-14s %10.2f" % ("main.py", "CLI, warm", 1000 * warm))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Code cache benchmark")
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.lines, args.repeat)
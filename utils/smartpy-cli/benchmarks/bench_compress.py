@@ -0,0 +1,61 @@
+## Time and peak memory of compressing generated Michelson files, loaded whole or streamed. ##
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from common import michelson_contract, smartpyio
+
+import michelson_cli
+
+
+def loaded(filename, target):
+    with open(filename, "r", newline="\n") as f:
+        result = smartpyio.removeCommentsMichelson(f.read())
+    with michelson_cli.output(target) as out:
+        out.write(result + "\n")
+
+
+def streamed(filename, target):
+    with michelson_cli.output(target) as out:
+        michelson_cli.compress_file(filename, out)
+
+
+def measure(f, filename, target):
+    start = time.perf_counter()
+    f(filename, target)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    f(filename, target)
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    with open(target, "rb") as out:
+        return out.read(), elapsed, peak
+
+
+def run(sizes):
+    print("%-10s %12s %12s %8s %10s %12s %6s" % ("instrs", "bytes", "compressed", "mode", "time (ms)", "peak (KB)", "same"))
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "contract_compiled.tz")
+        target = os.path.join(directory, "compressed.tz")
+        for size in sizes:
+            with open(filename, "w") as f:
+                f.write(michelson_contract(size))
+            reference = None
+            for (mode, f) in [("loaded", loaded), ("streamed", streamed)]:
+                (result, elapsed, peak) = measure(f, filename, target)
+                if reference is None:
+                    reference = result
+                print(
+                    "%-10i %12i %12i %8s %10.2f %12.1f %6s"
+                    % (size, os.path.getsize(filename), len(result), mode, 1000 * elapsed, peak / 1024, result == reference)
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Michelson compression benchmark")
+    parser.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 400000])
+    args = parser.parse_args()
+    run(args.sizes)
@@ -0,0 +1,54 @@
+## Nodes built, elaboration time and export size of main.py contracts with the constant pool. ##
+
+import argparse
+
+from common import contract_calls, elaborate, load_script, smartpy, timeit
+
+modes = {
+    "off": (False, True),
+    "lines": (True, True),
+    "no lines": (True, False),
+}
+
+
+def measure(context, name, mode, repeat):
+    (pool, line_info) = modes[mode]
+
+    def run():
+        smartpy.set_constant_pool(pool, line_info)
+        try:
+            return elaborate(context, name).export()
+        finally:
+            smartpy.set_constant_pool(False)
+
+    export = run()
+    smartpy.setProfiling(True)
+    try:
+        run()
+        nodes = smartpy.sp.profiler.nodes
+    finally:
+        smartpy.setProfiling(False)
+    return export, nodes, timeit(run, repeat)
+
+
+def run(names, repeat):
+    context = load_script()
+    print("%-14s %-9s %8s %10s %10s %6s" % ("contract", "pool", "nodes", "time (ms)", "bytes", "same"))
+    for name in names:
+        plain = None
+        for mode in modes:
+            (export, nodes, elapsed) = measure(context, name, mode, repeat)
+            if plain is None:
+                plain = export
+            print(
+                "%-14s %-9s %8i %10.2f %10i %6s"
+                % (name, mode, nodes, 1000 * elapsed, len(export.encode("utf8")), export == plain)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Constant pool benchmark")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.contracts, args.repeat)
@@ -0,0 +1,75 @@
+## Latency of smartpy_cli invocations, cold processes against a warm daemon. ##
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import cli_directory, contract_calls, main_script
+
+import compile_daemon
+
+smartpy_cli = os.path.join(cli_directory, "smartpy_cli.py")
+
+
+def invocations(directory):
+    result = []
+    for name, class_call in contract_calls.items():
+        sexprfile = os.path.join(directory, name + ".sexpr")
+        result.append((name, [main_script, "--no-cache", "--class_call", class_call, "--sexprfile", sexprfile]))
+    result.append(("scenario", [main_script, "--scenario", os.path.join(directory, "scenario.json")]))
+    return result
+
+
+def cold(argv):
+    subprocess.run([sys.executable, smartpy_cli] + argv, check=True, stdout=subprocess.DEVNULL)
+
+
+def warm(socket, argv):
+    answer = compile_daemon.request(socket, argv)
+    if answer["status"] != 0:
+        raise Exception(answer["output"])
+
+
+def wait_for(socket, process):
+    while not os.path.exists(socket):
+        if process.poll() is not None:
+            raise Exception("The daemon exited with status %i" % process.returncode)
+        time.sleep(0.01)
+
+
+def median_ms(f, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+def run(repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        socket = os.path.join(directory, "smartpy.sock")
+        daemon = subprocess.Popen([sys.executable, smartpy_cli, "--serve", socket])
+        try:
+            wait_for(socket, daemon)
+            print("%-14s %10s %10s %8s %10s" % ("invocation", "cold (ms)", "warm (ms)", "speedup", "same"))
+            for name, argv in invocations(directory):
+                output = argv[-1]
+                coldTime = median_ms(lambda: cold(argv), repeat)
+                coldOutput = open(output, "rb").read()
+                warmTime = median_ms(lambda: warm(socket, argv), repeat)
+                same = open(output, "rb").read() == coldOutput
+                print("%-14s %10.1f %10.1f %7.1fx %10s" % (name, coldTime, warmTime, coldTime / warmTime, same))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile daemon latency benchmark")
+    parser.add_argument("--repeat", type=int, default=11)
+    args = parser.parse_args()
+    run(args.repeat)
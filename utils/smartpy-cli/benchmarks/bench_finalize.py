@@ -0,0 +1,87 @@
+## Resident memory of a process elaborating a main.py contract many times, with and without finalize. ##
+
+# Elaborated contracts stay reachable (the library registers every
+# contract in window.contracts), so memory grows with each of them unless
+# their trees are released once exported. Each mode runs in its own
+# process, its RSS is read from /proc.
+
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from common import contract_calls, elaborate, load_script, smartpy
+
+
+def rss():
+    """Resident set size of this process, in KB."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def child(name, count, finalize):
+    context = load_script()
+    smartpy.set_finalize(finalize)
+    before = rss()
+    exports = hashlib.sha256()
+    start = time.perf_counter()
+    contracts = []
+    for _ in range(count):
+        contract = elaborate(context, name)
+        exports.update(contract.export().encode("utf8"))
+        contracts.append(contract)
+    elapsed = time.perf_counter() - start
+    result = {
+        "rss": rss() - before,
+        "peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "time": elapsed,
+        "exports": exports.hexdigest(),
+    }
+    print(json.dumps(result))
+
+
+def measure(name, count, finalize):
+    command = [sys.executable, os.path.abspath(__file__), name, "--count", str(count), "--child"]
+    if finalize:
+        command.append("--finalize")
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def run(names, count):
+    print("%-14s %-9s %6s %14s %14s %10s %6s" % ("contract", "finalize", "count", "growth (MB)", "max RSS (MB)", "time (s)", "same"))
+    for name in names:
+        results = {finalize: measure(name, count, finalize) for finalize in [False, True]}
+        for finalize, result in results.items():
+            print(
+                "%-14s %-9s %6i %14.1f %14.1f %10.2f %6s"
+                % (
+                    name,
+                    finalize,
+                    count,
+                    result["rss"] / 1024,
+                    result["peak"] / 1024,
+                    result["time"],
+                    result["exports"] == results[False]["exports"],
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finalize memory benchmark")
+    parser.add_argument("contracts", nargs="*", default=["DAO"])
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--finalize", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.contracts[0], args.count, args.finalize)
+    else:
+        run(args.contracts, args.count)
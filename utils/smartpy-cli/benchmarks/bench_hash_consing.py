@@ -0,0 +1,51 @@
+## Per-contract dedup ratio and memory of hash-consed elaboration. ##
+
+import argparse
+import gc
+import tracemalloc
+
+from common import contract_calls, elaborate, load_script, smartpy
+
+
+def retained(context, name):
+    gc.collect()
+    tracemalloc.start()
+    contract = elaborate(context, name)
+    gc.collect()
+    result = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return contract, result
+
+
+def run(names):
+    context = load_script()
+    print("%-14s %10s %8s %8s %12s %12s" % ("contract", "requested", "unique", "dedup", "plain (KB)", "shared (KB)"))
+    for name in names:
+        smartpy.set_hash_consing(False)
+        plain, plainMemory = retained(context, name)
+        smartpy.set_hash_consing(True)
+        try:
+            shared, sharedMemory = retained(context, name)
+        finally:
+            smartpy.set_hash_consing(False)
+        if plain.export() != shared.export():
+            raise Exception("Hash consing changed the export of %s" % name)
+        stats = shared.hash_consing_stats
+        print(
+            "%-14s %10i %8i %7.1f%% %12.1f %12.1f"
+            % (
+                name,
+                stats["requested"],
+                stats["unique"],
+                100 * stats["dedup_ratio"],
+                plainMemory / 1024,
+                sharedMemory / 1024,
+            )
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hash consing report")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    args = parser.parse_args()
+    run(args.contracts)
@@ -0,0 +1,73 @@
+## Elaboration time of main.py contracts with entry point exports replayed from message_cache. ##
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from common import browser, contract_calls, elaborate, load_script, main_script, smartpy, timeit
+
+import message_cache
+
+# An edit that keeps the line numbers of main.py: RoundManager.disburse
+# checks the source instead of the sender.
+edited_line = "    def disburse(self):\n        sp.verify(sp.sender == self.data.daoContractAddress)\n"
+edit = "    def disburse(self):\n        sp.verify(sp.source == self.data.daoContractAddress)\n"
+
+
+def edited_script(directory):
+    filename = directory + "/main_edited.py"
+    code = open(main_script).read()
+    if code.count(edited_line) != 1:
+        raise Exception("main.py changed, update the edit of this benchmark")
+    with open(filename, "w") as f:
+        f.write(code.replace(edited_line, edit))
+    return filename
+
+
+def export(context, name, cache):
+    smartpy.set_message_cache(cache)
+    try:
+        return elaborate(context, name).export()
+    finally:
+        smartpy.set_message_cache(None)
+
+
+def clear(directory):
+    shutil.rmtree(message_cache.MessageCache(directory).store.directory, ignore_errors=True)
+
+
+def run(names, repeat):
+    with tempfile.TemporaryDirectory() as directory:
+        contexts = {"unchanged": load_script()}
+        # Both scripts define the same tests
+        browser.window.pythonTests.clear()
+        contexts["edited"] = load_script(edited_script(directory))
+        print("%-14s %-10s %10s %10s %6s %8s %6s" % ("contract", "script", "cold (ms)", "warm (ms)", "hits", "misses", "same"))
+        for name in names:
+            for script, context in contexts.items():
+                reference = export(context, name, None)
+                cold = timeit(lambda: export(context, name, None), repeat)
+                warm = None
+                for _ in range(repeat):
+                    # Fragments left by a run on the unchanged script
+                    clear(directory)
+                    export(contexts["unchanged"], name, message_cache.MessageCache(directory))
+                    cache = message_cache.MessageCache(directory)
+                    start = time.perf_counter()
+                    result = export(context, name, cache)
+                    elapsed = time.perf_counter() - start
+                    warm = elapsed if warm is None else min(warm, elapsed)
+                print(
+                    "%-14s %-10s %10.2f %10.2f %6i %8i %6s"
+                    % (name, script, 1000 * cold, 1000 * warm, cache.hits, cache.misses, result == reference)
+                )
+                clear(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental elaboration benchmark")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    run(args.contracts, args.repeat)
@@ -0,0 +1,34 @@
+## Elaboration time of main.py contracts, inspect.stack() vs frame walking. ##
+
+import argparse
+import inspect
+
+from common import contract_calls, elaborate, load_script, smartpy, timeit
+
+
+def get_line_no_inspect():
+    for x in inspect.stack():
+        if x.filename == "SmartPy Script":
+            return x.lineno
+    return -1
+
+
+def run(repeat):
+    context = load_script()
+    fast = smartpy.get_line_no
+    print("%-14s %12s %12s %8s" % ("contract", "before (ms)", "after (ms)", "speedup"))
+    for name in contract_calls:
+        try:
+            smartpy.get_line_no = get_line_no_inspect
+            before = timeit(lambda: elaborate(context, name), repeat)
+        finally:
+            smartpy.get_line_no = fast
+        after = timeit(lambda: elaborate(context, name), repeat)
+        print("%-14s %12.2f %12.2f %7.1fx" % (name, before * 1000, after * 1000, before / after))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="get_line_no benchmark")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.repeat)
@@ -0,0 +1,40 @@
+## Memory retained by elaborating the main.py contracts, measured with tracemalloc. ##
+
+import argparse
+import gc
+import tracemalloc
+
+from common import browser, contract_calls, elaborate, load_script, smartpy
+
+
+def count_exprs():
+    return sum(1 for x in gc.get_objects() if isinstance(x, smartpy.Expr))
+
+
+def run(names):
+    context = load_script()
+    print("%-14s %8s %14s %14s %10s" % ("contract", "nodes", "retained (KB)", "peak (KB)", "B/node"))
+    for name in names:
+        # elaborate restarts contract ids, the new contract would replace the
+        # previous one in window.contracts and free its nodes while measured
+        browser.window.contracts.clear()
+        gc.collect()
+        nodes = count_exprs()
+        tracemalloc.start()
+        contract = elaborate(context, name)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        nodes = count_exprs() - nodes
+        print(
+            "%-14s %8i %14.1f %14.1f %10.1f"
+            % (name, nodes, retained / 1024, peak / 1024, retained / max(nodes, 1))
+        )
+        del contract
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Elaboration memory benchmark")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    args = parser.parse_args()
+    run(args.contracts)
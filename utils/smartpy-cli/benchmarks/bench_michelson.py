@@ -0,0 +1,122 @@
+## Time to format generated Michelson with ppMichelson, against the implementation it replaced. ##
+
+# Contracts are formatted as compiled, one instruction per line, and on a
+# single line (as some tools print them, without comments): the previous
+# implementation is quadratic in the number of instructions of a line.
+
+import argparse
+
+from common import michelson_contract, smartpyio, timeit
+
+
+def reference_pp(code, withComments):
+    """smartpyio.ppMichelson before it read generated items."""
+    lines = [x.strip() for x in code.split("\n")]
+
+    def split(s):
+        if "#" in s:
+            pos = s.index("#")
+            return s[:pos].strip(), s[pos:].strip()
+        return s.strip(), None
+
+    lines = [split(x) for x in lines if x]
+    result = []
+    for s, c in lines:
+        if not withComments:
+            c = None
+        s = (
+            s.replace("{", " { ")
+            .replace("}", " } ")
+            .replace("(", " ( ")
+            .replace(")", " ) ")
+            .replace(" ;", ";")
+            .replace(" ;", ";")
+            .strip()
+        )
+        split = s.split()
+        cursor = 0
+        if s == "" and c:
+            result.append((s, c))
+        while len(split):
+            if split[cursor] in ["parameter", "storage", "code"]:
+                result.append((" ".join(split[0 : cursor + 1]), None))
+                split = split[cursor + 1 :]
+                continue
+            if split[cursor] in ["{", "}", "};", ";"]:
+                if cursor != 0:
+                    result.append((" ".join(split[0:cursor]), None))
+                    split = split[cursor:]
+                    cursor = 0
+                else:
+                    result.append((" ".join(split[0 : cursor + 1]), None))
+                    split = split[cursor + 1 :]
+            elif len(split) == cursor + 1:
+                result.append((" ".join(split[0 : cursor + 1]), c))
+                split = []
+            elif split[cursor].endswith(";"):
+                result.append((" ".join(split[0 : cursor + 1]), None))
+                split = split[cursor + 1 :]
+                cursor = 0
+            else:
+                cursor += 1
+    lines = result
+    parameter = []
+    storage = []
+    code = []
+    init = []
+    result = {"init": init, "parameter": parameter, "storage": storage, "code": code}
+    step = "init"
+    indent = ""
+    for (s, c) in lines:
+        if s == "{":
+            indent = indent + "  "
+            nextIndent = indent + "  "
+        elif "}" in s:
+            indent = indent[:-2]
+            nextIndent = indent[:-2]
+        else:
+            nextIndent = indent
+        if s in ["parameter", "storage", "code"]:
+            step = s
+        line = (
+            (indent + ("%-10s %s" % (s, c) if c else s))
+            if step != "init"
+            else (("%s %s" % (s, c)).strip() if c else s)
+        )
+        if line:
+            result[step].append(line)
+        indent = nextIndent
+    if init:
+        init = "\n".join(init) + "\n\n"
+    else:
+        init = ""
+    michelson = "%s%s\n%s\n%s" % (
+        init,
+        " ".join(parameter).replace(" )", ")").replace("( ", "(").replace(" ;", ";"),
+        ("storage   %s" % (" ".join(storage[1:]))).replace(" )", ")").replace("( ", "(").replace(" ;", ";"),
+        "\n".join(code),
+    )
+    return michelson
+
+
+def one_line(code):
+    return " ".join(line.split("#")[0].strip() for line in code.split("\n"))
+
+
+def run(sizes, repeat):
+    print("%-8s %-10s %12s %16s %12s %6s" % ("layout", "instrs", "bytes", "reference (ms)", "items (ms)", "same"))
+    for size in sizes:
+        compiled = michelson_contract(size)
+        for (layout, code) in [("lines", compiled), ("one line", one_line(compiled))]:
+            same = all(reference_pp(code, c) == smartpyio.ppMichelson(code, c) for c in [True, False])
+            reference = timeit(lambda: reference_pp(code, True), repeat)
+            items = timeit(lambda: smartpyio.ppMichelson(code, True), repeat)
+            print("%-8s %-10i %12i %16.2f %12.2f %6s" % (layout, size, len(code), 1000 * reference, 1000 * items, same))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Michelson formatting benchmark")
+    parser.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 40000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
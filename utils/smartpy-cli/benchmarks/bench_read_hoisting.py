@@ -0,0 +1,56 @@
+## Storage lookups and export size saved by hoisting repeated storage reads. ##
+
+# Michelson gas cannot be measured without the SmartML compiler, the number
+# of map and big_map lookups (getItem nodes) left in the exported entry
+# points is reported as its proxy.
+
+import argparse
+
+from common import contract_calls, elaborate, load_script, smartpy
+
+
+def lookups(x):
+    (label, children) = smartpy.tree_children(x)
+    if children is None:
+        return 0
+    result = 1 if label == "getItem" else 0
+    for child in children:
+        if child.__class__ not in smartpy.hash_consing_scalars:
+            result += lookups(child)
+    return result
+
+
+def measure(context, name, hoisting):
+    smartpy.set_read_hoisting(hoisting)
+    try:
+        contract = elaborate(context, name)
+    finally:
+        smartpy.set_read_hoisting(False)
+    result = {}
+    for entry_point, mb in contract.messages.items():
+        size = len(mb.export().encode("utf8"))
+        result[entry_point] = (lookups(mb), size, contract.read_hoisting_stats.get(entry_point))
+    return result, len(contract.export().encode("utf8"))
+
+
+def run(names):
+    context = load_script()
+    print("%-14s %-26s %8s %8s %8s %10s %10s" % ("contract", "entry point", "locals", "lookups", "hoisted", "bytes", "hoisted"))
+    for name in names:
+        plain, plainSize = measure(context, name, False)
+        hoisted, hoistedSize = measure(context, name, True)
+        for entry_point in sorted(plain):
+            (plainLookups, plainBytes, _) = plain[entry_point]
+            (hoistedLookups, hoistedBytes, stats) = hoisted[entry_point]
+            print(
+                "%-14s %-26s %8i %8i %8i %10i %10i"
+                % (name, entry_point, stats["bindings"], plainLookups, hoistedLookups, plainBytes, hoistedBytes)
+            )
+        print("%-14s %-26s %8s %8s %8s %10i %10i" % (name, "(contract)", "", "", "", plainSize, hoistedSize))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage read hoisting report")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    args = parser.parse_args()
+    run(args.contracts)
@@ -0,0 +1,70 @@
+## Peak memory of a load-test scenario written as one JSON list or streamed as NDJSON. ##
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import cli_directory, main_script
+
+load_test = """
+@sp.add_test(name = "Load Test")
+def test():
+    scenario = sp.test_scenario()
+    admin = sp.test_account("admin")
+    alice = sp.test_account("alice")
+    token = QuadToken(admin.address, True)
+    scenario += token
+    dao = sp.test_account("dao")
+    rm = RoundManager(dao.address, True)
+    scenario += rm
+    scenario += rm.createNewRound(description = "x", start = sp.timestamp(0), end = sp.timestamp(100000), totalSponsorship = sp.tez(1)).run(sender = dao)
+    scenario += rm.enterRound(description = "p").run(sender = alice)
+    for i in range(%i):
+        scenario += rm.contribute(entryId = 1).run(sender = alice, amount = sp.mutez(i + 1))
+"""
+
+
+def child(script, scenario, format):
+    sys.argv = ["smartpy_cli.py", script, "--scenario", scenario, "--scenario_format", format]
+    sys.path.insert(0, cli_directory)
+    import smartpy_cli
+
+    start = time.perf_counter()
+    smartpy_cli.main()
+    elapsed = time.perf_counter() - start
+    print("%f %i" % (elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def run(calls):
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "load_test.py")
+        with open(script, "w") as f:
+            f.write(open(main_script).read() + load_test % calls)
+        print("%-8s %10s %14s %12s" % ("format", "time (s)", "max RSS (MB)", "output (MB)"))
+        for format in ["json", "ndjson"]:
+            scenario = os.path.join(directory, "scenario." + format)
+            output = subprocess.run(
+                [sys.executable, __file__, "--child", script, scenario, format],
+                check=True,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ).stdout.split()
+            print(
+                "%-8s %10.2f %14.1f %12.1f"
+                % (format, float(output[-2]), int(output[-1]) / 1024, os.path.getsize(scenario) / 2 ** 20)
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scenario output memory benchmark")
+    parser.add_argument("--calls", type=int, default=10000)
+    parser.add_argument("--child", nargs=3, metavar=("SCRIPT", "SCENARIO", "FORMAT"))
+    args = parser.parse_args()
+    if args.child:
+        child(*args.child)
+    else:
+        run(args.calls)
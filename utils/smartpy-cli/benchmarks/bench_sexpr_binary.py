@@ -0,0 +1,95 @@
+## Size and parse time of exported contracts and scenarios, text against sexpr_binary. ##
+
+import argparse
+import gzip
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from bench_scenario_stream import load_test
+from common import cli_directory, contract_calls, elaborate, load_script, main_script, timeit
+
+import sexpr_binary
+
+
+def scenario_messages(calls):
+    with tempfile.TemporaryDirectory() as directory:
+        script = os.path.join(directory, "load_test.py")
+        with open(script, "w") as f:
+            f.write(open(main_script).read() + load_test % calls)
+        scenario = os.path.join(directory, "scenario.json")
+        subprocess.run(
+            [sys.executable, os.path.join(cli_directory, "smartpy_cli.py"), script, "--scenario", scenario],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return json.load(open(scenario))
+
+
+def report(name, text, binary, parse_text, parse_binary, repeat):
+    same = parse_text() == parse_binary()
+    textTime = timeit(parse_text, repeat)
+    binaryTime = timeit(parse_binary, repeat)
+    textBytes = len(text.encode("utf8"))
+    print(
+        "%-14s %9i %9i %6.2f %9i %9i %9.2f %9.2f %6s"
+        % (
+            name,
+            textBytes,
+            len(binary),
+            textBytes / len(binary),
+            len(gzip.compress(text.encode("utf8"))),
+            len(gzip.compress(binary)),
+            1000 * textTime,
+            1000 * binaryTime,
+            same,
+        )
+    )
+
+
+def run(names, calls, repeat):
+    context = load_script()
+    print(
+        "%-14s %9s %9s %6s %9s %9s %9s %9s %6s"
+        % ("export", "text", "binary", "ratio", "text.gz", "binary.gz", "text ms", "binary ms", "same")
+    )
+    for name in names:
+        text = elaborate(context, name).export()
+        binary = sexpr_binary.encode(text)
+        report(
+            name,
+            text,
+            binary,
+            lambda: sexpr_binary.parse_text(text),
+            lambda: sexpr_binary.decode_trees(binary)[0],
+            repeat,
+        )
+    scenarios = scenario_messages(calls)
+    text = json.dumps(scenarios)
+    binary = sexpr_binary.encode_scenario(scenarios)
+    # Downstream, the scenario JSON is loaded and its sexpr fields parsed
+    report(
+        "scenario",
+        text,
+        binary,
+        lambda: [
+            sexpr_binary.parse_text(v)
+            for scenario in json.loads(text)
+            for message in scenario["scenario"]
+            for (k, v) in message.items()
+            if k in sexpr_binary.scenario_sexpr_fields
+        ],
+        lambda: sexpr_binary.decode_trees(binary),
+        repeat,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Binary sexpr size and parse time")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    parser.add_argument("--calls", type=int, default=1000, help="contributions in the load test scenario")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.contracts, args.calls, args.repeat)
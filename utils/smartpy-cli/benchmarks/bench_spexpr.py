@@ -0,0 +1,96 @@
+## Conversion throughput of spExpr on a mixed stream of values. ##
+
+import argparse
+from types import FunctionType
+
+from common import smartpy, timeit
+
+sp = smartpy
+
+
+def spExpr_chain(x, context="expression"):
+    """The isinstance chain spExpr used before its dispatch table."""
+    if x is None:
+        raise Exception("Unexpected value (None) for %s in line %i." % (context, sp.get_line_no()))
+    if isinstance(x, sp.Local):
+        raise Exception("Local value of variable %s can be accessed by doing %s.value" % (x.name, x.name))
+    if isinstance(x, sp.Expr):
+        return x
+    if x == ():
+        return sp.unit
+    if isinstance(x, float):
+        return sp.literal("float", x)
+    if isinstance(x, sp.pyBool):
+        return sp.literal("bool", x)
+    if isinstance(x, sp.pyInt):
+        if x < 0:
+            return sp.literal("int", x)
+        return sp.literal("intOrNat", x)
+    if hasattr(x, "__int__"):
+        return sp.literal("intOrNat", sp.pyInt(x))
+    if isinstance(x, str):
+        return sp.literal("string", x)
+    if isinstance(x, sp.pyBytes):
+        return sp.literal("bytes", x.decode())
+    if isinstance(x, sp.WouldBeValue):
+        return x
+    if isinstance(x, dict):
+        return sp.map(x)
+    if isinstance(x, sp.pySet):
+        return sp.set([spExpr_chain(y) for y in x])
+    if isinstance(x, sp.pyTuple):
+        return sp.tuple([spExpr_chain(y) for y in x])
+    if isinstance(x, sp.pyList):
+        return sp.list([spExpr_chain(y) for y in x])
+    if isinstance(x, sp.pyRange):
+        return sp.list(sp.pyList(x))
+    if isinstance(x, sp.Lambda):
+        return x.f
+    if isinstance(x, sp.GlobalLambda):
+        return sp.Expr("global", [x.name, sp.get_line_no()])
+    if isinstance(x, FunctionType):
+        return sp.build_lambda(x).f
+    if isinstance(x, sp.TestAccount):
+        return x.e
+    if isinstance(x, sp.TType):
+        raise Exception("spExpr: using type expression %s as an expression" % (str(x)))
+    if isinstance(x, sp.Verbatim):
+        return x
+    raise Exception("spExpr: '%s' of type '%s'" % (str(x), str(type(x))))
+
+
+def mixed_stream(size):
+    values = [
+        sp.Expr("attr", [sp.Expr("data", []), "ledger", 1]),
+        sp.record(a=1, b="x"),
+        sp.nat(3),
+        12,
+        -4,
+        True,
+        "string",
+        (),
+        (1, "a"),
+        [1, 2],
+        {1: "a"},
+        sp.sender,
+    ]
+    return [values[i % len(values)] for i in range(size)]
+
+
+def run(size, repeat):
+    stream = mixed_stream(size)
+    for name, convert in [("isinstance chain", spExpr_chain), ("dispatch table", sp.spExpr)]:
+        elapsed = timeit(lambda: [convert(x) for x in stream], repeat)
+        print("%-18s %10.1f ns/value" % (name, elapsed * 1e9 / size))
+    for name, convert in [("isinstance chain", spExpr_chain), ("dispatch table", sp.spExpr)]:
+        exprs = [x for x in stream if isinstance(x, (sp.Expr, sp.WouldBeValue))]
+        elapsed = timeit(lambda: [convert(x) for x in exprs], repeat)
+        print("%-18s %10.1f ns/value (Expr and WouldBeValue only)" % (name, elapsed * 1e9 / len(exprs)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="spExpr microbenchmark")
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.size, args.repeat)
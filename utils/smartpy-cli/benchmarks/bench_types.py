@@ -0,0 +1,80 @@
+## Type constructions, distinct type instances and elaboration cost with interned types. ##
+
+# Without interning is emulated by emptying the table before each
+# construction, so that every type is a new instance exporting itself.
+
+import argparse
+import gc
+import tracemalloc
+
+from common import contract_calls, elaborate, load_script, smartpy, timeit
+
+
+class Counting:
+    def __init__(self, interning):
+        self.interning = interning
+        self.calls = 0
+        self.instances = set()
+        self.intern_type = smartpy.intern_type
+
+    def __call__(self, cls, parts, extra, fields):
+        self.calls += 1
+        if not self.interning:
+            smartpy.interned_types.clear()
+        result = self.intern_type(cls, parts, extra, fields)
+        if self.instances is not None:
+            self.instances.add(id(result))
+        return result
+
+
+def measure(context, name, interning, repeat):
+    counting = Counting(interning)
+    original = smartpy.intern_type
+    smartpy.intern_type = counting
+    try:
+        smartpy.interned_types.clear()
+        export = elaborate(context, name).export()
+        (calls, instances) = (counting.calls, len(counting.instances))
+        # Counted once, the set would be part of the memory measured below
+        counting.instances = None
+
+        def run():
+            smartpy.interned_types.clear()
+            elaborate(context, name).export()
+
+        elapsed = timeit(run, repeat)
+        smartpy.interned_types.clear()
+        gc.collect()
+        tracemalloc.start()
+        contract = elaborate(context, name)
+        contract.export()
+        gc.collect()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        smartpy.intern_type = original
+        smartpy.interned_types.clear()
+    return export, calls, instances, elapsed, current
+
+
+def run(names, repeat):
+    context = load_script()
+    print("%-14s %-9s %8s %10s %10s %12s %6s" % ("contract", "interning", "types", "instances", "time (ms)", "memory (KB)", "same"))
+    for name in names:
+        results = {}
+        for interning in [False, True]:
+            results[interning] = measure(context, name, interning, repeat)
+        for interning in [False, True]:
+            (export, calls, instances, elapsed, memory) = results[interning]
+            print(
+                "%-14s %-9s %8i %10i %10.2f %12.1f %6s"
+                % (name, interning, calls, instances, 1000 * elapsed, memory / 1024, export == results[False][0])
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Interned types benchmark")
+    parser.add_argument("contracts", nargs="*", default=list(contract_calls))
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.contracts, args.repeat)
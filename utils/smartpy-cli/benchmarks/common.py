@@ -0,0 +1,124 @@
+## Helpers shared by the SmartPy elaboration benchmarks. ##
+
+import os
+import sys
+import time
+
+cli_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if cli_directory not in sys.path:
+    sys.path.insert(0, cli_directory)
+
+import browser
+import smartpyio
+import smartpy
+
+main_script = os.path.join(cli_directory, "..", "..", "contracts", "src", "main.py")
+
+contract_calls = {
+    "QuadToken": "QuadToken(sp.address('tz1aoQSwjDU4pxSwT5AsBiK5Xk15FWgBJoYr'), True)",
+    "DAO": "DAO(sp.address('tz1aoQSwjDU4pxSwT5AsBiK5Xk15FWgBJoYr'), sp.address('KT1M5okdsaETTgRgRpwEyAXr7LhPpyVTp29F'), True)",
+    "RoundManager": "RoundManager(sp.address('KT1BVUacxr898SAp7HjHrZiVatwvVxe85Crc'), True)",
+}
+
+
+def load_script(filename=main_script):
+    """Adapts, compiles and executes a SmartPy script, returns its globals."""
+    code = open(filename, "r").read()
+    compiledCode = compile(smartpyio.adaptBlocks(code), "SmartPy Script", "exec")
+    context = {"alert": browser.alert, "window": browser.window}
+    exec(compiledCode, context)
+    return context
+
+
+def elaborate(context, name):
+    """Elaborates a contract of main.py with fresh counters, as smartpyio.run does."""
+    smartpy.sp.types.unknownIds = 0
+    smartpy.sp.types.seqCounter = 0
+    browser.window.lambdaNextId = 0
+    browser.window.contractNextId = 0
+    return eval(contract_calls[name], context)
+
+
+def timeit(f, repeat):
+    """Best wall-clock time of f() over repeat runs, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+simple_instructions = [
+    "DUP;",
+    "DROP;",
+    "SWAP;",
+    "CAR;",
+    "CDR;",
+    "PAIR;",
+    "ADD;",
+    "SUB;",
+    "COMPARE;",
+    "EQ;",
+    "GT;",
+    "SENDER;",
+    "NOW;",
+    "AMOUNT;",
+    "PUSH nat 1;",
+    "PUSH string \"WrongCondition\";",
+    "DIG 2;",
+    "DUG 3;",
+    "GET;",
+    "UPDATE;",
+    "SOME;",
+    "NIL operation;",
+]
+
+
+def michelson_contract(instructions, seed=0):
+    """A Michelson contract laid out as SmartPy compiles it, with about that many instructions."""
+    import random
+
+    rng = random.Random(seed)
+    lines = [
+        "parameter (or (or (unit %claim) (nat %vote)) (pair %propose (string %description) (timestamp %endTime)));",
+        "storage   (pair (pair (address %admin) (big_map %votes nat nat)) (pair (nat %count) (bool %active)));",
+        "code",
+        "  {",
+    ]
+    count = [0]
+
+    def block(indent, size):
+        while size > 0 and count[0] < instructions:
+            r = rng.random()
+            if r < 0.08 and indent < 20:
+                branch = rng.choice(["IF_LEFT", "IF", "IF_NONE", "LOOP"])
+                lines.append(indent * " " + branch)
+                lines.append((indent + 2) * " " + "{")
+                block(indent + 4, rng.randint(1, 12))
+                if branch == "LOOP":
+                    lines.append((indent + 2) * " " + "};")
+                    size -= 1
+                    continue
+                lines.append((indent + 2) * " " + "}")
+                lines.append((indent + 2) * " " + "{")
+                block(indent + 4, rng.randint(1, 12))
+                lines.append((indent + 2) * " " + "};")
+            elif r < 0.12:
+                lines.append(indent * " " + "%-10s # == line %i ==" % (rng.choice(simple_instructions), rng.randint(1, 900)))
+            else:
+                lines.append(indent * " " + rng.choice(simple_instructions))
+            count[0] += 1
+            size -= 1
+
+    block(4, instructions)
+    lines.append("    NIL operation;")
+    lines.append("    PAIR")
+    lines.append("  };")
+    # The last instruction of a sequence has no semicolon
+    for i in range(len(lines) - 1):
+        if lines[i + 1].lstrip().startswith("}") and lines[i].endswith(";"):
+            lines[i] = lines[i][:-1]
+    return "\n".join(lines)
@@ -23,6 +23,7 @@ class Window:
     contractNextId = 0
     lambdaNextId = 0
     activeTrace = None
+    scenarioStream = None
 
     class console: pass
     console.log = print
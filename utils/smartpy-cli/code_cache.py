@@ -0,0 +1,91 @@
+## Adapted scripts and their compiled code objects kept between runs, like __pycache__. ##
+
+# An entry holds a header and the marshalled pair (adapted code, code
+# object). It is stored under the digest of the script, of the Python that
+# compiled it (its bytecode magic number) and of the SmartPy version and
+# adaptation code, so entries of other versions are never read. Entries are
+# written to a temporary file renamed over the old one: readers see a whole
+# entry or none. Those that cannot be read back are removed.
+
+import hashlib
+import importlib.util
+import marshal
+import os
+import sys
+
+import compile_cache
+from version import version
+
+script_filename = "SmartPy Script"
+header = b"SPYC" + importlib.util.MAGIC_NUMBER
+
+
+def python_version():
+    return "%s %s" % (sys.implementation.cache_tag, importlib.util.MAGIC_NUMBER.hex())
+
+
+def code_key(code, filename=script_filename):
+    h = hashlib.sha256()
+    for part in [
+        version,
+        compile_cache.source_digest("smartpyio.py"),
+        python_version(),
+        filename,
+        code,
+    ]:
+        h.update(part.encode("utf8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class CodeCache(compile_cache.CompileCache):
+    """Scripts adapted by smartpyio.adaptBlocks and compiled, by digest of the script."""
+
+    suffix = ".spyc"
+    binary = True
+
+    def __init__(self, directory=None, max_bytes=None, max_age=None):
+        if directory is None:
+            directory = os.path.join(compile_cache.default_directory, "code")
+        compile_cache.CompileCache.__init__(self, directory, max_bytes, max_age)
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, code, filename=script_filename):
+        """(adapted code, code object) of a script, or None."""
+        import smartpyio
+
+        key = code_key(code, filename)
+        data = self.read(key)
+        if data is not None and data.startswith(header):
+            try:
+                (adaptedCode, codeObject) = marshal.loads(data[len(header) :])
+            except (EOFError, ValueError, TypeError):
+                pass
+            else:
+                # As adaptBlocks would
+                smartpyio.reverseLines.set(adaptedCode.count("\n") + 1)
+                self.hits += 1
+                return adaptedCode, codeObject
+        if data is not None:
+            self.remove(self.path(key))
+        self.misses += 1
+        return None
+
+    def store(self, code, adaptedCode, codeObject, filename=script_filename):
+        try:
+            self.write(code_key(code, filename), header + marshal.dumps((adaptedCode, codeObject)))
+        except OSError as e:
+            print("Could not write to the compile cache: %s" % e)
+
+    def compile(self, code, filename=script_filename):
+        """Adapts and compiles a script, unless it is stored."""
+        import smartpyio
+
+        result = self.load(code, filename)
+        if result is None:
+            adaptedCode = smartpyio.adaptBlocks(code)
+            codeObject = compile(adaptedCode, filename, "exec")
+            self.store(code, adaptedCode, codeObject, filename)
+            result = (adaptedCode, codeObject)
+        return result
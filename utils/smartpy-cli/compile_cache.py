@@ -0,0 +1,128 @@
+## Content-addressed on-disk cache of contract exports. ##
+
+import hashlib
+import os
+import tempfile
+import time
+
+from version import version
+
+default_directory = os.environ.get(
+    "SMARTPY_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "smartpy")
+)
+default_max_bytes = 64 * 1024 * 1024
+default_max_age = 7 * 24 * 3600
+suffix = ".sexpr"
+
+source_digests = {}
+
+
+def source_digest(name):
+    """Digest of a source file, by default a module of the CLI, read once."""
+    result = source_digests.get(name)
+    if result is None:
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+        result = source_digests[name] = hashlib.sha256(open(filename, "rb").read()).hexdigest()
+    return result
+
+
+def smartpy_fingerprint():
+    """Version of the library, with a digest of smartpy.py since dev builds share one version."""
+    return "%s:%s" % (version, source_digest("smartpy.py"))
+
+
+def cache_key(adaptedCode, class_call, options=""):
+    h = hashlib.sha256()
+    for part in [smartpy_fingerprint(), class_call, options, adaptedCode]:
+        h.update(part.encode("utf8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class CompileCache:
+    """Exports stored under the hash of what produced them.
+
+    Entries are evicted when older than max_age seconds, then least recently
+    used first until the directory holds at most max_bytes.
+    """
+
+    suffix = suffix
+    # Entries are bytes rather than text
+    binary = False
+
+    def __init__(self, directory=None, max_bytes=None, max_age=None):
+        self.directory = default_directory if directory is None else directory
+        self.max_bytes = default_max_bytes if max_bytes is None else max_bytes
+        self.max_age = default_max_age if max_age is None else max_age
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def open(self, path, mode):
+        if self.binary:
+            return open(path, mode + "b")
+        return open(path, mode, newline="")
+
+    def get(self, adaptedCode, class_call, options=""):
+        return self.read(cache_key(adaptedCode, class_call, options))
+
+    def put(self, adaptedCode, class_call, sexpr, options=""):
+        self.write(cache_key(adaptedCode, class_call, options), sexpr)
+
+    def read(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with self.open(path, "r") as f:
+                result = f.read()
+            os.utime(path)
+            return result
+        except OSError:
+            return None
+
+    def write(self, key, text):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with self.open(fd, "w") as f:
+                f.write(text)
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        result = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            result.append((stat.st_mtime, stat.st_size, path))
+        return result
+
+    def evict(self):
+        now = time.time()
+        kept = []
+        for entry in self.entries():
+            if now - entry[0] > self.max_age:
+                self.remove(entry[2])
+            else:
+                kept.append(entry)
+        total = sum(size for _, size, _ in kept)
+        for mtime, size, path in sorted(kept):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
@@ -0,0 +1,80 @@
+## Long-lived smartpy_cli process serving invocations over a Unix socket. ##
+
+# Server side: smartpy_cli.py --serve SOCKET
+# Client side: python3 compile_daemon.py SOCKET [smartpy_cli arguments]
+#
+# A request is one JSON line {"argv": [...], "cwd": "..."}, the answer is a
+# JSON object {"status": exit code, "output": stdout and stderr}.
+# Requests are served one at a time since elaboration uses global state.
+
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import traceback
+
+
+def exit_status(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code)
+    return 1
+
+
+def run_captured(run, argv, cwd):
+    output = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            run(argv, cwd)
+        except SystemExit as e:
+            status = exit_status(e)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    return {"status": status, "output": output.getvalue()}
+
+
+def serve(path, run):
+    """Serves requests on the socket at path with run(argv, cwd) until interrupted."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline().decode("utf8"))
+            answer = run_captured(run, request["argv"], request["cwd"])
+            self.wfile.write((json.dumps(answer) + "\n").encode("utf8"))
+
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socketserver.UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def request(path, argv, cwd=None):
+    """Sends one smartpy_cli invocation to the daemon at path."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        message = {"argv": argv, "cwd": os.getcwd() if cwd is None else cwd}
+        s.sendall((json.dumps(message) + "\n").encode("utf8"))
+        with s.makefile("rb") as f:
+            return json.loads(f.readline().decode("utf8"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: compile_daemon.py SOCKET [smartpy_cli arguments]")
+        sys.exit(1)
+    answer = request(sys.argv[1], sys.argv[2:])
+    sys.stdout.write(answer["output"])
+    sys.exit(answer["status"])
@@ -0,0 +1,334 @@
+## Export fragments of entry points kept between runs. ##
+
+# An entry point is elaborated again only when its fingerprint changes. The
+# fingerprint covers its code objects (bytecode, constants, names and line
+# table), what they refer to in the script (helper functions, classes,
+# constants and methods of the contract), the Python attributes of the
+# contract, the id counters the entry point starts from, the library and
+# the export options. Its export and the counters it leaves are stored
+# under that fingerprint. Contracts holding values that cannot be
+# fingerprinted (objects without an export) are always elaborated.
+#
+# Entry points also share the attribute nodes cached on self.data (see
+# smartpy.cached_nodes): those cached before an entry point are part of its
+# fingerprint, those it leaves are restored when it is replayed.
+#
+# Exports hold line numbers, so inserting lines above an entry point
+# elaborates it again too.
+
+import builtins
+import hashlib
+import json
+import os
+import sys
+import types
+
+import compile_cache
+import smartpyio
+
+script_filename = "SmartPy Script"
+scalars = (str, int, bool, float, complex, bytes, type(None))
+
+# Attributes of a contract that are set by the library while elaborating it.
+elaboration_attributes = frozenset(
+    [
+        "address",
+        "balance",
+        "baker",
+        "contract_data_nodes",
+        "currentBlock",
+        "data",
+        "hash_consing_stats",
+        "mb",
+        "messages",
+        "messages_collected",
+        "read_hoisting_stats",
+        "smartml",
+    ]
+)
+
+
+def code_parts(code):
+    return [
+        code.co_code,
+        getattr(code, "co_linetable", None) or code.co_lnotab,
+        getattr(code, "co_exceptiontable", b""),
+        repr(
+            (
+                code.co_firstlineno,
+                code.co_argcount,
+                code.co_kwonlyargcount,
+                code.co_flags,
+                code.co_names,
+                code.co_varnames,
+                code.co_freevars,
+                code.co_cellvars,
+            )
+        ).encode("utf8"),
+    ]
+
+
+def elaboration_counters():
+    """The counters of smartpyio.counters, all moved by entry points: contract
+    ids among them when an entry point creates a contract."""
+    return list(smartpyio.counters())
+
+
+def set_elaboration_counters(state):
+    smartpyio.set_counters(tuple(state))
+
+
+class Unfingerprintable(Exception):
+    pass
+
+
+class Fingerprint:
+    """Digests of the values entry points depend on, memoized by id.
+
+    Functions and classes of the script are digested through their code and
+    attributes, modules, functions and classes of libraries through their
+    name and the source of their module.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        # Classes of the script are made in the namespace of the contract
+        self.script_module = cls.__module__
+        self.digests = {}
+        self.kept = []
+
+    def value(self, x):
+        if isinstance(x, scalars):
+            return repr(x)
+        if isinstance(x, tuple):
+            return "(%s)" % ",".join(self.value(v) for v in x)
+        if isinstance(x, list):
+            return "[%s]" % ",".join(self.value(v) for v in x)
+        if isinstance(x, (set, frozenset)):
+            return "{%s}" % ",".join(sorted(self.value(v) for v in x))
+        if isinstance(x, dict):
+            return "{%s}" % ",".join(sorted("%s:%s" % (self.value(k), self.value(v)) for (k, v) in x.items()))
+        key = id(x)
+        result = self.digests.get(key)
+        if result is None:
+            # Stands for x in its own digest, while it is computed
+            self.digests[key] = "cycle"
+            self.kept.append(x)
+            try:
+                result = self.digests[key] = self.compute(x)
+            except Unfingerprintable:
+                del self.digests[key]
+                raise
+        return result
+
+    def compute(self, x):
+        import smartpy
+
+        if isinstance(x, types.FunctionType):
+            return self.function(x)
+        if isinstance(x, types.MethodType):
+            return self.value(x.__func__)
+        if isinstance(x, (smartpy.AddedMessage, smartpy.GlobalLambda)):
+            return "%s %s" % (x.__class__.__name__, self.value(x.f))
+        if isinstance(x, smartpy.SubEntryPoint):
+            return "SubEntryPoint %s" % self.value(x.fg)
+        if isinstance(x, types.BuiltinFunctionType):
+            if x.__self__ is None or isinstance(x.__self__, types.ModuleType):
+                return "builtin %s.%s" % (x.__module__, x.__qualname__)
+            return "builtin %s of %s" % (x.__qualname__, self.value(x.__self__))
+        if isinstance(x, (staticmethod, classmethod)):
+            return "%s %s" % (x.__class__.__name__, self.value(x.__func__))
+        if isinstance(x, property):
+            return "property " + self.value((x.fget, x.fset, x.fdel))
+        if isinstance(x, types.ModuleType):
+            return self.library("module", x.__name__, "", getattr(x, "__file__", None))
+        if isinstance(x, type):
+            return self.type(x)
+        if hasattr(x, "export"):
+            try:
+                return "export " + x.export()
+            except Exception:
+                pass
+        # Two such objects could differ in what entry points read from them
+        raise Unfingerprintable(x.__class__.__qualname__)
+
+    def function(self, f):
+        code = f.__code__
+        if code.co_filename != script_filename:
+            return self.library("function", f.__module__, f.__qualname__, code.co_filename)
+        h = hashlib.sha256()
+        self.code(code, f.__globals__, h)
+        h.update(self.value(f.__defaults__).encode("utf8"))
+        h.update(self.value(f.__kwdefaults__).encode("utf8"))
+        for cell in f.__closure__ or ():
+            try:
+                h.update(self.value(cell.cell_contents).encode("utf8"))
+            except ValueError:
+                h.update(b"empty cell")
+        return h.hexdigest()
+
+    def code(self, code, namespace, h):
+        for part in code_parts(code):
+            h.update(part)
+            h.update(b"\0")
+        for c in code.co_consts:
+            if isinstance(c, types.CodeType):
+                self.code(c, namespace, h)
+            else:
+                h.update(self.value(c).encode("utf8"))
+                h.update(b"\0")
+        # Names are globals, builtins or attributes, of self among others.
+        # Attributes of other values are digested with these values.
+        builtin_names = namespace.get("__builtins__", {})
+        if isinstance(builtin_names, types.ModuleType):
+            builtin_names = builtin_names.__dict__
+        for name in code.co_names:
+            if name in namespace:
+                h.update(("%s=%s\0" % (name, self.value(namespace[name]))).encode("utf8"))
+            elif hasattr(self.cls, name):
+                h.update(("self.%s=%s\0" % (name, self.value(getattr(self.cls, name)))).encode("utf8"))
+            elif name in builtin_names:
+                h.update(("builtins.%s=%s\0" % (name, self.value(builtin_names[name]))).encode("utf8"))
+
+    def type(self, cls):
+        # Scripts run without __name__ make classes of the builtins module
+        if cls.__module__ != self.script_module or vars(builtins).get(cls.__qualname__) is cls:
+            module = sys.modules.get(cls.__module__)
+            return self.library("class", cls.__module__, cls.__qualname__, getattr(module, "__file__", None))
+        h = hashlib.sha256()
+        h.update(("class %s\0" % cls.__qualname__).encode("utf8"))
+        for base in cls.__bases__:
+            h.update(self.value(base).encode("utf8"))
+        for (name, x) in sorted(cls.__dict__.items()):
+            if name not in ("__dict__", "__weakref__"):
+                h.update(("%s=%s\0" % (name, self.value(x))).encode("utf8"))
+        return h.hexdigest()
+
+    def library(self, kind, module, qualname, filename):
+        """Modules without a source are built into Python, as are frozen ones."""
+        if filename is None or filename.startswith("<frozen "):
+            return "%s %s.%s" % (kind, module, qualname)
+        try:
+            digest = compile_cache.source_digest(filename)
+        except OSError:
+            raise Unfingerprintable("%s.%s" % (module, qualname))
+        return "%s %s.%s %s" % (kind, module, qualname, digest)
+
+
+class MessageCache:
+    """Replays the exports of unchanged entry points, see smartpy.set_message_cache.
+
+    Entry points changing the flags or global variables of their contract
+    are always elaborated, their side effects would not be replayed, and so
+    are those whose export depends on where it is made from (see
+    smartpy.context_free_export).
+
+    Contracts can be built while the entry points of another one are added
+    (sp.create_contract): begin and end keep the fingerprint and context of
+    each contract on a stack.
+    """
+
+    def __init__(self, directory=None, options=""):
+        if directory is None:
+            directory = compile_cache.default_directory
+        self.store = compile_cache.CompileCache(os.path.join(directory, "messages"))
+        self.store.suffix = ".json"
+        self.options = options
+        # (contract, fingerprint, context or None if it is not cached)
+        self.contracts = []
+        self.hits = 0
+        self.misses = 0
+
+    def begin(self, contract):
+        """Called once per contract, before its entry points are added."""
+        import smartpy
+
+        fingerprint = Fingerprint(contract.__class__)
+        try:
+            attributes = sorted(
+                (k, fingerprint.value(v))
+                for (k, v) in vars(contract).items()
+                if k not in elaboration_attributes and not isinstance(v, smartpy.AddedMessage)
+            )
+            context = "%s %s" % (
+                contract.__class__.__qualname__,
+                fingerprint.value(attributes),
+            )
+        except Unfingerprintable:
+            context = None
+        self.contracts.append((contract, fingerprint, context))
+
+    def end(self, contract):
+        """Called once per contract, after its entry points are added."""
+        (current, _, _) = self.contracts.pop()
+        assert current is contract
+
+    def key(self, contract, addedMessage):
+        """Key of an entry point of the current contract, or None if it cannot be cached."""
+        import smartpy
+
+        (current, fingerprint, context) = self.contracts[-1]
+        assert current is contract
+        if context is None:
+            return None
+        try:
+            code = fingerprint.value(addedMessage.f)
+        except Unfingerprintable:
+            return None
+        h = hashlib.sha256()
+        for part in [
+            compile_cache.smartpy_fingerprint(),
+            self.options,
+            context,
+            addedMessage.name,
+            str(addedMessage.originate),
+            str(addedMessage.lineNo),
+            code,
+            json.dumps(smartpy.cached_nodes(contract.data)),
+            json.dumps(elaboration_counters()),
+            # Line of the script creating the contract, if any
+            str(smartpy.get_line_no()),
+        ]:
+            h.update(part.encode("utf8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def add(self, contract, addedMessage):
+        import smartpy
+
+        name = addedMessage.name
+        key = self.key(contract, addedMessage)
+        if key is None:
+            self.misses += 1
+            contract.addMessage(addedMessage)
+            return
+        text = self.store.read(key)
+        fragment = None if text is None else json.loads(text)
+        if fragment is not None and fragment["export"] is not None:
+            contract.addCachedMessage(addedMessage, fragment["export"])
+            smartpy.restore_cached_nodes(contract.data, fragment["data"])
+            if fragment["read_hoisting"] is not None:
+                contract.read_hoisting_stats[name] = fragment["read_hoisting"]
+            set_elaboration_counters(fragment["counters"])
+            self.hits += 1
+            return
+        self.misses += 1
+        before = (len(contract.global_variables), frozenset(contract.flags))
+        contract.addMessage(addedMessage)
+        if fragment is not None:
+            # Known not to be replayable
+            return
+        if (len(contract.global_variables), frozenset(contract.flags)) != before:
+            export = None
+        else:
+            export = smartpy.context_free_export(contract.messages[name])
+        fragment = {
+            "export": export,
+            "counters": elaboration_counters(),
+            "data": smartpy.cached_nodes(contract.data),
+            "read_hoisting": contract.read_hoisting_stats.get(name),
+        }
+        try:
+            self.store.write(key, json.dumps(fragment))
+        except OSError as e:
+            print("Could not write to the compile cache: %s" % e)
@@ -0,0 +1,175 @@
+## Michelson files from the command line: formatting and compression as in the editor, static costs. ##
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import smartpyio
+
+
+@contextlib.contextmanager
+def borrowed_text(stream, **kwargs):
+    """A text stream on a binary stream the process owns (stdin, stdout), left open on exit."""
+    result = io.TextIOWrapper(stream, encoding="utf8", **kwargs)
+    try:
+        yield result
+    finally:
+        result.flush()
+        result.detach()
+
+
+def input_lines(filename):
+    """Lines of a file, or of stdin for "-", split on newlines only as ppMichelson does."""
+    if filename == "-":
+        return borrowed_text(sys.stdin.buffer, newline="\n")
+    return open(filename, "r", encoding="utf8", newline="\n")
+
+
+class CountedLines:
+    """Lines of a binary stream without their newline, counting the bytes read."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def __iter__(self):
+        for line in self.stream:
+            self.size += len(line)
+            if line.endswith(b"\n"):
+                line = line[:-1]
+            yield line.decode("utf8")
+
+
+def michelson_files(paths):
+    """Paths, with directories (SmartPy.sh output directories) standing for their .tz files."""
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, "*.tz")))
+        else:
+            yield path
+
+
+@contextlib.contextmanager
+def replacing(filename):
+    """A new file taking the place of filename once written, which can then be an input too."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp")
+    try:
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        with open(fd, "w", encoding="utf8", newline="\n") as result:
+            yield result
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def output(filename):
+    """A file to write to, or stdout for None: closing it leaves stdout open."""
+    if filename is None:
+        # What was printed before comes first
+        sys.stdout.flush()
+        return borrowed_text(sys.stdout.buffer, newline="\n", write_through=True)
+    return replacing(filename)
+
+
+def pp(args):
+    with output(args.output) as out:
+        for filename in args.files:
+            with input_lines(filename) as lines:
+                out.writelines(smartpyio.pp_michelson_chunks(lines, not args.no_comments))
+            out.write("\n")
+
+
+def compress_file(filename, out):
+    """Writes a file without comments and with sequences merged, one line at a time, returns the sizes before and after."""
+    written = 0
+    with (contextlib.nullcontext(sys.stdin.buffer) if filename == "-" else open(filename, "rb")) as stream:
+        lines = CountedLines(stream)
+        for line in smartpyio.compress_michelson_lines(smartpyio.strip_michelson_comments(lines)):
+            line += "\n"
+            out.write(line)
+            written += len(line) if line.isascii() else len(line.encode("utf8"))
+    report(filename, lines.size, written)
+    return lines.size, written
+
+
+def compress(args):
+    files = list(michelson_files(args.files))
+    if args.output is not None and len(files) != 1:
+        raise SystemExit("--output needs a single input, use --output_dir")
+    sizes = []
+    if args.output_dir is None:
+        with output(args.output) as out:
+            sizes = [compress_file(filename, out) for filename in files]
+    else:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for filename in files:
+            with output(os.path.join(args.output_dir, os.path.basename(filename))) as out:
+                sizes.append(compress_file(filename, out))
+    if len(files) > 1:
+        report("total", sum(size[0] for size in sizes), sum(size[1] for size in sizes))
+
+
+def report(name, before, after):
+    saved = before - after
+    print(
+        "%s: %i -> %i bytes, %i saved (%.1f%%)" % (name, before, after, saved, 100.0 * saved / before if before else 0),
+        file=sys.stderr,
+    )
+
+
+def cost(args):
+    import michelson_cost
+
+    result = michelson_cost.report(args.paths)
+    if not result["contracts"]:
+        raise SystemExit("No compiled contract found in %s" % " ".join(args.paths))
+    with output(args.output) as out:
+        out.write(michelson_cost.dumps(result))
+    if args.baseline is not None:
+        with open(args.baseline, "r", encoding="utf8") as f:
+            baseline = json.load(f)
+        regressions = michelson_cost.compare(baseline, result, args.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SmartPy Michelson tools")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    command = commands.add_parser("pp", help="format Michelson as smartpyio.ppMichelson")
+    command.add_argument("files", nargs="*", default=["-"], help="Michelson files (default: stdin)")
+    command.add_argument("--no_comments", action="store_true", help="drop comments")
+    command.add_argument("-o", "--output", nargs="?", help="output file, replaced once written: it can be an input (default: stdout)")
+    command.set_defaults(run=pp)
+    command = commands.add_parser("compress", help="remove comments and merge sequences as smartpyio.removeCommentsMichelson, reporting the bytes saved")
+    command.add_argument("files", nargs="*", default=["-"], help="Michelson files or directories of .tz files (default: stdin)")
+    command.add_argument("-o", "--output", nargs="?", help="output file, replaced once written: it can be the input (default: stdout)")
+    command.add_argument("--output_dir", nargs="?", help="directory to write each compressed file to, under its name: it can be an input directory")
+    command.set_defaults(run=compress)
+    command = commands.add_parser("cost", help="report sizes, entry point instructions, loops, gas bounds and storage costs of compiled contracts as JSON")
+    command.add_argument("paths", nargs="*", default=["."], help="NAME_compiled.tz files or SmartPy.sh output directories (default: .)")
+    command.add_argument("-o", "--output", nargs="?", help="output file (default: stdout)")
+    command.add_argument("--baseline", nargs="?", help="previous report, exits with 1 on regressions from it")
+    command.add_argument("--tolerance", type=float, default=0.0, help="growth in percent allowed from the baseline (default: 0)")
+    command.set_defaults(run=cost)
+    args = parser.parse_args(argv)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+## Static cost report of compiled Michelson: size, entry points, loops, gas bound and storage cost. ##
+
+# Reads the .tz files written by SmartPy.sh compile (NAME_compiled.tz and
+# NAME_storage_init.tz) and reports, for each contract:
+#
+#   code         instructions, text bytes once compressed and Micheline
+#                binary bytes of the script
+#   storage      binary bytes of the initial storage and the tez burnt to
+#                originate the contract
+#   entry_points for each branch of the parameter dispatch (the IF_LEFT
+#                tree matching the or type of the parameter), its
+#                instructions, the instructions of its longest path, its
+#                loops and a gas bound
+#   common       the instructions outside of the dispatch
+#
+# Gas bounds add the weights of gas_weights along the longest path of an
+# entry point, with the code around the dispatch, counting loop bodies
+# once. They are only bounds of entry points without loops, iterations or
+# lambda calls ("bounded"), and are in units of that table rather than
+# protocol gas: they show how costs move from one build to the next.
+#
+# Reports are JSON with sorted keys, compare checks one against a baseline.
+
+import json
+import os
+import re
+
+import smartpyio
+
+cost_model = 1
+
+# Tez burnt per byte of storage and bytes paid for a new contract
+cost_per_byte = 250
+origination_size = 257
+
+default_weight = 1
+gas_weights = {}
+for (weight, names) in [
+    (2, "ABS ADD AND COMPARE EQ GE GT INT ISNAT LE LSL LSR LT NEG NEQ NOT OR SUB XOR LAMBDA EXEC"),
+    (4, "MUL EDIV APPLY"),
+    (8, "CONCAT GET GET_AND_UPDATE MEM SIZE SLICE UPDATE"),
+    (10, "IMPLICIT_ACCOUNT"),
+    (30, "BLAKE2B HASH_KEY KECCAK SHA256 SHA3 SHA512"),
+    (40, "PACK SET_DELEGATE TRANSFER_TOKENS"),
+    (60, "CONTRACT UNPACK"),
+    (200, "CREATE_CONTRACT"),
+    (600, "CHECK_SIGNATURE"),
+]:
+    for name in names.split():
+        gas_weights[name] = weight
+
+# Instructions running code a number of times known at run time only
+loop_instructions = frozenset(["ITER", "LOOP", "LOOP_LEFT", "MAP"])
+unbounded_instructions = loop_instructions | frozenset(["EXEC"])
+# Instructions running one of their sequences
+branch_instructions = frozenset(["IF", "IF_CONS", "IF_LEFT", "IF_NONE"])
+# Instructions whose sequences are data or the code of another contract
+data_instructions = frozenset(["CREATE_CONTRACT", "PUSH"])
+
+token_re = re.compile(r'\s+|#[^\n]*|/\*.*?\*/|"(?:[^"\\]|\\.)*"|[{}();]|[^\s{}();"#]+', re.S)
+int_re = re.compile(r"-?[0-9]+")
+
+
+class Prim:
+    """An instruction, type or data constructor and its arguments."""
+
+    __slots__ = ("name", "args", "annots")
+
+    def __init__(self, name, args, annots):
+        self.name = name
+        self.args = args
+        self.annots = annots
+
+
+class Parser:
+    """Micheline expressions of Michelson text: lists for sequences, Prim, int, str and bytes."""
+
+    def __init__(self, text):
+        self.tokens = [
+            token
+            for token in (m.group() for m in token_re.finditer(text))
+            if not token[0].isspace() and token[0] != "#" and not token.startswith("/*")
+        ]
+        self.i = 0
+
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Unexpected end of Michelson")
+        self.i += 1
+        return token
+
+    def expect(self, token):
+        found = self.next()
+        if found != token:
+            raise ValueError("Expected %r, found %r at token %i" % (token, found, self.i - 1))
+
+    def script(self):
+        """Items of a whole file, with or without braces around them."""
+        if self.peek() == "{":
+            self.next()
+            result = self.sequence()
+        else:
+            result = self.items(None)
+        self.end()
+        return result
+
+    def data(self):
+        """The single expression of a whole file, as NAME_storage_init.tz."""
+        result = self.application()
+        while self.peek() == ";":
+            self.next()
+        self.end()
+        return result
+
+    def end(self):
+        if self.peek() is not None:
+            raise ValueError("Unexpected %r at token %i" % (self.peek(), self.i))
+
+    def sequence(self):
+        result = self.items("}")
+        self.expect("}")
+        return result
+
+    def items(self, end):
+        result = []
+        while True:
+            token = self.peek()
+            if token == end:
+                return result
+            if token == ";":
+                self.next()
+                continue
+            result.append(self.application())
+            if self.peek() not in (";", end):
+                raise ValueError("Expected ';' at token %i, found %r" % (self.i, self.peek()))
+
+    def application(self):
+        token = self.next()
+        if token == "{":
+            return self.sequence()
+        if token == "(":
+            result = self.application()
+            self.expect(")")
+            return result
+        result = self.atom(token)
+        if not isinstance(result, Prim):
+            return result
+        while self.peek() not in (None, ";", "}", ")"):
+            token = self.next()
+            if token[0] in "%@:":
+                result.annots.append(token)
+            elif token == "{":
+                result.args.append(self.sequence())
+            elif token == "(":
+                result.args.append(self.application())
+                self.expect(")")
+            else:
+                result.args.append(self.atom(token))
+        return result
+
+    def atom(self, token):
+        if token[0] == '"':
+            return token[1:-1]
+        if int_re.fullmatch(token):
+            return int(token)
+        if token.startswith("0x"):
+            return bytes.fromhex(token[2:])
+        return Prim(token, [], [])
+
+
+def parse(text):
+    return Parser(text).script()
+
+
+def parse_data(text):
+    return Parser(text).data()
+
+
+def zarith_size(n):
+    bits = abs(n).bit_length()
+    return 1 if bits <= 6 else 1 + (bits - 6 + 6) // 7
+
+
+def binary_size(x):
+    """Bytes of x in the Micheline binary encoding, as originated."""
+    if isinstance(x, list):
+        return 5 + sum(binary_size(y) for y in x)
+    if isinstance(x, int):
+        return 1 + zarith_size(x)
+    if isinstance(x, str):
+        return 5 + len(x.encode("utf8"))
+    if isinstance(x, bytes):
+        return 5 + len(x)
+    annots = len(" ".join(x.annots).encode("utf8"))
+    args = sum(binary_size(y) for y in x.args)
+    if len(x.args) > 2:
+        return 2 + 4 + args + 4 + annots
+    return 2 + args + (4 + annots if x.annots else 0)
+
+
+class Cost:
+    """Instructions of some code, those of its longest path, its gas bound and loops."""
+
+    def __init__(self):
+        self.instructions = 0
+        self.path = 0
+        self.gas = 0
+        self.loops = []
+        self.unbounded = set()
+
+    def add(self, other):
+        self.instructions += other.instructions
+        self.path += other.path
+        self.gas += other.gas
+        self.loops += other.loops
+        self.unbounded |= other.unbounded
+
+    def json(self):
+        return {
+            "instructions": self.instructions,
+            "worst_path": self.path,
+            "gas_bound": self.gas,
+            "bounded": not self.unbounded,
+            "unbounded_by": sorted(self.unbounded),
+            "loops": self.loops,
+            "loop_count": len(self.loops),
+        }
+
+
+def code_cost(code, depth=0):
+    """Cost of a sequence of instructions, loops are at the given nesting depth."""
+    result = Cost()
+    for x in code:
+        if isinstance(x, list):
+            result.add(code_cost(x, depth))
+            continue
+        if not isinstance(x, Prim):
+            continue
+        result.instructions += 1
+        result.path += 1
+        result.gas += gas_weights.get(x.name, default_weight)
+        if x.name in unbounded_instructions:
+            result.unbounded.add(x.name)
+        if x.name in data_instructions:
+            continue
+        bodies = [code_cost(y, depth + (x.name in loop_instructions)) for y in x.args if isinstance(y, list)]
+        if x.name in loop_instructions and bodies:
+            result.loops.append({"instruction": x.name, "depth": depth, "body_instructions": bodies[0].instructions})
+        if x.name in branch_instructions and bodies:
+            for body in bodies:
+                result.instructions += body.instructions
+                result.loops += body.loops
+                result.unbounded |= body.unbounded
+            result.path += max(body.path for body in bodies)
+            result.gas += max(body.gas for body in bodies)
+        elif x.name == "LAMBDA":
+            # Its body runs when called (EXEC), not here
+            for body in bodies:
+                result.instructions += body.instructions
+        else:
+            for body in bodies:
+                result.add(body)
+    return result
+
+
+def field_annotation(x):
+    for annot in x.annots:
+        if annot.startswith("%"):
+            return annot[1:]
+    return None
+
+
+def entry_point_costs(parameter, code):
+    """Costs of the entry points of the or tree of parameter dispatched by IF_LEFT in code, and of the rest."""
+    entry_points = {}
+    common = Cost()
+
+    def dispatch(t, code, around):
+        name = field_annotation(t)
+        split = None
+        if t.name == "or" and name is None:
+            split = next((i for (i, x) in enumerate(code) if isinstance(x, Prim) and x.name == "IF_LEFT"), None)
+        if split is None:
+            cost = code_cost(code)
+            cost.path += around.path
+            cost.gas += around.gas
+            entry_points[name or "default"] = cost.json()
+            return
+        rest = code_cost(code[:split] + code[split + 1 :])
+        common.add(rest)
+        common.instructions += 1
+        here = Cost()
+        here.path = around.path + rest.path + 1
+        here.gas = around.gas + rest.gas + gas_weights.get("IF_LEFT", default_weight)
+        (left, right) = (code[split].args + [[], []])[:2]
+        dispatch(t.args[0], left if isinstance(left, list) else [left], here)
+        dispatch(t.args[1], right if isinstance(right, list) else [right], here)
+
+    dispatch(parameter, code, Cost())
+    return entry_points, common
+
+
+def section(script, name):
+    for x in script:
+        if isinstance(x, Prim) and x.name == name:
+            return x.args[0]
+    raise ValueError("No %s section" % name)
+
+
+def contract_report(text, storage=None):
+    script = parse(text)
+    parameter = section(script, "parameter")
+    code = section(script, "code")
+    (entry_points, common) = entry_point_costs(parameter, code if isinstance(code, list) else [code])
+    scriptBytes = 4 + binary_size(script)
+    storageBytes = None if storage is None else 4 + binary_size(parse_data(storage))
+    paid = scriptBytes + (storageBytes or 0)
+    return {
+        "code": {
+            "instructions": code_cost(code if isinstance(code, list) else [code]).instructions,
+            "text_bytes": len(smartpyio.removeCommentsMichelson(text).encode("utf8")),
+            "binary_bytes": scriptBytes,
+        },
+        "storage": {
+            "initial_storage_bytes": storageBytes,
+            "paid_bytes": paid,
+            "burn_mutez": (paid + origination_size) * cost_per_byte,
+        },
+        "entry_points": entry_points,
+        "common": {"instructions": common.instructions, "gas_bound": common.gas},
+    }
+
+
+def compiled_files(paths):
+    """(name, code file, storage file or None) of NAME_compiled.tz files, directories stand for theirs."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith("_compiled.tz"))
+        else:
+            files.append(path)
+    result = []
+    names = set()
+    for filename in files:
+        base = os.path.basename(filename)
+        name = base[: -len("_compiled.tz")] if base.endswith("_compiled.tz") else os.path.splitext(base)[0]
+        if name in names:
+            name = "%s/%s" % (os.path.basename(os.path.dirname(os.path.abspath(filename))), name)
+        names.add(name)
+        storage = os.path.join(os.path.dirname(filename), name.split("/")[-1] + "_storage_init.tz")
+        result.append((name, filename, storage if os.path.exists(storage) else None))
+    return result
+
+
+def report(paths):
+    contracts = {}
+    for (name, filename, storage) in compiled_files(paths):
+        with open(filename, "r", encoding="utf8") as f:
+            text = f.read()
+        storageText = None
+        if storage is not None:
+            with open(storage, "r", encoding="utf8") as f:
+                storageText = f.read()
+        contracts[name] = contract_report(text, storageText)
+    return {"cost_model": cost_model, "contracts": contracts}
+
+
+def dumps(report):
+    return json.dumps(report, indent=2, sort_keys=True) + "\n"
+
+
+def metrics(x, prefix=""):
+    """Numbers and booleans of a report by path."""
+    if isinstance(x, dict):
+        for (k, v) in x.items():
+            yield from metrics(v, "%s/%s" % (prefix, k) if prefix else k)
+    elif isinstance(x, (bool, int, float)):
+        yield prefix, x
+
+
+def compare(baseline, report, tolerance=0.0):
+    """Regressions of report from baseline: numbers growing more than tolerance percent, bounds lost."""
+    if baseline.get("cost_model") != report.get("cost_model"):
+        return ["cost_model changed from %s to %s, make a new baseline" % (baseline.get("cost_model"), report.get("cost_model"))]
+    current = dict(metrics(report))
+    result = []
+    for (path, before) in metrics(baseline):
+        after = current.get(path)
+        if after is None:
+            continue
+        if isinstance(before, bool):
+            if before and not after:
+                result.append("%s: no longer true" % path)
+        elif after > before * (1 + tolerance / 100.0):
+            result.append("%s: %s -> %s" % (path, before, after))
+    return result
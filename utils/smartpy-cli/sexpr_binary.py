@@ -0,0 +1,393 @@
+## Compact binary encoding of exported sexprs. ##
+
+# A file holds a string pool, a tag table and a list of documents:
+#
+#   b"SPXB" version
+#   varint n, n strings (varint byte length, utf8)    string pool
+#   varint n, n pool indices                          tag table (op names)
+#   varint n, n token streams, each ended by END      documents
+#   varint n, n bytes of utf8 JSON                    metadata (n = 0: none)
+#
+# A token is a byte, kind | separator << 6, followed by its operand. The
+# separator is the whitespace before the token: none, a space, a newline
+# or, for anything else, a pool index after the token byte. Kinds are
+# OPEN, CLOSE, INT (zigzag varint), WORD and STRING (pool index, a string
+# without its quotes), END, and OPEN_TAG + i for "(" directly followed by
+# the i-th op name of the tag table. Pool strings and tags are sorted by
+# decreasing frequency so that the common ones have one byte indices.
+#
+# Decoding gives back the exported text exactly.
+
+import json
+import re
+
+magic = b"SPXB"
+format_version = 1
+
+OPEN = 0
+CLOSE = 1
+INT = 2
+WORD = 3
+STRING = 4
+END = 5
+OPEN_TAG = 6
+max_tags = 64 - OPEN_TAG
+
+SEP_NONE = 0
+SEP_SPACE = 1
+SEP_NEWLINE = 2
+SEP_OTHER = 3
+
+token_re = re.compile(r'(\s*)(\(|\)|"[^"]*"|[^\s()"]+)')
+int_re = re.compile(r"-?[1-9][0-9]*|0")
+separators = {"": SEP_NONE, " ": SEP_SPACE, "\n": SEP_NEWLINE}
+
+# Scenario message fields holding an exported sexpr.
+scenario_sexpr_fields = frozenset(["export", "params", "amount", "condition", "expression"])
+
+
+def tokens(text):
+    """(separator, token) pairs of text, and the trailing whitespace."""
+    result = []
+    pos = 0
+    match = token_re.match
+    while True:
+        m = match(text, pos)
+        if m is None:
+            break
+        result.append(m.groups())
+        pos = m.end()
+    rest = text[pos:]
+    if rest.strip():
+        raise ValueError("Cannot encode sexpr at offset %i: %r" % (pos, rest[:40]))
+    return result, rest
+
+
+def write_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, i):
+    result = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, i
+        shift += 7
+
+
+def zigzag(n):
+    return 2 * n if n >= 0 else -2 * n - 1
+
+
+def unzigzag(n):
+    return n >> 1 if n & 1 == 0 else -((n + 1) >> 1)
+
+
+def by_frequency(counts):
+    return sorted(counts, key=lambda x: (-counts[x], x))
+
+
+class Encoder:
+    def __init__(self, texts):
+        self.documents = [tokens(text) for text in texts]
+        strings = {}
+        ops = {}
+        for (toks, rest) in self.documents:
+            previous = None
+            for (sep, tok) in toks:
+                if sep not in separators:
+                    strings[sep] = strings.get(sep, 0) + 1
+                c = tok[0]
+                if c == "(" or c == ")":
+                    pass
+                elif c == '"':
+                    tok = tok[1:-1]
+                    strings[tok] = strings.get(tok, 0) + 1
+                elif int_re.fullmatch(tok) is None:
+                    if previous == "(" and sep == "":
+                        ops[tok] = ops.get(tok, 0) + 1
+                    strings[tok] = strings.get(tok, 0) + 1
+                previous = tok
+            if rest not in separators:
+                strings[rest] = strings.get(rest, 0) + 1
+        self.tags = {op: i for (i, op) in enumerate(by_frequency(ops)[:max_tags])}
+        for op in self.tags:
+            # Tagged occurrences are not written as words
+            strings[op] -= ops[op]
+        strings = {s: n for (s, n) in strings.items() if n > 0 or s in self.tags}
+        self.pool = by_frequency(strings)
+        self.indices = {s: i for (i, s) in enumerate(self.pool)}
+
+    def token(self, out, kind, sep):
+        code = separators.get(sep)
+        if code is None:
+            out.append(kind | SEP_OTHER << 6)
+            write_varint(out, self.indices[sep])
+        else:
+            out.append(kind | code << 6)
+
+    def document(self, out, toks, rest):
+        tags = self.tags
+        indices = self.indices
+        i = 0
+        n = len(toks)
+        while i < n:
+            (sep, tok) = toks[i]
+            c = tok[0]
+            if c == "(":
+                if i + 1 < n:
+                    (nextSep, nextTok) = toks[i + 1]
+                    tag = tags.get(nextTok) if nextSep == "" else None
+                    if tag is not None:
+                        self.token(out, OPEN_TAG + tag, sep)
+                        i += 2
+                        continue
+                self.token(out, OPEN, sep)
+            elif c == ")":
+                self.token(out, CLOSE, sep)
+            elif c == '"':
+                self.token(out, STRING, sep)
+                write_varint(out, indices[tok[1:-1]])
+            elif int_re.fullmatch(tok) is not None:
+                self.token(out, INT, sep)
+                write_varint(out, zigzag(int(tok)))
+            else:
+                self.token(out, WORD, sep)
+                write_varint(out, indices[tok])
+            i += 1
+        self.token(out, END, rest)
+
+    def encode(self, meta=None):
+        out = bytearray(magic)
+        out.append(format_version)
+        write_varint(out, len(self.pool))
+        for s in self.pool:
+            b = s.encode("utf8")
+            write_varint(out, len(b))
+            out += b
+        ordered = sorted(self.tags, key=self.tags.get)
+        write_varint(out, len(ordered))
+        for op in ordered:
+            write_varint(out, self.indices[op])
+        write_varint(out, len(self.documents))
+        for (toks, rest) in self.documents:
+            self.document(out, toks, rest)
+        if meta is None:
+            write_varint(out, 0)
+        else:
+            b = json.dumps(meta).encode("utf8")
+            write_varint(out, len(b))
+            out += b
+        return bytes(out)
+
+
+def encode_documents(texts, meta=None):
+    """Encodes sexpr texts sharing one pool and tag table, with optional JSON metadata."""
+    return Encoder(texts).encode(meta)
+
+
+def encode(text):
+    return encode_documents([text])
+
+
+class Decoder:
+    def __init__(self, data):
+        if data[: len(magic)] != magic:
+            raise ValueError("Not a binary sexpr file")
+        if data[len(magic)] != format_version:
+            raise ValueError("Unsupported binary sexpr version %i" % data[len(magic)])
+        self.data = data
+        i = len(magic) + 1
+        (n, i) = read_varint(data, i)
+        pool = []
+        for _ in range(n):
+            (size, i) = read_varint(data, i)
+            pool.append(data[i : i + size].decode("utf8"))
+            i += size
+        (n, i) = read_varint(data, i)
+        tags = []
+        for _ in range(n):
+            (index, i) = read_varint(data, i)
+            tags.append(pool[index])
+        self.pool = pool
+        self.tags = tags
+        (self.count, self.start) = read_varint(data, i)
+
+    def separator(self, code, i):
+        if code == SEP_NONE:
+            return "", i
+        if code == SEP_SPACE:
+            return " ", i
+        if code == SEP_NEWLINE:
+            return "\n", i
+        (index, i) = read_varint(self.data, i)
+        return self.pool[index], i
+
+    def text(self, i):
+        """Text of the document starting at i, and the offset after it."""
+        data = self.data
+        pool = self.pool
+        tags = self.tags
+        out = []
+        while True:
+            b = data[i]
+            i += 1
+            kind = b & 0x3F
+            code = b >> 6
+            if code:
+                (sep, i) = self.separator(code, i)
+                out.append(sep)
+            if kind >= OPEN_TAG:
+                out.append("(")
+                out.append(tags[kind - OPEN_TAG])
+            elif kind == CLOSE:
+                out.append(")")
+            elif kind == OPEN:
+                out.append("(")
+            elif kind == INT:
+                (n, i) = read_varint(data, i)
+                out.append(str(unzigzag(n)))
+            elif kind == WORD:
+                (n, i) = read_varint(data, i)
+                out.append(pool[n])
+            elif kind == STRING:
+                (n, i) = read_varint(data, i)
+                out.append('"%s"' % pool[n])
+            elif kind == END:
+                return "".join(out), i
+            else:
+                raise ValueError("Bad token %i at offset %i" % (b, i - 1))
+
+    def tree(self, i):
+        """Items of the document starting at i as parse_text gives them, and the offset after it."""
+        data = self.data
+        pool = self.pool
+        tags = self.tags
+        stack = []
+        current = []
+        while True:
+            b = data[i]
+            i += 1
+            kind = b & 0x3F
+            if b >> 6 == SEP_OTHER:
+                (_, i) = read_varint(data, i)
+            if kind >= OPEN_TAG:
+                stack.append(current)
+                current = [tags[kind - OPEN_TAG]]
+            elif kind == CLOSE:
+                node = current
+                current = stack.pop()
+                current.append(node)
+            elif kind == OPEN:
+                stack.append(current)
+                current = []
+            elif kind == INT:
+                (n, i) = read_varint(data, i)
+                current.append(unzigzag(n))
+            elif kind == WORD:
+                (n, i) = read_varint(data, i)
+                current.append(pool[n])
+            elif kind == STRING:
+                (n, i) = read_varint(data, i)
+                current.append('"%s"' % pool[n])
+            elif kind == END:
+                return current, i
+            else:
+                raise ValueError("Bad token %i at offset %i" % (b, i - 1))
+
+    def documents(self, f):
+        result = []
+        i = self.start
+        for _ in range(self.count):
+            (x, i) = f(i)
+            result.append(x)
+        return result, i
+
+    def meta(self, i):
+        (n, i) = read_varint(self.data, i)
+        return json.loads(self.data[i : i + n].decode("utf8")) if n else None
+
+
+def decode_documents(data):
+    """Texts and metadata of encode_documents(texts, meta)."""
+    decoder = Decoder(data)
+    (texts, i) = decoder.documents(decoder.text)
+    return texts, decoder.meta(i)
+
+
+def decode(data):
+    (texts, _) = decode_documents(data)
+    if len(texts) != 1:
+        raise ValueError("Expected one document, found %i" % len(texts))
+    return texts[0]
+
+
+def decode_trees(data):
+    """Parsed documents, without going through their text."""
+    decoder = Decoder(data)
+    return decoder.documents(decoder.tree)[0]
+
+
+def parse_text(text):
+    """Items of a text sexpr: lists for parentheses, ints and other atoms as strings."""
+    stack = []
+    current = []
+    (toks, _) = tokens(text)
+    for (_, tok) in toks:
+        c = tok[0]
+        if c == "(":
+            stack.append(current)
+            current = []
+        elif c == ")":
+            node = current
+            current = stack.pop()
+            current.append(node)
+        elif c != '"' and int_re.fullmatch(tok) is not None:
+            current.append(int(tok))
+        else:
+            current.append(tok)
+    return current
+
+
+def encode_scenario(scenarios):
+    """Encodes the output of smartpy_cli --scenario, sexpr fields go to the documents."""
+    texts = []
+
+    def extract(x):
+        if isinstance(x, dict):
+            result = {}
+            for (k, v) in x.items():
+                if k in scenario_sexpr_fields and isinstance(v, str):
+                    result[k] = {"$sexpr": len(texts)}
+                    texts.append(v)
+                else:
+                    result[k] = extract(v)
+            return result
+        if isinstance(x, list):
+            return [extract(v) for v in x]
+        return x
+
+    meta = extract(scenarios)
+    return encode_documents(texts, meta)
+
+
+def decode_scenario(data):
+    (texts, meta) = decode_documents(data)
+
+    def restore(x):
+        if isinstance(x, dict):
+            if len(x) == 1 and "$sexpr" in x:
+                return texts[x["$sexpr"]]
+            return {k: restore(v) for (k, v) in x.items()}
+        if isinstance(x, list):
+            return [restore(v) for v in x]
+        return x
+
+    return restore(meta)
@@ -6,7 +6,11 @@ import traceback
 import inspect
 import sys
 import datetime
+from contextlib import nullcontext
+from contextvars import ContextVar
+from time import perf_counter_ns
 from types import FunctionType
+import weakref
 
 pyRange = range
 pyBool = bool
@@ -16,9 +20,12 @@ pyList = list
 pyTuple = tuple
 pyBytes = bytes
 pyMap = map
+pySum = sum
 
 pyLen = len
 
+script_filename = "SmartPy Script"
+
 
 def get_line_no():
     if window.in_browser:
@@ -27,21 +34,67 @@ def get_line_no():
             if "exec" in line_info:
                 return pyInt(line_info.split(",")[0])
         return -1
-    else:
-        for x in inspect.stack():
-            if x.filename == "SmartPy Script":
-                return x.lineno
-        return -1
+    # Walk the raw frames instead of inspect.stack(), which reads the source
+    # context of every frame on the stack.
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_filename == script_filename:
+            return frame.f_lineno
+        frame = frame.f_back
+    return -1
+
+
+setslot = object.__setattr__
+
+
+def make_expr(cls, f, l):
+    self = object.__new__(cls)
+    setslot(self, "_f", f)
+    setslot(self, "_l", l)
+    setslot(self, "_attributes", None)
+    setslot(self, "_opens", None)
+    setslot(self, "_onUpdateHandlers", None)
+    setslot(self, "_extra", None)
+    return self
 
 
 class Expr:
-    def __init__(self, f, l):
-        self._f = f
-        self._l = l
-        self.onUpdateHandlers = []
-        self.attributes = {}
-        self.opens = {}
-        setattr(self, "__initialized", True)
+    # Most nodes are leaves: the attribute and open_variant caches, the update
+    # handlers and the extra attributes (such as __asBlock) are only
+    # allocated on first use.
+    __slots__ = ("_f", "_l", "_attributes", "_opens", "_onUpdateHandlers", "_extra")
+
+    # Nodes are built in __new__ so that hash consing can return an existing
+    # node without running an initializer on it again.
+    def __new__(cls, f = None, l = None):
+        if hash_consing is not None and l is not None:
+            return hash_consing.intern(cls, f, l)
+        return make_expr(cls, f, l)
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            setslot(self, "_attributes", {})
+        return self._attributes
+
+    @property
+    def opens(self):
+        if self._opens is None:
+            setslot(self, "_opens", {})
+        return self._opens
+
+    @property
+    def onUpdateHandlers(self):
+        if self._onUpdateHandlers is None:
+            setslot(self, "_onUpdateHandlers", [])
+        return self._onUpdateHandlers
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in Expr.__slots__}
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setslot(self, slot, value)
 
     def __eq__(self, other):
         return Expr("eq", [self, spExpr(other), get_line_no()])
@@ -145,7 +198,11 @@ class Expr:
         )
 
     def __hash__(self):
-        return hash(self.export())
+        # Structural, so that hashing a node does not serialize its subtree.
+        try:
+            return hash((self._f, pyTuple(self._l)))
+        except TypeError:
+            return hash(self.export())
 
     def on_update(self, f):
         self.onUpdateHandlers.append(f)
@@ -184,25 +241,37 @@ class Expr:
 
     def __getattr__(self, attr):
         if "__" in attr:
+            extra = self._extra
+            if extra is not None and attr in extra:
+                return extra[attr]
             raise AttributeError("")
-        try:
-            return self.attributes[attr]
-        except KeyError:
-            result = Expr("attr", [self, attr, get_line_no()])
-            self.attributes[attr] = result
-            return result
+        if attr in expr_slots:
+            raise AttributeError("")
+        attributes = self._attributes
+        if attributes is None:
+            attributes = {}
+            setslot(self, "_attributes", attributes)
+        else:
+            try:
+                return attributes[attr]
+            except KeyError:
+                pass
+        result = Expr("attr", [self, attr, get_line_no()])
+        attributes[attr] = result
+        return result
 
     def __setattr__(self, attr, value):
-        if "__" not in attr and hasattr(self, "__initialized"):
-            sp.set(getattr(self, attr), value)
-            if (
-                hasattr(getattr(self, attr), "onUpdateHandlers")
-                and getattr(self, attr).onUpdateHandlers
-            ):
-                for f in getattr(self, attr).onUpdateHandlers:
-                    f(getattr(self, attr), value)
+        if "__" in attr:
+            if self._extra is None:
+                setslot(self, "_extra", {})
+            self._extra[attr] = value
         else:
-            object.__setattr__(self, attr, value)
+            target = getattr(self, attr)
+            sp.set(target, value)
+            handlers = getattr(target, "_onUpdateHandlers", None)
+            if handlers:
+                for f in handlers:
+                    f(target, value)
 
 
     def __delitem__(self, item):
@@ -319,20 +388,521 @@ class Expr:
         return Expr("add_seconds", [self, spExpr(days * 24 * 60 * 60), get_line_no()])
 
     def export(self):
-        def ppe(e):
-            if hasattr(e, "export"):
-                return e.export()
-            if isinstance(e, str):
-                return '"%s"' % e
-            return str(e)
+        return export_string(self)
+
+    def write_export(self, buffer):
         if self._f == "invalid":
             raise Exception(" ".join(str(x) for x in self._l))
-        if self._l:
-            return "(%s %s)" % (self._f, " ".join(ppe(x) for x in self._l))
-        return "(%s)" % (self._f)
+        out = buffer.out
+        if not self._l:
+            out.append("(%s)" % (self._f))
+            return
+        key = id(self)
+        if key in buffer.spans:
+            buffer.replay(key)
+            return
+        start = pyLen(out)
+        out.append("(%s" % (self._f))
+        for x in self._l:
+            out.append(" ")
+            if x.__class__ is Expr:
+                x.write_export(buffer)
+            else:
+                export_value(x, buffer)
+        out.append(")")
+        buffer.spans[key] = (start, pyLen(out), self)
+
+
+expr_slots = pySet(Expr.__slots__)
+
+
+class ExportBuffer:
+    """Single buffer the export of a whole tree is written into.
+
+    Every node is serialized once: a subtree reached again during the same
+    export (a cached attribute, an open_variant or a hash consed node) is
+    replayed from the span it was first written to. Spans hold on to their
+    node so that the ids of nodes built during the export are not reused.
+    """
+
+    def __init__(self):
+        self.out = []
+        self.spans = {}
+        self.strings = {}
+
+    def replay(self, key):
+        s = self.strings.get(key)
+        if s is None:
+            (start, end, _) = self.spans[key]
+            s = self.strings[key] = "".join(self.out[start:end])
+        self.out.append(s)
+
+    def value(self):
+        return "".join(self.out)
+
+
+def export_value(e, buffer):
+    if hasattr(e, "write_export"):
+        e.write_export(buffer)
+    elif hasattr(e, "export"):
+        buffer.out.append(e.export())
+    elif isinstance(e, str):
+        buffer.out.append('"%s"' % e)
+    else:
+        buffer.out.append(str(e))
+
+
+def export_values(l, buffer, sep=" "):
+    out = buffer.out
+    for i, x in enumerate(l):
+        if i:
+            out.append(sep)
+        export_value(x, buffer)
+
+
+def export_string(x):
+    buffer = ExportBuffer()
+    x.write_export(buffer)
+    return buffer.value()
+
+hash_consing = None
+
+hash_consing_scalars = pySet([str, pyInt, pyBool, float, type(None)])
+
+
+class HashConsing:
+    """Table of shared Expr nodes keyed on (op, children, line).
+
+    Scalar children are compared by value and every other child (Expr,
+    types, blocks) by identity, so only structurally identical subtrees
+    are shared and nodes holding a fresh command block never are.
+    """
+
+    def __init__(self):
+        self.table = {}
+        self.requested = 0
+
+    def intern(self, cls, f, l):
+        self.requested += 1
+        key = (
+            f,
+            pyTuple([x.__class__ for x in l]),
+            pyTuple([x if x.__class__ in hash_consing_scalars else id(x) for x in l]),
+        )
+        try:
+            return self.table[key]
+        except KeyError:
+            result = make_expr(cls, f, l)
+            self.table[key] = result
+            return result
+
+    def reset(self):
+        self.table = {}
+        self.requested = 0
+
+    def stats(self):
+        unique = pyLen(self.table)
+        return {
+            "requested": self.requested,
+            "unique": unique,
+            "dedup_ratio": 1 - unique / self.requested if self.requested else 0.0,
+        }
+
+
+def set_hash_consing(b):
+    global hash_consing
+    hash_consing = HashConsing() if b else None
+
+
+plain_make_expr = make_expr
+
+
+def counting_make_expr(cls, f, l):
+    sp.profiler.nodes += 1
+    return plain_make_expr(cls, f, l)
+
+
+class TreeStats:
+    """Size of an Expr tree as exported against what is held in memory.
+
+    nodes counts the Expr in the exported tree, objects the distinct Expr
+    objects behind them and shared_objects those reached from more than one
+    place. distinct_subtrees counts the structurally different subtrees,
+    which is the size of the tree with all repetitions shared.
+    """
+
+    def __init__(self):
+        self.memo = {}
+        self.parents = {}
+        self.structures = {}
+        self.exprStructures = pySet()
+
+    def structure(self, key):
+        sid = self.structures.get(key)
+        if sid is None:
+            sid = self.structures[key] = pyLen(self.structures)
+        return sid
+
+    def visit(self, x):
+        """Returns the structure id, the number of nodes and the depth of x."""
+        known = self.memo.get(id(x))
+        if known is not None:
+            if x.__class__ is Expr:
+                self.parents[id(x)] += 1
+            return known[1]
+        if x.__class__ in hash_consing_scalars:
+            result = (self.structure((x.__class__, x)), 0, 0)
+        else:
+            (label, children) = tree_children(x)
+            if children is None:
+                buffer = ExportBuffer()
+                export_value(x, buffer)
+                result = (self.structure((label, buffer.value())), 0, 0)
+            else:
+                visited = [self.visit(c) for c in children]
+                sid = self.structure((label, pyTuple([v[0] for v in visited])))
+                nodes = pySum(v[1] for v in visited)
+                depth = normalMax([v[2] for v in visited], default=0)
+                if x.__class__ is Expr:
+                    self.parents[id(x)] = 1
+                    self.exprStructures.add(sid)
+                    nodes += 1
+                    depth += 1
+                result = (sid, nodes, depth)
+        self.memo[id(x)] = (x, result)
+        return result
+
+    def stats(self, root):
+        (_, nodes, depth) = self.visit(root)
+        return {
+            "nodes": nodes,
+            "max_depth": depth,
+            "objects": pyLen(self.parents),
+            "shared_objects": pySum(1 for n in self.parents.values() if n > 1),
+            "distinct_subtrees": pyLen(self.exprStructures),
+        }
+
+
+def tree_children(x):
+    """The label and children of a node of an elaborated tree, None for leaves."""
+    if isinstance(x, Expr):
+        return (x._f, x._l)
+    if isinstance(x, (MessageBuilder, CommandBlock)):
+        return ("block", x.commands.commands)
+    if isinstance(x, TreeBlock):
+        return ("block", x.commands)
+    if isinstance(x, record):
+        keys = sorted(x.fields)
+        return (("record",) + pyTuple(keys), [x.fields[k] for k in keys])
+    if isinstance(x, mapOrBigMap):
+        return (x.name(), [y for item in x.l.items() for y in item])
+    if isinstance(x, (tuple, build_list, build_set)):
+        return (x.__class__.__name__, x.l)
+    if isinstance(x, Lambda):
+        return ("lambda", [x.f])
+    if isinstance(x, (pyList, pyTuple)):
+        return ("list", x)
+    return (x.__class__.__name__, None)
+
+
+def tree_stats(x):
+    """TreeStats of x with the size of its export in bytes."""
+    result = TreeStats().stats(x)
+    buffer = ExportBuffer()
+    export_value(x, buffer)
+    result["export_bytes"] = pyLen(buffer.value().encode("utf8"))
+    return result
+
+
+read_hoisting = False
+
+
+def set_read_hoisting(b):
+    global read_hoisting
+    read_hoisting = b
+
+
+pure_read_ops = pySet(["data", "attr", "getItem", "params", "sender", "source", "amount", "now", "level", "isNat", "openVariant"])
+
+write_ops = pySet(["set", "delItem", "updateSet"])
+
+non_storage_roots = pySet(["getLocal", "operations"])
+
+
+def write_root(target):
+    while target.__class__ is Expr and target._f in ("attr", "getItem"):
+        target = target._l[0]
+    return target._f if target.__class__ is Expr else None
+
+
+def writes_storage(x):
+    """Whether x assigns anything but local variables and operations."""
+    if x.__class__ is Expr:
+        if x._f == "lambda":
+            return False
+        if x._f in write_ops and write_root(x._l[0]) not in non_storage_roots:
+            return True
+        return any(writes_storage(y) for y in x._l)
+    if isinstance(x, (TreeBlock, CommandBlock)):
+        return any(writes_storage(y) for y in block_commands(x))
+    return False
+
+
+def block_commands(x):
+    return x.commands.commands if isinstance(x, CommandBlock) else x.commands
+
+
+def conditional_children(e):
+    """Indices of the children of e that are not always evaluated with it."""
+    if e._f in ("and", "or"):
+        return (1,)
+    if e._f == "eif":
+        return (1, 2)
+    if e._f == "verify":
+        return (2,)
+    return ()
+
+
+class ReadHoisting:
+    """Binds storage reads repeated within a block to generated locals.
+
+    A read is a getItem chain over data, params, literals and the
+    transaction constants. Within a block, the commands from one storage
+    write to the next form a segment. A read evaluated unconditionally by
+    a command of a segment, and reached at least twice from that command
+    on, is bound by a defineLocal before that command. Its later
+    occurrences in the segment, conditional ones included, read the
+    local. The value of a local cannot change before its last use since
+    the segment ends with the first command that writes storage.
+    Assignment targets are never rewritten, and a top level set,
+    delItem or updateSet reads its arguments before writing.
+    Nested blocks are then processed the same way.
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.bindings = 0
+        self.replaced = 0
+
+    def key(self, e):
+        """Structural key of e, without line numbers, if it is a pure read."""
+        known = self.keys.get(id(e))
+        if known is not None:
+            return known[1]
+        result = None
+        if e.__class__ is Expr:
+            if e._f == "literal":
+                result = ("literal", e._l[0].export())
+            elif e._f in pure_read_ops:
+                l = e._l
+                if l and l[-1].__class__ is pyInt:
+                    l = l[:-1]
+                children = [self.key(x) if x.__class__ is Expr else x for x in l]
+                if all(x is not None for x in children):
+                    result = (e._f,) + pyTuple(children)
+        self.keys[id(e)] = (e, result)
+        return result
+
+    def occurrences(self, e, conditional, found):
+        """Appends the reads within e as (key, node, conditional)."""
+        if e.__class__ is Expr:
+            if e._f == "lambda":
+                return
+            if e._f == "getItem" and self.key(e) is not None:
+                found.append((self.key(e), e, conditional))
+            lazy = conditional_children(e)
+            for i, x in enumerate(e._l):
+                self.occurrences(x, conditional or i in lazy, found)
+        elif isinstance(e, (TreeBlock, CommandBlock)):
+            for x in block_commands(e):
+                self.occurrences(x, True, found)
+
+    def read_children(self, c):
+        """The children of command c that may be rewritten."""
+        if c._f in write_ops:
+            return pyRange(1, pyLen(c._l))
+        return pyRange(pyLen(c._l))
+
+    def rewrite(self, e, bound):
+        if e.__class__ is Expr:
+            if e._f == "lambda":
+                return e
+            if e._f == "getItem":
+                name = bound.get(self.key(e))
+                if name is not None:
+                    self.replaced += 1
+                    line = e._l[-1] if e._l[-1].__class__ is pyInt else -1
+                    return Expr("getLocal", [name, line])
+            l = [self.rewrite(x, bound) for x in e._l]
+            if any(x is not y for (x, y) in zip(l, e._l)):
+                return Expr(e._f, l)
+            return e
+        if isinstance(e, (TreeBlock, CommandBlock)):
+            commands = block_commands(e)
+            rewritten = [self.rewrite(x, bound) for x in commands]
+            commands[:] = rewritten
+        return e
+
+    def rewrite_command(self, c, bound):
+        indices = self.read_children(c)
+        l = [self.rewrite(x, bound) if i in indices else x for (i, x) in enumerate(c._l)]
+        if any(x is not y for (x, y) in zip(l, c._l)):
+            return Expr(c._f, l)
+        return c
+
+    def segments(self, commands):
+        """Splits commands into segments, each ending with a storage write."""
+        result = []
+        current = []
+        for c in commands:
+            if c.__class__ is Expr and writes_storage(c):
+                if c._f in write_ops:
+                    current.append(c)
+                    result.append((current, True))
+                else:
+                    if current:
+                        result.append((current, True))
+                    result.append(([c], False))
+                current = []
+            else:
+                current.append(c)
+        if current:
+            result.append((current, True))
+        return result
+
+    def segment(self, commands):
+        reads = []
+        for c in commands:
+            found = []
+            if c.__class__ is Expr:
+                for i in self.read_children(c):
+                    self.occurrences(c._l[i], False, found)
+            reads.append(found)
+        first = {}
+        nodes = {}
+        for (i, found) in enumerate(reads):
+            for (key, node, conditional) in found:
+                if not conditional and key not in first:
+                    first[key] = i
+                    nodes[key] = node
+        # Larger reads first: the occurrences of a read within a bound
+        # larger one are replaced with it and only count once.
+        chosen = {}
+        for key in sorted(first, key=lambda k: -pyLen(repr(k))):
+            uses = 0
+            for (i, found) in enumerate(reads):
+                if i < first[key]:
+                    continue
+                covered = [n for (k, n, _) in found if k in chosen and chosen[k] <= i and k != key]
+                for (k, node, _) in found:
+                    if k == key and not any(self.contains(c, node) for c in covered):
+                        uses += 1
+            uses += pySum(1 for k in chosen if k != key and key in self.subkeys(k))
+            if uses >= 2:
+                chosen[key] = first[key]
+        result = []
+        bound = {}
+        for (i, c) in enumerate(commands):
+            for key in sorted([k for k in chosen if chosen[k] == i], key=lambda k: pyLen(repr(k))):
+                name = "__cse%i" % self.bindings
+                self.bindings += 1
+                value = self.rewrite(nodes[key], bound)
+                line = nodes[key]._l[-1] if nodes[key]._l[-1].__class__ is pyInt else -1
+                result.append(Expr("defineLocal", [name, value, line]))
+                bound[key] = name
+            result.append(self.rewrite_command(c, bound) if c.__class__ is Expr else c)
+        return result
+
+    def contains(self, e, node):
+        if e is node:
+            return True
+        return e.__class__ is Expr and any(self.contains(x, node) for x in e._l)
+
+    def subkeys(self, key):
+        result = []
+
+        def walk(k):
+            if k.__class__ is pyTuple:
+                if k and k[0] == "getItem":
+                    result.append(k)
+                for x in k[1:]:
+                    walk(x)
+
+        walk(key)
+        return result[1:]
+
+    def block(self, block):
+        commands = []
+        for (segment, hoist) in self.segments(block_commands(block)):
+            commands.extend(self.segment(segment) if hoist else segment)
+        block_commands(block)[:] = commands
+        for c in commands:
+            self.nested(c)
+
+    def nested(self, e):
+        if e.__class__ is Expr:
+            if e._f == "lambda":
+                return
+            for x in e._l:
+                self.nested(x)
+        elif isinstance(e, (TreeBlock, CommandBlock)):
+            self.block(e)
+
+    def stats(self):
+        return {"bindings": self.bindings, "replaced_reads": self.replaced}
+
+
+constant_pool = None
+
+
+class ConstantPool:
+    """Literal nodes shared per (type, value), and per line when line_info.
+
+    Shared nodes are exported once per export and replayed after that (see
+    ExportBuffer). Without line_info, literals get line -1: each constant
+    is a single node, at the cost of the location of errors on literals.
+    """
+
+    def __init__(self, line_info=True):
+        self.line_info = line_info
+        self.values = {}
+        self.literals = {}
+        self.requested = 0
+
+    def literal(self, t, l):
+        self.requested += 1
+        # 0.0 and -0.0 are equal, as are 1 and 1.0 (told apart by class)
+        key = (t, l.__class__, repr(l) if isinstance(l, float) else l)
+        try:
+            value = self.values.get(key)
+        except TypeError:
+            # Unhashable values are not pooled
+            return Expr("literal", [Expr(t, [l]), get_line_no()])
+        if value is None:
+            value = self.values[key] = Expr(t, [l])
+        line = get_line_no() if self.line_info else -1
+        key = (key, line)
+        result = self.literals.get(key)
+        if result is None:
+            result = self.literals[key] = Expr("literal", [value, line])
+        return result
+
+    def stats(self):
+        return {
+            "requested": self.requested,
+            "values": pyLen(self.values),
+            "literals": pyLen(self.literals),
+        }
+
+
+def set_constant_pool(b, line_info=True):
+    global constant_pool
+    constant_pool = ConstantPool(line_info) if b else None
 
 
 def literal(t, l):
+    if constant_pool is not None:
+        return constant_pool.literal(t, l)
     return Expr("literal", [Expr(t, [l]), get_line_no()])
 
 
@@ -471,100 +1041,100 @@ def tez(x):
 
 
 def spExpr(x, context = "expression"):
-    debug = False  # isinstance(x, dict)
-    if x is None:
-        raise Exception("Unexpected value (None) for %s in line %i." % (context, get_line_no()))
-    if isinstance(x, Local):
-        raise Exception(
-            "Local value of variable %s can be accessed by doing %s.value"
-            % (x.name, x.name)
-        )
-    if isinstance(x, Expr):
-        if debug:
-            alert("Expr")
+    c = x.__class__
+    if c is Expr:
+        return x
+    try:
+        converter = spExpr_converters[c]
+    except KeyError:
+        converter = spExpr_converters[c] = spExpr_converter(c)
+    if converter is None:
         return x
+    return converter(x, context)
+
+
+# Converters used by spExpr, cached per type. None means that values of the
+# type are already expressions and are returned as is.
+spExpr_converters = {}
+
+
+def spExpr_converter(c):
+    """Finds the conversion of values of type c, in spExpr's order of precedence."""
+    if c is type(None):
+        return spExpr_none
+    if issubclass(c, Local):
+        return spExpr_local
+    if issubclass(c, Expr):
+        return None
+    if issubclass(c, pyTuple):
+        return spExpr_tuple
+    if issubclass(c, float):
+        return lambda x, context: literal("float", x)
+    if issubclass(c, pyBool):
+        return lambda x, context: literal("bool", x)
+    if issubclass(c, pyInt):
+        return lambda x, context: literal("int", x) if x < 0 else literal("intOrNat", x)
+    if hasattr(c, "__int__"):
+        return lambda x, context: literal("intOrNat", pyInt(x))
+    if issubclass(c, str):
+        return lambda x, context: literal("string", x)
+    if issubclass(c, pyBytes):
+        return lambda x, context: literal("bytes", x.decode())
+    if issubclass(c, WouldBeValue):
+        return None
+    if issubclass(c, dict):
+        return lambda x, context: map(x)
+    if issubclass(c, pySet):
+        return spExpr_set
+    if issubclass(c, pyList):
+        return lambda x, context: list([spExpr(y) for y in x])
+    if issubclass(c, pyRange):
+        return lambda x, context: list(pyList(x))
+    if issubclass(c, Lambda):
+        return lambda x, context: x.f
+    if issubclass(c, GlobalLambda):
+        return lambda x, context: Expr("global", [x.name, get_line_no()])
+    if issubclass(c, FunctionType):
+        return lambda x, context: build_lambda(x).f
+    if issubclass(c, TestAccount):
+        return lambda x, context: x.e
+    if issubclass(c, TType):
+        return spExpr_type
+    if issubclass(c, Verbatim):
+        return None
+    return spExpr_unknown
+
+
+def spExpr_none(x, context):
+    raise Exception("Unexpected value (None) for %s in line %i." % (context, get_line_no()))
+
+
+def spExpr_local(x, context):
+    raise Exception(
+        "Local value of variable %s can be accessed by doing %s.value"
+        % (x.name, x.name)
+    )
+
+
+def spExpr_tuple(x, context):
     if x == ():
-        if debug:
-            alert("unit")
         return unit
-    if isinstance(x, float):
-        if debug:
-            alert("float")
-        return literal("float", x)
-    if isinstance(x, pyBool):
-        if debug:
-            alert("bool")
-        return literal("bool", x)
-    if isinstance(x, pyInt):
-        if debug:
-            alert("int")
-        if x < 0:
-            return literal("int", x)
-        return literal("intOrNat", x)
-    if hasattr(x, "__int__"):
-        return literal("intOrNat", pyInt(x))
-    if isinstance(x, str):
-        if debug:
-            alert("str")
-        return literal("string", x)
-    if isinstance(x, pyBytes):
-        if debug:
-            alert("bytes")
-        return literal("bytes", x.decode())
-    if isinstance(x, WouldBeValue):
-        if debug:
-            alert("WouldBeValue")
-        return x
-    if isinstance(x, dict):
-        if debug:
-            alert("dict")
-        return map(x)
-    if isinstance(x, pySet):
-        if any(isinstance(y, Expr) for y in x):
-            raise Exception(
-                "{e1, ..., en} syntax is forbidden for SmartPy Expr. Please use sp.set([e1, .., en])"
-            )
-        return set([spExpr(y) for y in x])
-    if isinstance(x, pyTuple):
-        if debug:
-            alert("tuple")
-        return tuple([spExpr(y) for y in x])
-    if isinstance(x, pyList):
-        if debug:
-            alert("list")
-        return list([spExpr(y) for y in x])
-    if isinstance(x, pyRange):
-        if debug:
-            alert(x)
-            alert("range")
-        return list(pyList(x))
-    if isinstance(x, Lambda):
-        if debug:
-            alert(x)
-            alert("Lambda")
-        return x.f
-    if isinstance(x, GlobalLambda):
-        if debug:
-            alert(x)
-            alert("Lambda")
-        return Expr("global", [x.name, get_line_no()])
-    if isinstance(x, FunctionType):
-        if debug:
-            alert(x)
-            alert("FunctionType")
-        return build_lambda(x).f
-    if isinstance(x, TestAccount):
-        if debug:
-            alert(x)
-            alert("TestAccount")
-        return x.e
-    if isinstance(x, TType):
-        if debug:
-            alert(x)
-            alert("TType")
-        raise Exception("spExpr: using type expression %s as an expression" % (str(x)))
-    if isinstance(x, Verbatim):
-        return x
+    return tuple([spExpr(y) for y in x])
+
+
+def spExpr_set(x, context):
+    if any(isinstance(y, Expr) for y in x):
+        raise Exception(
+            "{e1, ..., en} syntax is forbidden for SmartPy Expr. Please use sp.set([e1, .., en])"
+        )
+    return set([spExpr(y) for y in x])
+
+
+def spExpr_type(x, context):
+    raise Exception("spExpr: using type expression %s as an expression" % (str(x)))
+
+
+def spExpr_unknown(x, context):
     raise Exception("spExpr: '%s' of type '%s'" % (str(x), str(type(x))))
 
 
@@ -573,25 +1143,72 @@ class TType:
         return self.export()
 
 
-class TRecord(TType):
-    def __init__(self, **kargs):
-        args = {}
-        for (k, v) in kargs.items():
-            v = sp.types.conv(v)
-            args[k] = v
-            setattr(self, k, v)
-        self.kargs = args
-        self.layout_ = None
+# Types are dropped from the table with their last user
+interned_types = weakref.WeakValueDictionary()
 
-    def layout(self, layout):
-        result = TRecord(**dict(self.kargs))
-        result.layout_ = parse_layout(layout)
+
+class InternedType(TType):
+    """Type shared by every construction from the same parts.
+
+    Parts are converted types, compared by identity: interned parts are
+    unique, so equal types are the same instance. Instances are immutable
+    and export once, unless a part can change (an Expr or a TVariant,
+    whose layout can be set afterwards). The memoized export is kept in
+    _exported and _fixed, apart from the fields of records.
+    """
+
+    def __setattr__(self, attr, value):
+        raise Exception("Types are immutable: cannot set %s.%s" % (self.__class__.__name__, attr))
+
+    def export(self):
+        result = self._exported
+        if result is None:
+            result = self.build_export()
+            if self._fixed:
+                object.__setattr__(self, "_exported", result)
         return result
 
+
+def fixed_type(t):
+    return isinstance(t, (TSimple, TUnknown)) or (isinstance(t, InternedType) and t._fixed)
+
+
+def intern_type(cls, parts, extra, fields):
+    # Types compare by identity and key themselves, Expr (whose == builds an
+    # Expr) by their id
+    key = (cls, pyTuple(t if isinstance(t, TType) else id(t) for t in parts), extra)
+    result = interned_types.get(key)
+    if result is None:
+        result = object.__new__(cls)
+        for (k, v) in fields:
+            object.__setattr__(result, k, v)
+        object.__setattr__(result, "_exported", None)
+        object.__setattr__(result, "_fixed", all(fixed_type(t) for t in parts))
+        # Holding on to the parts keeps the ids of Expr parts from being
+        # reused while the type is in the table
+        interned_types[key] = result
+    return result
+
+
+def record_type(fields, layout):
+    names = sorted(fields)
+    return intern_type(
+        TRecord,
+        [fields[k] for k in names],
+        (pyTuple(names), layout),
+        pyList(fields.items()) + [("kargs", fields), ("layout_", layout)],
+    )
+
+
+class TRecord(InternedType):
+    def __new__(cls, **kargs):
+        return record_type({k: sp.types.conv(v) for (k, v) in kargs.items()}, None)
+
+    def layout(self, layout):
+        return record_type(dict(self.kargs), parse_layout(layout))
+
     def right_comb(self):
-        result = TRecord(**dict(self.kargs))
-        result.layout_ = "Right"
-        return result
+        return record_type(dict(self.kargs), "Right")
 
     def with_fields(self, **kargs):
         result = dict(self.kargs)
@@ -605,7 +1222,7 @@ class TRecord(TType):
             del result[k]
         return TRecord(**result)
 
-    def export(self):
+    def build_export(self):
         fields = " ".join(
             "(%s %s)" % (x, y.export()) for (x, y) in sorted(self.kargs.items())
         )
@@ -719,37 +1336,41 @@ class TUnknown(TType):
         return '(unknown %i)' % self.id
 
 
-class TList(TType):
-    def __init__(self, t):
-        self.t = sp.types.conv(t)
+class TList(InternedType):
+    def __new__(cls, t):
+        t = sp.types.conv(t)
+        return intern_type(cls, [t], None, [("t", t)])
 
-    def export(self):
+    def build_export(self):
         return "(list %s)" % self.t.export()
 
 
-class TMap(TType):
-    def __init__(self, k, v):
-        self.k = sp.types.conv(k)
-        self.v = sp.types.conv(v)
+class TMap(InternedType):
+    def __new__(cls, k, v):
+        k = sp.types.conv(k)
+        v = sp.types.conv(v)
+        return intern_type(cls, [k, v], None, [("k", k), ("v", v)])
 
-    def export(self):
+    def build_export(self):
         return "(map %s %s)" % (self.k.export(), self.v.export())
 
 
-class TSet(TType):
-    def __init__(self, t):
-        self.t = sp.types.conv(t)
+class TSet(InternedType):
+    def __new__(cls, t):
+        t = sp.types.conv(t)
+        return intern_type(cls, [t], None, [("t", t)])
 
-    def export(self):
+    def build_export(self):
         return "(set %s)" % self.t.export()
 
 
-class TBigMap(TType):
-    def __init__(self, k, v):
-        self.k = sp.types.conv(k)
-        self.v = sp.types.conv(v)
+class TBigMap(InternedType):
+    def __new__(cls, k, v):
+        k = sp.types.conv(k)
+        v = sp.types.conv(v)
+        return intern_type(cls, [k, v], None, [("k", k), ("v", v)])
 
-    def export(self):
+    def build_export(self):
         return "(bigmap %s %s)" % (self.k.export(), self.v.export())
 
 
@@ -777,28 +1398,31 @@ class TAnnots(TType):
         )
 
 
-class TOption(TType):
-    def __init__(self, t):
-        self.t = sp.types.conv(t)
+class TOption(InternedType):
+    def __new__(cls, t):
+        t = sp.types.conv(t)
+        return intern_type(cls, [t], None, [("t", t)])
 
-    def export(self):
+    def build_export(self):
         return "(option %s)" % self.t.export()
 
 
-class TContract(TType):
-    def __init__(self, t):
-        self.t = sp.types.conv(t)
+class TContract(InternedType):
+    def __new__(cls, t):
+        t = sp.types.conv(t)
+        return intern_type(cls, [t], None, [("t", t)])
 
-    def export(self):
+    def build_export(self):
         return "(contract %s)" % self.t.export()
 
 
-class TLambda(TType):
-    def __init__(self, t1, t2):
-        self.t1 = sp.types.conv(t1)
-        self.t2 = sp.types.conv(t2)
+class TLambda(InternedType):
+    def __new__(cls, t1, t2):
+        t1 = sp.types.conv(t1)
+        t2 = sp.types.conv(t2)
+        return intern_type(cls, [t1, t2], None, [("t1", t1), ("t2", t2)])
 
-    def export(self):
+    def build_export(self):
         return "(lambda %s %s)" % (self.t1.export(), self.t2.export())
 
 
@@ -869,7 +1493,12 @@ class TreeBlock:
         self.locals.append(var)
 
     def export(self):
-        return "(%s)" % (" ".join(x.export() for x in self.commands))
+        return export_string(self)
+
+    def write_export(self, buffer):
+        buffer.out.append("(")
+        export_values(self.commands, buffer)
+        buffer.out.append(")")
 
 
 class CommandBlock:
@@ -889,23 +1518,177 @@ class CommandBlock:
     def export(self):
         return self.commands.export()
 
+    def write_export(self, buffer):
+        self.commands.write_export(buffer)
+
+
+class ProfileSpan:
+    """A timed region; nodes counts the Expr allocated within it, blocks the
+    change in allocated memory blocks (and bytes while tracemalloc traces)."""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.children = []
+        self.marks = []
+
+    def __enter__(self):
+        profiler = self.profiler
+        stack = profiler.stack
+        (stack[-1].children if stack else profiler.roots).append(self)
+        stack.append(self)
+        self.nodes = profiler.nodes
+        self.bytes = traced_bytes()
+        self.blocks = sys.getallocatedblocks()
+        self.start = perf_counter_ns()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.end = perf_counter_ns()
+        self.blocks = sys.getallocatedblocks() - self.blocks
+        self.bytes = traced_bytes() - self.bytes
+        self.nodes = self.profiler.nodes - self.nodes
+        self.profiler.stack.pop()
+
+    def to_json(self, origin):
+        result = {
+            "name": self.name,
+            "start_ns": self.start - origin,
+            "duration_ns": self.end - self.start,
+            "nodes": self.nodes,
+            "allocated_blocks": self.blocks,
+            "children": [x.to_json(origin) for x in self.children],
+        }
+        if tracemalloc_tracing():
+            result["allocated_bytes"] = self.bytes
+        if self.marks:
+            result["marks"] = [{"at_ns": at - origin, "name": name} for (at, name) in self.marks]
+        return result
+
+
+def tracemalloc_tracing():
+    tracemalloc = sys.modules.get("tracemalloc")
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def traced_bytes():
+    if tracemalloc_tracing():
+        return sys.modules["tracemalloc"].get_traced_memory()[0]
+    return 0
+
+
+class Profiler:
+    """Tree of spans opened by sp.span, with the marks of sp.profile."""
+
+    def __init__(self):
+        self.roots = []
+        self.stack = []
+        self.marks = []
+        self.nodes = 0
+        self.origin = perf_counter_ns()
+
+    def span(self, name):
+        return ProfileSpan(self, name)
+
+    def mark(self, name):
+        (self.stack[-1].marks if self.stack else self.marks).append((perf_counter_ns(), name))
+
+    def spans(self):
+        return [x for x in self.roots if hasattr(x, "end")]
+
+    def json(self):
+        return {
+            "unit": "ns",
+            "spans": [x.to_json(self.origin) for x in self.spans()],
+            "marks": [{"at_ns": at - self.origin, "name": name} for (at, name) in self.marks],
+        }
+
+    def speedscope(self, name="SmartPy"):
+        """The spans in the evented format of https://www.speedscope.app."""
+        frames = []
+        frameIds = {}
+        events = []
+
+        def walk(span):
+            if span.name not in frameIds:
+                frameIds[span.name] = pyLen(frames)
+                frames.append({"name": span.name})
+            frame = frameIds[span.name]
+            events.append({"type": "O", "frame": frame, "at": span.start - self.origin})
+            for child in span.children:
+                walk(child)
+            events.append({"type": "C", "frame": frame, "at": span.end - self.origin})
+
+        spans = self.spans()
+        for span in spans:
+            walk(span)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [
+                {
+                    "type": "evented",
+                    "name": name,
+                    "unit": "nanoseconds",
+                    "startValue": 0,
+                    "endValue": spans[-1].end - self.origin if spans else 0,
+                    "events": events,
+                }
+            ],
+            "exporter": "smartpy",
+        }
+
+    def text(self):
+        lines = []
+
+        def walk(span, depth):
+            lines.append(
+                "%s%s %.3f ms, %i nodes, %i blocks"
+                % ("  " * depth, span.name, (span.end - span.start) / 1e6, span.nodes, span.blocks)
+            )
+            for child in span.children:
+                walk(child, depth + 1)
+
+        for span in self.spans():
+            walk(span, 0)
+        return "\n".join(lines)
+
+
+no_span = nullcontext()
+
+
+# Message builder receiving new commands, one per thread or context
+current_mb = ContextVar("current_mb", default=None)
+
 
 class Sp:
     def __init__(self):
         self.types = SpTypes()
-        self.profiling = False
-        self.profilingLogs = []
-        self.mb = None
+        self.profiler = None
+
+    @property
+    def mb(self):
+        return current_mb.get()
+
+    @mb.setter
+    def mb(self, mb):
+        current_mb.set(mb)
 
     def profile(self, s=""):
-        if self.profiling:
-            import datetime
+        if self.profiler is not None:
+            self.profiler.mark(s)
 
-            self.profilingLogs.append(str(datetime.datetime.now()) + " " + s)
+    def span(self, name):
+        if self.profiler is None:
+            return no_span
+        return self.profiler.span(name)
 
     def setMB(self, mb):
         self.mb = mb
 
+    def building(self, mb):
+        return BuilderContext(self, mb)
+
     def delItem(self, expr, item):
         self.newCommand(Expr("delItem", [expr, spExpr(item), get_line_no()]))
 
@@ -913,8 +1696,9 @@ class Sp:
         return Expr("cons", [spExpr(x), spExpr(xs), get_line_no()])
 
     def newCommand(self, command):
-        if hasattr(self, "mb") and self.mb is not None:
-            self.mb.append(command)
+        mb = current_mb.get()
+        if mb is not None:
+            mb.append(command)
         else:
             raise Exception("New command outside of contract (line %i):\n%s" % (get_line_no(), str(command)))
 
@@ -936,6 +1720,27 @@ class Sp:
         return Expr("data", [])
 
 
+class BuilderContext:
+    """Makes a message builder the target of new commands within a with block.
+
+    The previous builder is restored on exit, also on errors, so that
+    elaborations can nest (lambdas, contracts created by entry points). The
+    builder is context-local: elaborations running in other threads or
+    contexts (contextvars.copy_context) do not see it.
+    """
+
+    def __init__(self, sp, mb):
+        self.sp = sp
+        self.mb = mb
+
+    def __enter__(self):
+        self.token = current_mb.set(self.mb)
+        return self.mb
+
+    def __exit__(self, type, value, traceback):
+        current_mb.reset(self.token)
+
+
 sp = Sp()
 
 
@@ -956,6 +1761,9 @@ class MessageBuilder:
     def export(self):
         return self.commands.export()
 
+    def write_export(self, buffer):
+        self.commands.write_export(buffer)
+
     def __repr__(self):
         return "Commands:%s" % (" ".join(str(command) for command in self.commands))
 
@@ -1021,6 +1829,9 @@ class TestAccount:
     def export(self):
         return self.e.export()
 
+    def write_export(self, buffer):
+        self.e.write_export(buffer)
+
 
 def test_account(seed):
     return TestAccount(seed)
@@ -1053,6 +1864,29 @@ def parse_account_or_address(account, name):
     )
 
 
+def check_amount(amount):
+    if isinstance(amount, pyInt):
+        raise Exception(
+            "Amount should be in tez or mutez and not int (use sp.tez(..) or sp.mutez(..))"
+        )
+
+
+def message_time(now):
+    if isinstance(now, Expr) and now._f == "literal":
+        now = now._l[0]
+    if isinstance(now, Expr) and now._f == "timestamp":
+        now = now._l[0]
+    if not isinstance(now, pyInt):
+        raise Exception("bad now " + str(now))
+    return now
+
+
+def message_level(level):
+    if not isinstance(level, pyInt):
+        raise Exception("bad level " + str(level))
+    return level
+
+
 class ExecMessage:
     def __init__(self, _contract, _message, params, kargs):
         self.message = _message
@@ -1082,49 +1916,35 @@ class ExecMessage:
         show=True,
         chain_id=None,
     ):
-        sp.profile(self.message + " begin " + str(get_line_no()))
-        if isinstance(now, Expr) and now._f == "literal":
-            now = now._l[0]
-        if isinstance(amount, pyInt):
-            raise Exception(
-                "Amount should be in tez or mutez and not int (use sp.tez(..) or sp.mutez(..))"
-            )
-        if isinstance(now, Expr) and now._f == "timestamp":
-            now = now._l[0]
-        if now is not None:
-            if not isinstance(now, pyInt):
-                raise Exception("bad now " + str(now))
-            self.smartml.setNow(now)
-        if level is not None:
-            if not isinstance(level, pyInt):
-                raise Exception("bad level " + str(level))
-            self.smartml.setLevel(level)
-        if self.params is None:
-            self.params = record(**self.kargs)
-        if chain_id is None:
-            chain_id = ""
-        else:
-            chain_id = chain_id.export()
-        self.contract.data = Expr(
-            "contractData", [self.smartml.contractId, get_line_no()]
-        )
-        result = PreparedMessage()
-        result.lineNo = self.lineNo
-        result.title = self.contract.title if self.contract.title else ""
-        result.messageClass = self.contract.execMessageClass
-        result.source = parse_account_or_address(source, "Source")
-        result.sender = parse_account_or_address(sender, "Sender")
-        result.chain_id = chain_id
-        result.time = self.smartml.time
-        result.amount = amount.export()
-        result.level = self.smartml.level
-        result.contractId = self.smartml.contractId
-        result.message = self.message
-        result.params = self.params.export()
-        result.valid = valid
-        result.show = show
-        sp.profile(self.message + " end")
-        return result
+        with sp.span("run " + self.message):
+            check_amount(amount)
+            if now is not None:
+                self.smartml.setNow(message_time(now))
+            if level is not None:
+                self.smartml.setLevel(message_level(level))
+            if self.params is None:
+                self.params = record(**self.kargs)
+            if chain_id is None:
+                chain_id = ""
+            else:
+                chain_id = chain_id.export()
+            self.contract.data = contract_data(self.contract)
+            result = PreparedMessage()
+            result.lineNo = self.lineNo
+            result.title = self.contract.title if self.contract.title else ""
+            result.messageClass = self.contract.execMessageClass
+            result.source = parse_account_or_address(source, "Source")
+            result.sender = parse_account_or_address(sender, "Sender")
+            result.chain_id = chain_id
+            result.time = self.smartml.time
+            result.amount = amount.export()
+            result.level = self.smartml.level
+            result.contractId = self.smartml.contractId
+            result.message = self.message
+            result.params = self.params.export()
+            result.valid = valid
+            result.show = show
+            return result
 
 
 class WouldBeValue:
@@ -1146,12 +1966,16 @@ class record(WouldBeValue):
         self.lineNo = get_line_no()
 
     def export(self):
-        return "(record %i %s)" % (
-            self.lineNo,
-            " ".join(
-                "(%s %s)" % (k, v.export()) for (k, v) in sorted(self.fields.items())
-            ),
-        )
+        return export_string(self)
+
+    def write_export(self, buffer):
+        out = buffer.out
+        out.append("(record %i " % self.lineNo)
+        for i, (k, v) in enumerate(sorted(self.fields.items())):
+            out.append(" (%s " % k if i else "(%s " % k)
+            export_value(v, buffer)
+            out.append(")")
+        out.append(")")
 
 
 class tuple(WouldBeValue):
@@ -1162,10 +1986,12 @@ class tuple(WouldBeValue):
         self.lineNo = get_line_no()
 
     def export(self):
-        return "(tuple %s %s)" % (
-            " ".join(spExpr(x).export() for x in self.l),
-            self.lineNo,
-        )
+        return export_string(self)
+
+    def write_export(self, buffer):
+        buffer.out.append("(tuple ")
+        export_values([spExpr(x) for x in self.l], buffer)
+        buffer.out.append(" %s)" % self.lineNo)
 
 
 def pair(e1, e2):
@@ -1186,10 +2012,12 @@ class build_list(WouldBeValue):
         return Expr("map_function", [self, spExpr(f), get_line_no()])
 
     def export(self):
-        return "(list %s %s)" % (
-            self.lineNo,
-            " ".join(spExpr(x).export() for x in self.l),
-        )
+        return export_string(self)
+
+    def write_export(self, buffer):
+        buffer.out.append("(list %s " % self.lineNo)
+        export_values([spExpr(x) for x in self.l], buffer)
+        buffer.out.append(")")
 
     def concat(self):
         return Expr("concat", [self, get_line_no()])
@@ -1223,10 +2051,12 @@ class build_set(WouldBeValue):
         )
 
     def export(self):
-        return "(set %s %s)" % (
-            self.lineNo,
-            " ".join(spExpr(x).export() for x in self.l),
-        )
+        return export_string(self)
+
+    def write_export(self, buffer):
+        buffer.out.append("(set %s " % self.lineNo)
+        export_values([spExpr(x) for x in self.l], buffer)
+        buffer.out.append(")")
 
 
 class mapOrBigMap(WouldBeValue):
@@ -1243,14 +2073,18 @@ class mapOrBigMap(WouldBeValue):
         return Expr("getItem", [self, spExpr(item), get_line_no()])
 
     def export(self):
-        return "(%s %s %s)" % (
-            self.name(),
-            self.lineNo,
-            " ".join(
-                "(%s %s)" % (spExpr(k).export(), spExpr(v).export())
-                for (k, v) in self.l.items()
-            ),
-        )
+        return export_string(self)
+
+    def write_export(self, buffer):
+        out = buffer.out
+        out.append("(%s %s " % (self.name(), self.lineNo))
+        for i, (k, v) in enumerate(self.l.items()):
+            out.append(" (" if i else "(")
+            export_value(spExpr(k), buffer)
+            out.append(" ")
+            export_value(spExpr(v), buffer)
+            out.append(")")
+        out.append(")")
 
 
 class build_map(mapOrBigMap):
@@ -1326,6 +2160,90 @@ class Smartml:
         return "Setting level to [%s].<br>" % level
 
 
+finalize_exports = False
+
+
+def set_finalize(b):
+    """Contracts release their elaborated trees once exported, see Contract._finalize."""
+    global finalize_exports
+    finalize_exports = b
+
+
+message_cache = None
+
+
+def set_message_cache(cache):
+    """Entry points are added through cache.add(contract, addedMessage) when
+    set, which can replay their export instead of elaborating them (see
+    message_cache.py)."""
+    global message_cache
+    message_cache = cache
+
+
+def context_free_export(x):
+    """Export of x, or None when it depends on where it is exported from:
+    some nodes, like the getLocal of a Local, are built while exporting and
+    take the line number of the caller."""
+    global get_line_no
+    line_no = get_line_no
+    calls = []
+
+    def counting_line_no():
+        calls.append(None)
+        return line_no()
+
+    get_line_no = counting_line_no
+    try:
+        result = x.export()
+    finally:
+        get_line_no = line_no
+    return None if calls else result
+
+
+def cached_nodes(x):
+    """Attribute and open_variant nodes cached on x and below, with their lines.
+
+    These nodes are shared by the entry points of a contract: the first one
+    reading self.data.x gives its line to the others.
+    """
+    result = []
+    if x._attributes is not None:
+        for (name, y) in sorted(x._attributes.items()):
+            result.append(["attr", name, y._l[2], cached_nodes(y)])
+    if x._opens is not None:
+        for (name, y) in sorted(x._opens.items()):
+            result.append(["openVariant", name, y._l[3], cached_nodes(y)])
+    return result
+
+
+def restore_cached_nodes(x, state):
+    """Caches nodes on x as listed by cached_nodes, where missing."""
+    for (kind, name, line, below) in state:
+        if kind == "attr":
+            y = x.attributes.get(name)
+            if y is None:
+                y = x.attributes[name] = Expr("attr", [x, name, line])
+        else:
+            y = x.opens.get(name)
+            if y is None:
+                y = x.opens[name] = Expr("openVariant", [x, name, "None", line])
+        restore_cached_nodes(y, below)
+
+
+class CachedMessage:
+    """Entry point of a contract known by its export only."""
+
+    def __init__(self, text, originate):
+        self.text = text
+        self.originate = originate
+
+    def export(self):
+        return self.text
+
+    def write_export(self, buffer):
+        buffer.out.append(self.text)
+
+
 class Contract:
     def __init__(self, **kargs):
         self.init_type(t = sp.types.unknown())
@@ -1382,6 +2300,8 @@ class Contract:
             self.title = ""
         if not hasattr(self, "messages_collected"):
             self.messages_collected = False
+        if not hasattr(self, "read_hoisting_stats"):
+            self.read_hoisting_stats = {}
         if not hasattr(self, "storage"):
             self.storage = None
         if not hasattr(self, "__initial_balance"):
@@ -1394,6 +2314,8 @@ class Contract:
             self.entry_points_layout = None
         if not hasattr(self, "exception_optimization_level"):
             self.exception_optimization_level = None
+        if not hasattr(self, "_exported"):
+            self._exported = None
 
     def init_type(self, t):
         self.init_internal()
@@ -1416,42 +2338,49 @@ class Contract:
             self.storage = record(**kargs)
         self.collectMessages()
 
-    def addMessage(self, addedMessage):
-        sp.profile("addMessage begin " + addedMessage.name)
+    def addCachedMessage(self, addedMessage, text):
         addedMessage.contract = self
-        mb = MessageBuilder(addedMessage)
-        self.mb = mb
-        sp.setMB(mb)
-        args = inspect.getargs(addedMessage.f.__code__).args
-        nargs = pyLen(args)
-        params = Expr("params", [addedMessage.lineNo])
-        if nargs == 0:
-            raise Exception("Entry point '%s' is missing a self parameter (line %i)." % (addedMessage.name, addedMessage.lineNo))
-        elif nargs == 1:
-            x = addedMessage.f(self)
-        elif nargs == 2:
-            x = addedMessage.f(self, params)
-        else:
-            args[0] = self
-            for i in pyRange(1, nargs):
-                args[i] = Expr("attr", [params, args[i], get_line_no()])
-            x = addedMessage.f(*args)
-        if x is not None:
-            raise Exception(
-                "Entry point failure for %s (line %i): entry points cannot have return statements."
-                % (addedMessage.name, addedMessage.lineNo)
-            )
-        self.mb = None
-        sp.setMB(None)
-        self.messages[addedMessage.name] = mb
-        mb.originate = addedMessage.originate
+        self.messages[addedMessage.name] = CachedMessage(text, addedMessage.originate)
         setattr(self, addedMessage.name, addedMessage)
-        # if not isinstance(self.data, Expr) or self.data._f != "data":
-        #     raise Exception(
-        #         "It's forbidden to change self.data directly.\n self.data = "
-        #         + str(self.data)
-        #     )
-        sp.profile("addMessage end " + addedMessage.name)
+
+    def addMessage(self, addedMessage):
+        with sp.span("addMessage " + addedMessage.name):
+            addedMessage.contract = self
+            mb = MessageBuilder(addedMessage)
+            self.mb = mb
+            with sp.building(mb):
+                args = inspect.getargs(addedMessage.f.__code__).args
+                nargs = pyLen(args)
+                params = Expr("params", [addedMessage.lineNo])
+                if nargs == 0:
+                    raise Exception("Entry point '%s' is missing a self parameter (line %i)." % (addedMessage.name, addedMessage.lineNo))
+                elif nargs == 1:
+                    x = addedMessage.f(self)
+                elif nargs == 2:
+                    x = addedMessage.f(self, params)
+                else:
+                    args[0] = self
+                    for i in pyRange(1, nargs):
+                        args[i] = Expr("attr", [params, args[i], get_line_no()])
+                    x = addedMessage.f(*args)
+                if x is not None:
+                    raise Exception(
+                        "Entry point failure for %s (line %i): entry points cannot have return statements."
+                        % (addedMessage.name, addedMessage.lineNo)
+                    )
+            self.mb = None
+            if read_hoisting:
+                hoisting = ReadHoisting()
+                hoisting.block(mb.commands)
+                self.read_hoisting_stats[addedMessage.name] = hoisting.stats()
+            self.messages[addedMessage.name] = mb
+            mb.originate = addedMessage.originate
+            setattr(self, addedMessage.name, addedMessage)
+            # if not isinstance(self.data, Expr) or self.data._f != "data":
+            #     raise Exception(
+            #         "It's forbidden to change self.data directly.\n self.data = "
+            #         + str(self.data)
+            #     )
 
     def buildExtraMessages(self):
         pass
@@ -1459,59 +2388,134 @@ class Contract:
     def collectMessages(self):
         if self.messages_collected:
             return
-        sp.profile("CollectMessages begin " + self.__class__.__name__)
-        self.data = sp.getData()
-        for f in dir(self):
-            attr = getattr(self, f)
-            if isinstance(attr, GlobalLambda):
-                attr._l = self.global_lambda(attr.name, attr.f)
-            if isinstance(attr, SubEntryPoint):
-                attr._l = self.global_lambda(attr.name, lambda x: attr.fg(self,x))
-                attr.contract = self
-        for f in dir(self):
-            attr = getattr(self, f)
-            if isinstance(attr, AddedMessage):
-                self.addMessage(
-                    AddedMessage(attr.name, attr.f, attr.originate, attr.lineNo)
-                )
-        self.buildExtraMessages()
-        # self.smartml = window.buildSmartlmJS(self)
-        self.smartml = Smartml(self)
-        sp.profile("CollectMessages smartml " + self.__class__.__name__)
-        self.data = Expr("contractData", [self.smartml.contractId, get_line_no()])
-        self.balance = Expr("contractBalance", [self.smartml.contractId, get_line_no()])
-        sp.profile("CollectMessages end " + self.__class__.__name__)
+        with sp.span("collectMessages " + self.__class__.__name__):
+            if hash_consing is not None:
+                hash_consing.reset()
+            self.data = sp.getData()
+            names = dir(self)
+            for f in names:
+                attr = getattr(self, f)
+                if isinstance(attr, GlobalLambda):
+                    attr._l = self.global_lambda(attr.name, attr.f)
+                if isinstance(attr, SubEntryPoint):
+                    attr._l = self.global_lambda(attr.name, lambda x: attr.fg(self,x))
+                    attr.contract = self
+            # Entry points are elaborated in the sorted order of dir, which keeps
+            # seq names, unknown type ids and lambda ids deterministic.
+            cache = message_cache
+            if cache is not None:
+                cache.begin(self)
+            try:
+                for f in names:
+                    attr = getattr(self, f)
+                    if isinstance(attr, AddedMessage):
+                        addedMessage = AddedMessage(attr.name, attr.f, attr.originate, attr.lineNo)
+                        if cache is None:
+                            self.addMessage(addedMessage)
+                        else:
+                            cache.add(self, addedMessage)
+            finally:
+                if cache is not None:
+                    cache.end(self)
+            self.buildExtraMessages()
+            if hash_consing is not None:
+                self.hash_consing_stats = hash_consing.stats()
+                hash_consing.reset()
+            # self.smartml = window.buildSmartlmJS(self)
+            self.smartml = Smartml(self)
+            sp.profile("CollectMessages smartml " + self.__class__.__name__)
+            self.contract_data_nodes = {}
+            self.data = contract_data(self)
+            self.balance = Expr("contractBalance", [self.smartml.contractId, get_line_no()])
         self.address = contract_address(self)
         self.baker = contract_baker(self)
 
+    def tree_stats(self):
+        """Size statistics of the tree of each entry point, see TreeStats."""
+        return {name: tree_stats(mb) for (name, mb) in sorted(self.messages.items())}
+
     def export(self):
-        if self.exception_optimization_level is not None:
-            self.add_flag("Exception_%s" % self.exception_optimization_level)
-        result = "(storage %s\nstorage_type (%s)\nmessages (%s)\nflags (%s)\nglobals (%s)\nstorage_layout %s\nentry_points_layout %s\nbalance %s)" % (
-            (self.storage.export() if self.storage is not None else "()"),
-            ("%s" % (self.storage_type.export()) if self.storage_type is not None else "()"),
-            (
-                " ".join(
-                    "(%s %s %s)" % (k, str(v.originate), v.export())
-                    for (k, v) in sorted(self.messages.items())
-                )
-            ),
-            (" ".join(str(flag) for flag in sorted(self.flags))),
-            (
-                " ".join(
-                    "(%s %s)" % (name, variable.export())
-                    for (name, variable) in self.global_variables
-                )
-            ),
-            (self.storage_layout if self.storage_layout is not None else "()"),
-            (self.entry_points_layout if self.entry_points_layout is not None else "()"),
-            (self.__initial_balance.export() if self.__initial_balance is not None else "()"),
-        )
+        with sp.span("export " + self.__class__.__name__):
+            buffer = ExportBuffer()
+            self.write_export(buffer)
+            result = buffer.value()
         if self.verbose:
             alert("Creating\n\n%s" % result)
             window.console.log(result)
+        if finalize_exports and self._exported is None:
+            self._finalize(result)
         return result
 
+    def export_to(self, file):
+        """Writes the export to an open file without joining it in memory."""
+        if self.verbose or finalize_exports:
+            file.write(self.export())
+            return
+        with sp.span("export " + self.__class__.__name__):
+            buffer = ExportBuffer()
+            self.write_export(buffer)
+        file.writelines(buffer.out)
+
+    def _finalize(self, export=None):
+        """Keeps the export of the contract and releases what it was built from.
+
+        Entry points, storage and global variables are dropped with the nodes
+        cached on them. The contract can still be exported, added to
+        scenarios and called, but no longer inspected (tree_stats).
+        """
+        if export is None:
+            export = self.export()
+        self._exported = export
+        self.messages = {}
+        self.storage = None
+        self.storage_type = None
+        self.global_variables = []
+        self.mb = None
+        self.contract_data_nodes = {}
+        # Sub entry points are shared by the instances of a class
+        for f in dir(self.__class__):
+            attr = getattr(self.__class__, f)
+            if isinstance(attr, SubEntryPoint) and getattr(attr, "contract", None) is self:
+                attr.contract = None
+                attr._l = None
+
+    def write_export(self, buffer):
+        if self._exported is not None:
+            buffer.out.append(self._exported)
+            return
+        if self.exception_optimization_level is not None:
+            self.add_flag("Exception_%s" % self.exception_optimization_level)
+        out = buffer.out
+        out.append("(storage ")
+        if self.storage is not None:
+            export_value(self.storage, buffer)
+        else:
+            out.append("()")
+        out.append("\nstorage_type (")
+        if self.storage_type is not None:
+            export_value(self.storage_type, buffer)
+        else:
+            out.append("()")
+        out.append(")\nmessages (")
+        for i, (k, v) in enumerate(sorted(self.messages.items())):
+            out.append(" (%s %s " % (k, str(v.originate)) if i else "(%s %s " % (k, str(v.originate)))
+            v.write_export(buffer)
+            out.append(")")
+        out.append(")\nflags (%s)\nglobals (" % (" ".join(str(flag) for flag in sorted(self.flags))))
+        for i, (name, variable) in enumerate(self.global_variables):
+            out.append(" (%s " % name if i else "(%s " % name)
+            export_value(variable, buffer)
+            out.append(")")
+        out.append(")\nstorage_layout %s\nentry_points_layout %s\nbalance " % (
+            (self.storage_layout if self.storage_layout is not None else "()"),
+            (self.entry_points_layout if self.entry_points_layout is not None else "()"),
+        ))
+        if self.__initial_balance is not None:
+            export_value(self.__initial_balance, buffer)
+        else:
+            out.append("()")
+        out.append(")")
+
     def setNow(self, time):
         return self.smartml.setNow(time)
 
@@ -1536,6 +2540,54 @@ def contract_address(c):
 def contract_baker(c):
     return Expr("contract_baker", [c.smartml.contractId, get_line_no()])
 
+def clear_side_tables(e):
+    """Makes a node look new: a reused node must not answer from caches filled before."""
+    setslot(e, "_attributes", None)
+    setslot(e, "_opens", None)
+    setslot(e, "_onUpdateHandlers", None)
+    setslot(e, "_extra", None)
+
+
+class FieldNodes(dict):
+    """Attribute cache of a contractData node for one scenario step.
+
+    As with a new node, the first read of a field in a step gives the node
+    of that field and of the line reading it, later reads that node. Such
+    nodes are kept in pool by (field, line) and reused from step to step.
+    """
+
+    __slots__ = ("node", "pool")
+
+    def __missing__(self, attr):
+        line_no = get_line_no()
+        key = (attr, line_no)
+        result = self.pool.get(key)
+        if result is None:
+            result = self.pool[key] = Expr("attr", [self.node, attr, line_no])
+        else:
+            clear_side_tables(result)
+        self[attr] = result
+        return result
+
+
+def contract_data(c):
+    # One storage node per contract and line, shared by the scenario steps
+    # run from that line, with its field nodes per field and line.
+    line_no = get_line_no()
+    try:
+        (result, pool) = c.contract_data_nodes[line_no]
+    except KeyError:
+        result = Expr("contractData", [c.smartml.contractId, line_no])
+        pool = {}
+        c.contract_data_nodes[line_no] = (result, pool)
+    else:
+        clear_side_tables(result)
+    fields = FieldNodes()
+    fields.node = result
+    fields.pool = pool
+    setslot(result, "_attributes", fields)
+    return result
+
 class AddedMessage:
     def __init__(self, name, f, originate, lineNo):
         self.name = name
@@ -1803,25 +2855,22 @@ class Lambda:
 
     def collectLambda(self, f):
         prev = sp.mb
-        newMB = sp.mb is None
-        if newMB:
-            sp.setMB(MessageBuilder(None))
-        currentBlock = sp.mb.currentBlock
-        commands = TreeBlock()
-        sp.mb.currentBlock = commands
-        r = f(
-            Expr("lambdaParams", [self.id, self.params, get_line_no(), self.tParams])
-        )
-        if self.auto_result:
-            if r is not None:
-                result(r)
-        elif r is not None:
-            raise Exception("Please use 'sp.result' instead of 'return' in SmartPy functions.")
-        r = Expr("lambda", [self.id, self.params, get_line_no(), commands])
-        sp.mb.currentBlock = currentBlock
+        mb = MessageBuilder(None) if prev is None else prev
+        with sp.building(mb):
+            currentBlock = mb.currentBlock
+            commands = TreeBlock()
+            mb.currentBlock = commands
+            r = f(
+                Expr("lambdaParams", [self.id, self.params, get_line_no(), self.tParams])
+            )
+            if self.auto_result:
+                if r is not None:
+                    result(r)
+            elif r is not None:
+                raise Exception("Please use 'sp.result' instead of 'return' in SmartPy functions.")
+            r = Expr("lambda", [self.id, self.params, get_line_no(), commands])
+            mb.currentBlock = currentBlock
         self.mb = prev
-        if newMB:
-            sp.setMB(None)
         return r
 
     def __call__(self, arg):
@@ -1833,6 +2882,9 @@ class Lambda:
     def export(self):
         return self.f.export()
 
+    def write_export(self, buffer):
+        self.f.write_export(buffer)
+
 
 def build_lambda(f, params="", tParams = None, global_name=None):
     tParams = sp.types.conv(tParams)
@@ -1959,8 +3011,9 @@ def profile(s):
 
 
 def setProfiling(b):
-    sp.profiling = b
-    sp.profilingLogs = []
+    global make_expr
+    sp.profiler = Profiler() if b else None
+    make_expr = counting_make_expr if b else plain_make_expr
 
 
 def fst(e):
@@ -1993,16 +3046,25 @@ def poly_equal_expr(a, b):
 class Scenario:
     def __init__(self):
         self.messages = []
+        self.stream = window.scenarioStream
         self.smartml = Smartml(None)
         self.exceptions = []
         self.nextId = 0
 
+    def emit(self, message):
+        """Keeps message, or writes it out when a stream is set (smartpyio.ScenarioWriter)."""
+        if self.stream is None:
+            self.messages.append(message)
+        else:
+            self.stream.write(message)
+
     def acc(self, message, show):
         if isinstance(message, str):
             if show:
-                self.messages.append(message)
+                self.emit(message)
         else:
-            self.messages += [self.setShow(x, show) for x in message]
+            for x in message:
+                self.emit(self.setShow(x, show))
 
     def setShow(self, x, show):
         x["show"] = show
@@ -2018,6 +3080,125 @@ class Scenario:
         self.register(element, True)
         return self
 
+    def add_many(
+        self,
+        entry_point,
+        params=None,
+        sender=None,
+        source=None,
+        amount=mutez(0),
+        now=None,
+        level=None,
+        valid=True,
+        chain_id=None,
+        show=True,
+    ):
+        """Adds one call of entry_point per row, with the messages of
+
+            for i in range(n):
+                scenario += entry_point(params[i]).run(sender=sender[i], ...)
+
+        Each argument is a column: a list gives one value per call, any
+        other value is shared by all calls. params can also be a dict of
+        such columns, the fields of the parameter record; a constant list
+        value has to be given as sp.list(...) there.
+
+        The line number, contract data and parameter template are computed
+        once and each distinct constant is exported once.
+        """
+        line = get_line_no()
+        columns = [
+            x
+            for x in [params, sender, source, amount, now, level, valid, chain_id]
+            if isinstance(x, pyList)
+        ]
+        if isinstance(params, dict):
+            columns += [x for x in params.values() if isinstance(x, pyList)]
+        if not columns:
+            raise Exception("add_many expects at least one list of values (line %i)" % line)
+        n = pyLen(columns[0])
+        for x in columns:
+            if pyLen(x) != n:
+                raise Exception(
+                    "add_many columns have different lengths: %i and %i (line %i)"
+                    % (n, pyLen(x), line)
+                )
+        exports = {}
+
+        def export(x):
+            if x.__class__ in hash_consing_scalars:
+                key = (x.__class__, x)
+            else:
+                key = id(x)
+            result = exports.get(key)
+            if result is None:
+                # x is kept alive so that its id is not reused
+                result = exports[key] = (spExpr(x).export(), x)
+            return result[0]
+
+        def column(x, f):
+            if isinstance(x, pyList):
+                return [f(v) for v in x]
+            return [f(x)] * n
+
+        def account(name):
+            return lambda x: parse_account_or_address(x, name)
+
+        def amount_export(x):
+            check_amount(x)
+            return export(x)
+
+        if isinstance(params, dict):
+            prefix = "(record %i " % line
+            fields = []
+            for i, k in enumerate(sorted(params)):
+                fields.append((" (%s " % k if i else "(%s " % k, column(params[k], export)))
+            paramColumn = [
+                prefix + "".join([s + values[row] + ")" for (s, values) in fields]) + ")"
+                for row in pyRange(n)
+            ]
+        elif params is None:
+            paramColumn = [record().export()] * n
+        else:
+            paramColumn = column(params, export)
+        senders = column(sender, account("Sender"))
+        sources = column(source, account("Source"))
+        amounts = column(amount, amount_export)
+        chain_ids = column(chain_id, lambda x: "" if x is None else x.export())
+        times = None if now is None else column(now, message_time)
+        levels = None if level is None else column(level, message_level)
+        valids = column(valid, lambda x: x)
+        contract = entry_point.contract
+        smartml = contract.smartml
+        message = entry_point.name
+        title = contract.title if contract.title else ""
+        messageClass = contract.execMessageClass
+        with sp.span("add_many " + message):
+            contract.data = contract_data(contract)
+            for row in pyRange(n):
+                if times is not None:
+                    smartml.setNow(times[row])
+                if levels is not None:
+                    smartml.setLevel(levels[row])
+                data = {}
+                data["action"] = "message"
+                data["id"] = smartml.contractId
+                data["message"] = message
+                data["params"] = paramColumn[row]
+                data["line_no"] = line
+                data["title"] = title
+                data["messageClass"] = messageClass
+                data["source"] = sources[row]
+                data["sender"] = senders[row]
+                data["chain_id"] = chain_ids[row]
+                data["time"] = smartml.time
+                data["amount"] = amounts[row]
+                data["level"] = smartml.level
+                data["show"] = show
+                data["valid"] = valids[row]
+                self.emit(data)
+        return self
+
     def add(self, *elements):
         for element in elements:
             self.register(element, True)
@@ -2047,7 +3228,7 @@ class Scenario:
             data["action"] = "verify"
             data["condition"] = condition.export()
             data["line_no"] = get_line_no()
-            self.messages += [data]
+            self.emit(data)
         return self
 
     def verify_equal(self, v1, v2):
@@ -2055,7 +3236,7 @@ class Scenario:
         data["action"] = "verify"
         data["condition"] = poly_equal_expr(v1, v2).export()
         data["line_no"] = get_line_no()
-        self.messages += [data]
+        self.emit(data)
         return self
 
     def compute(self, expression):
@@ -2065,7 +3246,7 @@ class Scenario:
         data["expression"] = spExpr(expression).export()
         data["id"] = id
         data["line_no"] = get_line_no()
-        self.messages += [data]
+        self.emit(data)
         self.nextId += 1
         return Expr("scenario_var", [id, get_line_no()])
 
@@ -2076,7 +3257,7 @@ class Scenario:
         data["stripStrings"] = stripStrings
         data["expression"] = spExpr(expression).export()
         data["line_no"] = get_line_no()
-        self.messages += [data]
+        self.emit(data)
         return self
 
     def table_of_contents(self):
@@ -2103,7 +3284,7 @@ class Scenario:
         data["tag"] = tag
         data["inner"] = s
         data["line_no"] = get_line_no()
-        self.messages += [data]
+        self.emit(data)
         return self
 
     def simulation(self, c):
@@ -2112,7 +3293,7 @@ class Scenario:
             data["action"] = "simulation"
             data["id"] = c.smartml.contractId
             data["line_no"] = get_line_no()
-            self.messages += [data]
+            self.emit(data)
         else:
             self.p("No interactive simulation available outofbrowser.")
 
@@ -2212,7 +3393,7 @@ def compile_contract(
     import os
     os.makedirs(target_directory, exist_ok=True)
     targetSmlse = target_directory + "/" + name + ".smlse"
-    open(targetSmlse, "w").write(contract.export())
+    contract.export_to(open(targetSmlse, "w"))
     command = [
         "node",
         os.path.dirname(os.path.realpath(__file__)) + "/smartml-cli.js",
@@ -2258,6 +3439,9 @@ class Lazy_strings(build_big_map):
         m = Verbatim(super().export())
         return set_type_expr(m, TBigMap(TNat, TString)).export()
 
+    def write_export(self, buffer):
+        buffer.out.append(self.export())
+
 class seq__(object):
     def __init__(self, name, b):
         self.name = name
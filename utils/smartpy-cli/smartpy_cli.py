@@ -2,6 +2,11 @@
 
 import browser
 import smartpyio
+import code_cache
+import compile_cache
+import compile_daemon
+import message_cache
+import sexpr_binary
 import argparse
 import os
 import json
@@ -10,19 +15,78 @@ import traceback
 from version import version
 from urllib.request import urlopen
 
-if __name__ == "__main__":
+
+def read_manifest(filename):
+    """Reads a JSON list of {"class_call": ..., "sexprfile": ...} objects."""
+    with open(filename, "r") as f:
+        manifest = json.load(f)
+    return [(entry["class_call"], entry["sexprfile"]) for entry in manifest]
+
+
+def write_sexpr(sexpr, sexprfile, sexpr_format):
+    if sexpr_format == "binary":
+        open(sexprfile, "wb").write(sexpr_binary.encode(sexpr))
+    else:
+        open(sexprfile, "w").write(sexpr)
+
+
+def store_export(sexpr, sexprfile, cache, adaptedCode, class_call, options, sexpr_format="text"):
+    write_sexpr(sexpr, sexprfile, sexpr_format)
+    if cache is not None:
+        try:
+            cache.put(adaptedCode, class_call, sexpr, options)
+        except OSError as e:
+            print("Could not write to the compile cache: %s" % e)
+
+
+def write_export(contract, sexprfile, cache, adaptedCode, class_call, options, sexpr_format="text"):
+    if cache is None and sexpr_format == "text":
+        contract.export_to(open(sexprfile, "w"))
+    else:
+        store_export(contract.export(), sexprfile, cache, adaptedCode, class_call, options, sexpr_format)
+
+
+def serve_request(argv, cwd):
+    """Runs one daemon request like a fresh smartpy_cli process would."""
+    smartpyio.reset_state()
+    os.chdir(cwd)
+    main(argv, dict(cli_globals))
+
+
+def main(argv=None, context=None):
     parser = argparse.ArgumentParser(description="SmartPy")
     parser.add_argument("filename", metavar="f", type=str, help="", nargs="?")
     parser.add_argument("--version", action="store_true")
     parser.add_argument("--class_call", nargs="?")
     parser.add_argument("--scenario", nargs="?")
     parser.add_argument("--sexprfile", nargs="?")
+    parser.add_argument("--scenario_format", choices=["json", "ndjson", "binary"], default="json", help="ndjson streams one message per line while tests run, binary is sexpr_binary.encode_scenario")
+    parser.add_argument("--sexpr_format", choices=["text", "binary"], default="text", help="format of the exported contracts, binary is sexpr_binary.encode")
     parser.add_argument("--pyadaptedfile", nargs="?")
-    args = parser.parse_args()
+    parser.add_argument("--export", nargs=2, action="append", default=[], metavar=("CLASS_CALL", "SEXPRFILE"), help="export another contract, can be repeated")
+    parser.add_argument("--manifest", nargs="?", help="JSON list of {\"class_call\", \"sexprfile\"} objects to export")
+    parser.add_argument("--jobs", type=int, default=1, help="number of processes exporting contracts (0: one per CPU)")
+    parser.add_argument("--hoist_reads", action="store_true", help="bind storage reads repeated in entry points to locals")
+    parser.add_argument("--constant_pool", action="store_true", help="share literal nodes per type, value and line")
+    parser.add_argument("--no_literal_lines", action="store_true", help="share literal nodes per type and value, exported with line -1 (implies --constant_pool)")
+    parser.add_argument("--finalize", action="store_true", help="release the elaborated trees of contracts once exported, keeping their export")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="do not read or write the compile cache")
+    parser.add_argument("--cache_dir", nargs="?", help="compile cache directory (default: $SMARTPY_CACHE_DIR or ~/.cache/smartpy)")
+    parser.add_argument("--message_cache", action="store_true", help="replay the exports of entry points unchanged since a previous run from the compile cache (experimental)")
+    parser.add_argument("--profile", nargs="?", metavar="FILE", help="write a profile of the elaboration, exports and scenarios")
+    parser.add_argument("--profile_format", choices=["json", "speedscope"], default="json")
+    parser.add_argument("--tree_stats", nargs="?", metavar="FILE", help="write the Expr tree statistics of the entry points of each contract as JSON")
+    parser.add_argument("--serve", nargs="?", metavar="SOCKET", help="serve invocations from compile_daemon.py on a Unix socket")
+    args = parser.parse_args(argv)
+    if args.finalize and args.tree_stats is not None:
+        parser.error("--tree_stats needs the trees released by --finalize")
 
     if args.version:
         print("SmartPy %s" % version)
         quit()
+    if args.serve is not None:
+        compile_daemon.serve(args.serve, serve_request)
+        return
     if args.filename is None:
         print("filename required")
         quit(1)
@@ -30,12 +94,71 @@ if __name__ == "__main__":
         code = urlopen(args.filename).read().decode("utf8")
     else:
         code = open(args.filename, "r").read()
-    adaptedCode = smartpyio.adaptBlocks(code)
-    context = globals()
+    # Exports only depend on the adapted code and the class call. Profiled
+    # and measured runs elaborate everything, in this process.
+    inspected = args.profile is not None or args.tree_stats is not None
+    cache = None if args.no_cache or inspected else compile_cache.CompileCache(args.cache_dir)
+    (adapted, codes) = (None, None)
+    if cache is not None:
+        adapted = compile_cache.CompileCache(os.path.join(cache.directory, "adapted"))
+        adapted.suffix = ".py"
+        codes = code_cache.CodeCache(os.path.join(cache.directory, "code"))
+    smartpyio.set_adapted_store(adapted)
+    smartpyio.set_code_store(codes)
+    # Scripts compiled before are neither adapted nor compiled again
+    script = None if codes is None else codes.load(code)
+    if script is None:
+        (adaptedCode, compiledCode) = (smartpyio.adaptBlocks(code), None)
+    else:
+        (adaptedCode, compiledCode) = script
+    if args.pyadaptedfile is not None:
+        open(args.pyadaptedfile, "w").write(adaptedCode)
+
+    if args.sexprfile is not None and args.class_call is None:
+        raise Exception("Cannot export sexprfile without a --class_call.")
+    exports = []
+    if args.sexprfile is not None:
+        exports.append((args.class_call, args.sexprfile))
+    exports += [tuple(export) for export in args.export]
+    if args.manifest is not None:
+        exports += read_manifest(args.manifest)
+
+    # Options changing exports, part of the cache keys
+    options = ",".join(name for name in ["hoist_reads", "no_literal_lines"] if getattr(args, name))
+    constant_pool = args.constant_pool or args.no_literal_lines
+    pending = []
+    # Tests start from the counters left by the contracts elaborated for
+    # exports, so none is skipped when a scenario follows.
+    for class_call, sexprfile in exports:
+        sexpr = None if cache is None or args.scenario else cache.get(adaptedCode, class_call, options)
+        if sexpr is None:
+            pending.append((class_call, sexprfile))
+        else:
+            write_sexpr(sexpr, sexprfile, args.sexpr_format)
+    if len(pending) > 1 and args.jobs != 1 and not args.scenario and not inspected:
+        try:
+            sexprs = smartpyio.export_contracts(adaptedCode, [class_call for class_call, _ in pending], args.jobs or None, args.hoist_reads, constant_pool, not args.no_literal_lines)
+        except Exception as e:
+            print ("Exception while exporting " + args.filename)
+            print ('-'*60)
+            traceback.print_exc(file=sys.stdout)
+            print ('-'*60)
+            sys.exit(1)
+        for (class_call, sexprfile), sexpr in zip(pending, sexprs):
+            store_export(sexpr, sexprfile, cache, adaptedCode, class_call, options, args.sexpr_format)
+        pending = []
+    if exports and not pending and not args.scenario and (args.class_call is None or args.sexprfile is not None):
+        sys.exit(0)
+
+    if context is None:
+        context = globals()
     context["alert"] = browser.alert
     context["window"] = browser.window
     try:
-        compiledCode = compile(adaptedCode, "SmartPy Script", "exec")
+        if compiledCode is None:
+            compiledCode = compile(adaptedCode, "SmartPy Script", "exec")
+            if codes is not None:
+                codes.store(code, adaptedCode, compiledCode)
     except Exception as e:
         print ("Exception while parsing " + args.filename)
         print ('-'*60)
@@ -52,43 +175,96 @@ if __name__ == "__main__":
         print ('-'*60)
         sys.exit(1)
 
+    import smartpy
+
+    smartpy.set_read_hoisting(args.hoist_reads)
+    smartpy.set_constant_pool(constant_pool, not args.no_literal_lines)
+    smartpy.set_finalize(args.finalize)
+    # Entry points unchanged since a previous run are not elaborated again
+    if cache is not None and args.message_cache:
+        smartpy.set_message_cache(message_cache.MessageCache(cache.directory, options))
+    if args.profile is not None:
+        smartpy.setProfiling(True)
+
+    # Every contract is elaborated from the counters left by the script, as
+    # if it were the only one.
+    counters = smartpyio.counters()
+    class_call = args.class_call
+    contracts = {}
     try:
-        if args.class_call is not None:
+        if args.class_call is not None and args.sexprfile is None:
             contract = eval(args.class_call, context)
+            contracts[class_call] = contract
+        for class_call, sexprfile in pending:
+            smartpyio.set_counters(counters)
+            contract = eval(class_call, context)
+            write_export(contract, sexprfile, cache, adaptedCode, class_call, options, args.sexpr_format)
+            contracts[class_call] = contract
     except Exception as e:
-        print ("Exception while executing " + args.class_call)
+        print ("Exception while executing " + class_call)
         print ('-'*60)
         traceback.print_exc(file=sys.stdout)
         print ('-'*60)
         sys.exit(1)
-
-    if args.sexprfile is not None:
-        if args.class_call is None:
-            raise Exception("Cannot export sexprfile without a --class_call.")
-        open(args.sexprfile, "w").write(contract.export())
+    if args.tree_stats is not None:
+        treeStats = {class_call: contract.tree_stats() for (class_call, contract) in contracts.items()}
+        open(args.tree_stats, "w").write(json.dumps(treeStats, indent=2, sort_keys=True))
     if args.scenario:
         scenarios = []
-        for test in browser.window.pythonTests:
-            try:
-                test.eval()
-            except Exception as exn:
-                data = {}
-                data["action"] = "error"
-                data["message"] = str(exn)
-                if browser.scenario is not None:
-                    browser.scenario += [data]
+        stream = None
+        if args.scenario_format == "ndjson":
+            output = open(args.scenario, "w")
+            stream = browser.window.scenarioStream = smartpyio.ScenarioWriter(output)
+        try:
+            for test in browser.window.pythonTests:
+                if stream is not None:
+                    stream.begin(test)
+                try:
+                    test.eval()
+                except Exception as exn:
+                    data = {}
+                    data["action"] = "error"
+                    data["message"] = str(exn)
+                    if stream is not None:
+                        stream.write(data)
+                    elif browser.scenario is not None:
+                        browser.scenario += [data]
+                    else:
+                        browser.scenario = [data]
+                    print ("Exception while testing " + args.filename)
+                    print ('-'*60)
+                    traceback.print_exc(file=sys.stdout)
+                    print ('-'*60)
+                if stream is not None:
+                    output.flush()
+                    continue
+                if isinstance(browser.scenario, list):
+                    scenario = browser.scenario
                 else:
-                    browser.scenario = [data]
-                print ("Exception while testing " + args.filename)
-                print ('-'*60)
-                traceback.print_exc(file=sys.stdout)
-                print ('-'*60)
-            if isinstance(browser.scenario, list):
-                scenario = browser.scenario
-            else:
-                scenario = browser.scenario.messages  # trace
-            scenarios.append({'shortname': test.shortname, 'longname': test.name, 'scenario' : scenario})
-        open(args.scenario, "w").write(json.dumps(scenarios))
+                    scenario = browser.scenario.messages  # trace
+                scenarios.append({'shortname': test.shortname, 'longname': test.name, 'scenario' : scenario})
+        finally:
+            if stream is not None:
+                browser.window.scenarioStream = None
+                output.close()
+        if args.scenario_format == "binary":
+            open(args.scenario, "wb").write(sexpr_binary.encode_scenario(scenarios))
+        elif stream is None:
+            open(args.scenario, "w").write(json.dumps(scenarios))
             # print ("Exporting %s" % args.scenario)
-    if args.pyadaptedfile is not None:
-        open(args.pyadaptedfile, "w").write(adaptedCode)
+    if args.profile is not None:
+        profiler = smartpy.sp.profiler
+        smartpy.setProfiling(False)
+        if args.profile_format == "speedscope":
+            profile = profiler.speedscope(os.path.basename(args.filename))
+        else:
+            profile = profiler.json()
+        open(args.profile, "w").write(json.dumps(profile))
+
+
+# Scripts are executed in the module globals, daemon requests in copies of
+# them as they were before any script ran.
+cli_globals = dict(globals())
+
+if __name__ == "__main__":
+    main()
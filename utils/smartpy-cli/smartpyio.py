@@ -1,6 +1,13 @@
 ## Copyright 2019-2020 Smart Chain Arena LLC. ##
 
 from browser import alert, window
+import bisect
+import hashlib
+import json
+import re
+import tokenize
+
+import compile_cache
 
 window.activeScenario = None
 window.contracts = {}
@@ -17,8 +24,23 @@ class Test:
     def eval(self):
         import smartpy
 
-        smartpy.setProfiling(self.profile)
-        smartpy.profile("start")
+        # A profiler already running (smartpy_cli --profile) collects the
+        # test, otherwise one is started for tests with profile = True.
+        profiler = smartpy.sp.profiler
+        owned = profiler is None and self.profile
+        if owned:
+            smartpy.setProfiling(True)
+            profiler = smartpy.sp.profiler
+        try:
+            with smartpy.sp.span("test " + self.shortname):
+                self.run()
+        finally:
+            if owned:
+                smartpy.setProfiling(False)
+        if self.profile:
+            window.addOutput("<hr/><h4>Profiling</h4><pre>%s</pre>" % profiler.text())
+
+    def run(self):
         window.activeScenario = None
         window.contractNextId = 0
         window.lambdaNextId = 0
@@ -43,11 +65,6 @@ class Test:
                     )
                 )
                 raise Exception(badValidityText)
-        smartpy.profile("end")
-        if self.profile:
-            window.addOutput(
-                "<hr/><h4>Profiling</h4>" + "<br>".join(smartpy.sp.profilingLogs)
-            )
 
 
 window.pythonTests = []
@@ -81,7 +98,41 @@ import traceback
 context = globals().copy()
 context["alert"] = alert
 context["window"] = window
-reverseLines = {}
+class LineMap:
+    """Lines of the adapted code to lines of the script, as strings.
+
+    adaptBlocks keeps every line in place, the map is the identity on the
+    lines of the last adapted script (and the line it adds at the end).
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def set(self, count):
+        self.count = count
+
+    def clear(self):
+        self.count = 0
+
+    def __contains__(self, lineId):
+        try:
+            return 1 <= int(lineId) <= self.count
+        except (TypeError, ValueError):
+            return False
+
+    def __getitem__(self, lineId):
+        if lineId not in self:
+            raise KeyError(lineId)
+        return str(lineId)
+
+    def get(self, lineId, default=None):
+        return str(lineId) if lineId in self else default
+
+    def __len__(self):
+        return self.count
+
+
+reverseLines = LineMap()
 
 
 def formatErrorLine(line):
@@ -191,65 +242,233 @@ def syntaxChanges():
     return changes
 
 
-def adaptBlocks(code):
-    lines = code.split("\n") + [""]
-
-    def indent(line):
-        result = 0
-        for i in line:
-            if i == " ":
-                result += 1
-            else:
-                break
-        return result
-
-    blocks = []
-    lineId = 0
-    newLines = []
+# The sp.if, sp.for, sp.while and sp.else blocks of scripts and the context
+# managers they stand for.
+block_keywords = {"if": "if_", "for": "for_", "while": "while_", "else": "else_"}
+# Lines starting with a block header, after their newline (searched for
+# faster than ^). These keywords make sp.if and the others invalid anywhere
+# else. Headers on one line, without strings, comments or other colons, are
+# read from the groups of the first alternative (the colon group is set),
+# the others from their tokens.
+header_line = re.compile(
+    r"\n([ \t]*)sp\.(?:"
+    r"(?:(if|while) ([^'\"#\\:\n]*)|for ([A-Za-z_]\w*) in ([^'\"#\\:\n]*)|else[ \t]*)(:[ \r]*)$"
+    r"|(?:if|for|while|else)\b)",
+    re.M,
+)
+# Strings and comments: those spanning lines can hold lines looking like
+# headers, which are not rewritten.
+string_scanner = re.compile(
+    r"#[^\n]*"
+    r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+    r'|"""(?:[^"\\]|\\.|"(?!""))*"""'
+    r"|'(?:[^'\\\n]|\\.)*'"
+    r'|"(?:[^"\\\n]|\\.)*"',
+    re.S,
+)
+max_adapted_sources = 64
+
+# Adapted scripts by digest of their code, see adaptBlocks
+adapted_sources = {}
+adapted_store = None
+code_store = None
+
+
+def set_adapted_store(store):
+    """Also keeps adapted scripts in a compile_cache.CompileCache, or not (None)."""
+    global adapted_store
+    adapted_store = store
+
+
+def set_code_store(store):
+    """Keeps compiled scripts in a code_cache.CodeCache, or not (None)."""
+    global code_store
+    code_store = store
+
+
+def compile_script(code, filename="SmartPy Script"):
+    """Adapted code of a script and its code object, from code_store when set."""
+    if code_store is not None:
+        return code_store.compile(code, filename)
+    adaptedCode = adaptBlocks(code)
+    return adaptedCode, compile(adaptedCode, filename, "exec")
+
+
+def multiline_strings(code):
+    """Sorted (start, end) of the strings of code spanning several lines."""
+    if "'''" not in code and '"""' not in code and "\\\n" not in code:
+        return []
+    return [m.span() for m in string_scanner.finditer(code) if code.find("\n", m.start(), m.end()) >= 0]
+
+
+def simple_header_edit(m):
+    """The header_edits edit of a header matching the first alternative of header_line, if its brackets are balanced."""
+    (indent, keyword, condition, variable, iterable, colon) = m.groups()
+    body = condition if variable is None else iterable
+    if body is not None:
+        if not body.strip(" \t"):
+            return None
+        if ("(" in body or "[" in body or "{" in body or ")" in body or "]" in body or "}" in body) and any(
+            body.count(a) != body.count(b) for (a, b) in ["()", "[]", "{}"]
+        ):
+            return None
+    if keyword is not None:
+        text = "with sp.%s(%s)" % (block_keywords[keyword], condition)
+    elif variable is not None:
+        text = "with sp.for_('%s', %s) as %s" % (variable, iterable, variable)
+    else:
+        text = "with sp.else_()"
+    return indent + text + (":\r" if colon.endswith("\r") else ":")
+
+
+def header_tokens(lines, row):
+    """Tokens of the block header starting at line row, up to its colon.
+
+    Headers may span several lines. Rows are counted from that of the
+    header. None when this is not a header.
+    """
+    tokens = []
+    depth = 0
+    readline = (lines[i] + "\n" for i in range(row - 1, len(lines))).__next__
+    try:
+        for token in tokenize.generate_tokens(readline):
+            kind = token.type
+            text = token.string
+            if kind == tokenize.INDENT:
+                continue
+            if len(tokens) < 3:
+                # "sp", "." and the keyword
+                tokens.append(token)
+                continue
+            if kind == tokenize.OP:
+                if text in "([{":
+                    depth += 1
+                elif text in ")]}":
+                    depth -= 1
+                elif text == ":" and depth == 0:
+                    return tokens, token
+            if kind in (tokenize.NEWLINE, tokenize.ENDMARKER):
+                return None
+            tokens.append(token)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return None
+
+
+def header_edits(header, colon):
+    (sp, _, keyword) = header[:3]
+    rest = header[3:]
+    (row, col) = sp.start
+    name = keyword.string
+    if name == "else":
+        if rest or colon.start[0] != row:
+            return []
+        prefix = "with sp.else_()"
+        (after, suffix) = (colon, "")
+    elif name == "for":
+        if len(rest) < 3 or rest[0].type != tokenize.NAME or rest[1].string != "in":
+            return []
+        variable = rest[0].string
+        prefix = "with sp.for_('%s', " % variable
+        (after, suffix) = (rest[1], ") as %s" % variable)
+    else:
+        if not rest:
+            return []
+        prefix = "with sp.%s(" % block_keywords[name]
+        (after, suffix) = (keyword, ")")
+    if after is colon:
+        end = colon.start[1]
+    else:
+        # One space is part of the keyword
+        end = after.end[1]
+        if after.end[0] != row:
+            return []
+        if after.line[end : end + 1] == " ":
+            end += 1
+    (colonRow, colonCol) = colon.start
+    line = colon.line.rstrip("\n")
+    tail = line[colonCol + 1 :]
+    if not tail.strip(" \r"):
+        tail = "\r" if line.endswith("\r") else ""
+    return [(row, col, end, prefix), (colonRow, colonCol, len(line), suffix + ":" + tail)]
+
+
+def rewrite_blocks(code):
+    """code with its blocks as with statements, one line more (an empty last line).
+
+    Lines keep their place: a header on several lines is rewritten on its
+    first and last lines. Lines in strings are left as they are.
+    """
+    spans = multiline_strings(code)
+    starts = [start for (start, _) in spans]
+    chunks = []
+    position = 0
+    # Rows are only counted for the headers read from their tokens
+    lines = None
+    row = 1
+    counted = 0
+    # Positions in "\n" + code are those of code plus one: each match starts
+    # at the start of its line in code.
+    for m in header_line.finditer("\n" + code):
+        start = m.start()
+        if start < position:
+            continue
+        if spans:
+            i = bisect.bisect_right(starts, start) - 1
+            if i >= 0 and start < spans[i][1]:
+                continue
+        if m.group(6) is not None:
+            text = simple_header_edit(m)
+            if text is not None:
+                chunks.append(code[position:start])
+                chunks.append(text)
+                position = m.end() - 1
+                continue
+        if lines is None:
+            lines = code.split("\n")
+        row += code.count("\n", counted, start)
+        counted = start
+        header = header_tokens(lines, row)
+        if header is None:
+            continue
+        edits = header_edits(*header)
+        if not edits:
+            continue
+        last = max(r for (r, _, _, _) in edits)
+        edited = lines[row - 1 : row - 1 + last]
+        for (r, s, e, text) in sorted(edits, reverse=True):
+            edited[r - 1] = edited[r - 1][:s] + text + edited[r - 1][e:]
+        chunks.append(code[position:start])
+        chunks.append("\n".join(edited))
+        position = start + sum(len(line) + 1 for line in lines[row - 1 : row - 1 + last]) - 1
+    chunks.append(code[position:])
+    chunks.append("\n")
+    return "".join(chunks)
 
-    class NewLine:
-        def __init__(self, pos, line):
-            if pos is None:
-                pos = -1
-            self.pos = pos
-            self.line = line
 
-    for line in lines:
-        initialLine = line
-        lineId += 1
-        newIndent = indent(line)
-        stripped = line.strip()
-        nline = line.strip(" \r")
-        if line[newIndent:].startswith("sp.for "):
-            p = nline[:-1].split(" ")
-            if nline[-1] == ":" and p[0] == "sp.for" and p[2] == "in":
-                line = "%swith sp.for_('%s', %s) as %s:" % (
-                    newIndent * " ",
-                    p[1],
-                    " ".join(p[3:]),
-                    p[1],
-                )
-        elif line[newIndent:].startswith("sp.if "):
-            p = nline[:-1].split(" ")
-            if nline[-1] == ":" and p[0] == "sp.if":
-                line = "%swith sp.if_(%s):" % (newIndent * " ", " ".join(p[1:]))
-        elif line[newIndent:].startswith("sp.while "):
-            p = nline[:-1].split(" ")
-            if nline[-1] == ":" and p[0] == "sp.while":
-                line = "%swith sp.while_(%s):" % (newIndent * " ", " ".join(p[1:]))
-        elif line[newIndent:].startswith("sp.else ") or line[newIndent:].startswith(
-            "sp.else:"
-        ):
-            if nline[-1] == ":":
-                line = "%swith sp.else_():" % (newIndent * " ")
-        if initialLine.endswith("\r") and not line.endswith("\r"):
-            line += "\r"
-        newLines.append(NewLine(lineId, line))
-    result = "\n".join(line.line for line in newLines)
-    global reverseLines
-    reverseLines.clear()
-    for i in range(len(newLines)):
-        reverseLines[str(i + 1)] = str(newLines[i].pos)
+def adaptBlocks(code):
+    """Rewrites the blocks of a script, see rewrite_blocks.
+
+    Results are kept by digest of code (in adapted_store too when set). The
+    lines of the result are those of code, reverseLines maps them to
+    themselves.
+    """
+    key = hashlib.sha256(("%s\0%s" % (compile_cache.source_digest("smartpyio.py"), code)).encode("utf8")).hexdigest()
+    result = adapted_sources.get(key)
+    if result is None and adapted_store is not None:
+        result = adapted_store.read(key)
+    if result is None:
+        result = rewrite_blocks(code)
+        if adapted_store is not None:
+            try:
+                adapted_store.write(key, result)
+            except OSError as e:
+                print("Could not write to the compile cache: %s" % e)
+    if key not in adapted_sources:
+        if len(adapted_sources) >= max_adapted_sources:
+            del adapted_sources[next(iter(adapted_sources))]
+        adapted_sources[key] = result
+    reverseLines.set(result.count("\n") + 1)
     return result
 
 
@@ -302,9 +521,9 @@ def run(withTests):
                     "Warning: syntax change: %s -> %s. You can use the editor to adapt it."
                     % (change[0], change[1])
                 )
-    code = adaptBlocks(code)
+    (code, compiledCode) = compile_script(code, "<string>")
     env = context.copy()
-    exec(code, env)
+    exec(compiledCode, env)
     window.cleanAll()
     for test in window.pythonTests:
         window.addButton(test.name, test.f)
@@ -324,6 +543,137 @@ def run(withTests):
             alert(html)
 
 
+class ScenarioWriter:
+    """Writes scenario messages as newline-delimited JSON as they come.
+
+    A line {"action": "test", "shortname": ..., "longname": ...} starts the
+    messages of a test, every other line is one message.
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def begin(self, test):
+        self.write({"action": "test", "shortname": test.shortname, "longname": test.name})
+
+    def write(self, message):
+        self.file.write(json.dumps(message) + "\n")
+
+
+def read_scenario_stream(file):
+    """Yields (shortname, longname, message) from a ScenarioWriter stream, a line at a time."""
+    shortname = longname = None
+    for line in file:
+        if not line.strip():
+            continue
+        message = json.loads(line)
+        if isinstance(message, dict) and message.get("action") == "test":
+            shortname = message["shortname"]
+            longname = message["longname"]
+        else:
+            yield (shortname, longname, message)
+
+
+def load_scenario_stream(file):
+    """Reads a whole stream back into the list format of smartpy_cli --scenario."""
+    scenarios = []
+    for line in file:
+        if not line.strip():
+            continue
+        message = json.loads(line)
+        if isinstance(message, dict) and message.get("action") == "test":
+            scenarios.append({"shortname": message["shortname"], "longname": message["longname"], "scenario": []})
+        else:
+            scenarios[-1]["scenario"].append(message)
+    return scenarios
+
+
+def counters():
+    """Global counters that end up in exports (type variables, seq names, ids)."""
+    import smartpy
+
+    return (
+        smartpy.sp.types.unknownIds,
+        smartpy.sp.types.seqCounter,
+        window.lambdaNextId,
+        window.contractNextId,
+    )
+
+
+def set_counters(state):
+    import smartpy
+
+    (
+        smartpy.sp.types.unknownIds,
+        smartpy.sp.types.seqCounter,
+        window.lambdaNextId,
+        window.contractNextId,
+    ) = state
+
+
+def reset_state():
+    """Clears what a previous script left in smartpy, smartpyio and browser.
+
+    smartpy itself is dropped from sys.modules rather than reset: the next
+    script imports it again, so that its module level expressions take their
+    line numbers from that script, as in a fresh process.
+    """
+    import browser
+    import sys
+
+    window.pythonTests.clear()
+    window.activeTrace = None
+    window.scenarioStream = None
+    window.activeScenario = None
+    window.contracts = {}
+    window.validityErrors = []
+    window.lambdaNextId = 0
+    window.contractNextId = 0
+    browser.scenario = []
+    reverseLines.clear()
+    sys.modules.pop("smartpy", None)
+
+
+def export_contract(adaptedCode, class_call, hoist_reads=False, constant_pool=False, literal_lines=True):
+    """Executes an adapted script and returns the export of one contract.
+
+    Counters are reset first, so that the result does not depend on what
+    the process elaborated before.
+    """
+    import smartpy
+
+    window.pythonTests.clear()
+    set_counters((0, 0, 0, 0))
+    env = context.copy()
+    exec(compile(adaptedCode, "SmartPy Script", "exec"), env)
+    smartpy.set_read_hoisting(hoist_reads)
+    smartpy.set_constant_pool(constant_pool, literal_lines)
+    try:
+        return eval(class_call, env).export()
+    finally:
+        smartpy.set_read_hoisting(False)
+        smartpy.set_constant_pool(False)
+
+
+def export_contract_job(job):
+    return export_contract(*job)
+
+
+def export_contracts(adaptedCode, class_calls, processes=None, hoist_reads=False, constant_pool=False, literal_lines=True):
+    """Exports several contracts of a script, in order of class_calls.
+
+    Each contract is elaborated in its own process of a pool unless
+    processes is 1 or there is a single contract.
+    """
+    jobs = [(adaptedCode, class_call, hoist_reads, constant_pool, literal_lines) for class_call in class_calls]
+    if processes == 1 or len(jobs) < 2:
+        return [export_contract_job(job) for job in jobs]
+    import multiprocessing
+
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(export_contract_job, jobs)
+
+
 def onContract(address, cont):
     window.onContract(address, cont)
 
@@ -343,18 +693,21 @@ def toException(x):
     return Exception(x)
 
 
-def ppMichelson(code, withComments):
-    lines = [x.strip() for x in code.split("\n")]
+michelson_sections = ("parameter", "storage", "code")
+michelson_separators = ("{", "}", "};", ";")
 
-    def split(s):
-        if "#" in s:
-            pos = s.index("#")
-            return s[:pos].strip(), s[pos:].strip()
-        return s.strip(), None
 
-    lines = [split(x) for x in lines if x]
-    result = []
-    for s, c in lines:
+def michelson_items(lines, withComments):
+    """(instruction, comment) pairs of Michelson lines, those ppMichelson puts on lines of their own."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if "#" in line:
+            pos = line.index("#")
+            (s, c) = (line[:pos].strip(), line[pos:].strip())
+        else:
+            (s, c) = (line, None)
         if not withComments:
             c = None
         s = (
@@ -366,41 +719,42 @@ def ppMichelson(code, withComments):
             .replace(" ;", ";")
             .strip()
         )
-        split = s.split()
-        cursor = 0
         if s == "" and c:
-            result.append((s, c))
-        while len(split):
-            if split[cursor] in ["parameter", "storage", "code"]:
-                result.append((" ".join(split[0 : cursor + 1]), None))
-                split = split[cursor + 1 :]
-                continue
-            if split[cursor] in ["{", "}", "};", ";"]:
+            yield s, c
+        # Instructions are tokens[start : start + cursor + 1]
+        tokens = s.split()
+        n = len(tokens)
+        start = 0
+        cursor = 0
+        while start < n:
+            token = tokens[start + cursor]
+            if token in michelson_sections:
+                yield " ".join(tokens[start : start + cursor + 1]), None
+                start += cursor + 1
+            elif token in michelson_separators:
                 if cursor != 0:
-                    result.append((" ".join(split[0:cursor]), None))
-                    split = split[cursor:]
+                    yield " ".join(tokens[start : start + cursor]), None
+                    start += cursor
                     cursor = 0
                 else:
-                    result.append((" ".join(split[0 : cursor + 1]), None))
-                    split = split[cursor + 1 :]
-            elif len(split) == cursor + 1:
-                result.append((" ".join(split[0 : cursor + 1]), c))
-                split = []
-            elif split[cursor].endswith(";"):
-                result.append((" ".join(split[0 : cursor + 1]), None))
-                split = split[cursor + 1 :]
+                    yield token, None
+                    start += 1
+            elif start + cursor + 1 == n:
+                yield " ".join(tokens[start:]), c
+                start = n
+            elif token.endswith(";"):
+                yield " ".join(tokens[start : start + cursor + 1]), None
+                start += cursor + 1
                 cursor = 0
             else:
                 cursor += 1
-    lines = result
-    parameter = []
-    storage = []
-    code = []
-    init = []
-    result = {"init": init, "parameter": parameter, "storage": storage, "code": code}
+
+
+def michelson_lines(items):
+    """(section, line) pairs of the formatted items, the section is "init" before the first keyword."""
     step = "init"
     indent = ""
-    for (s, c) in lines:
+    for (s, c) in items:
         if s == "{":
             indent = indent + "  "
             nextIndent = indent + "  "
@@ -409,27 +763,33 @@ def ppMichelson(code, withComments):
             nextIndent = indent[:-2]
         else:
             nextIndent = indent
-        if s in ["parameter", "storage", "code"]:
+        if s in michelson_sections:
             step = s
-        line = (
-            (indent + ("%-10s %s" % (s, c) if c else s))
-            if step != "init"
-            else (("%s %s" % (s, c)).strip() if c else s)
-        )
+        if step != "init":
+            line = indent + ("%-10s %s" % (s, c) if c else s)
+        else:
+            line = ("%s %s" % (s, c)).strip() if c else s
         if line:
-            result[step].append(line)
+            yield step, line
         indent = nextIndent
-    if init:
-        init = "\n".join(init) + "\n\n"
-    else:
-        init = ""
-    michelson = "%s%s\n%s\n%s" % (
-        init,
-        " ".join(parameter).replace(" )", ")").replace("( ", "(").replace(" ;", ";"),
-        ("storage   %s" % (" ".join(storage[1:]))).replace(" )", ")").replace("( ", "(").replace(" ;", ";"),
-        "\n".join(code),
-    )
-    return michelson
+
+
+def pp_michelson_chunks(lines, withComments):
+    """Pieces of the text ppMichelson gives for an iterable of lines."""
+    sections = {"init": [], "parameter": [], "storage": [], "code": []}
+    for (step, line) in michelson_lines(michelson_items(lines, withComments)):
+        sections[step].append(line)
+    if sections["init"]:
+        yield "\n".join(sections["init"]) + "\n\n"
+    yield " ".join(sections["parameter"]).replace(" )", ")").replace("( ", "(").replace(" ;", ";")
+    yield "\n"
+    yield ("storage   %s" % (" ".join(sections["storage"][1:]))).replace(" )", ")").replace("( ", "(").replace(" ;", ";")
+    yield "\n"
+    yield "\n".join(sections["code"])
+
+
+def ppMichelson(code, withComments):
+    return "".join(pp_michelson_chunks(code.split("\n"), withComments))
 
 
 def ppMichelsonEditor(withComments):
@@ -440,8 +800,9 @@ def ppMichelsonEditorCompress():
     return removeCommentsMichelson(ppMichelson(window.editor.getValue(), False))
 
 
-def compressMichelson(lines):
-    result = []
+def compress_michelson_lines(lines):
+    """Lines of compressMichelson, yielded once complete."""
+    parts = None
     inSeq = False
     for line in lines:
         row = line.split()
@@ -453,20 +814,31 @@ def compressMichelson(lines):
             and not row[0].startswith("storage")
         )
         if inSeq and seqOK:
-            result[-1] += " " + " ".join(row)
+            parts.append(" ".join(row))
         else:
-            result.append(line)
+            if parts is not None:
+                yield " ".join(parts)
+            parts = [line]
             inSeq = seqOK
-    return result
+    if parts is not None:
+        yield " ".join(parts)
+
+
+def compressMichelson(lines):
+    return list(compress_michelson_lines(lines))
+
+
+def strip_michelson_comments(lines):
+    """Lines that are not blank once their comment is removed."""
+    for x in lines:
+        if "#" in x:
+            x = x[: x.index("#")].rstrip()
+        if x.strip():
+            yield x
 
 
 def removeCommentsMichelson(michelson):
-    lines = [
-        x[: x.index("#")].rstrip() if "#" in x else x for x in michelson.split("\n")
-    ]
-    lines = [x for x in lines if x.strip()]
-    lines = compressMichelson(lines)
-    return "\n".join(lines)
+    return "\n".join(compress_michelson_lines(strip_michelson_comments(michelson.split("\n"))))
 
 
 window.lambdaNextId = 0
@@ -0,0 +1,8 @@
+## Makes the modules of the CLI importable from its tests. ##
+
+import os
+import sys
+
+cli_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if cli_directory not in sys.path:
+    sys.path.insert(0, cli_directory)
@@ -0,0 +1,67 @@
+## smartpyio.adaptBlocks: the line based output, and where it deliberately differs. ##
+
+import smartpyio
+
+
+def adapt(code):
+    smartpyio.adapted_sources.clear()
+    return smartpyio.adaptBlocks(code)
+
+
+def test_one_line_headers():
+    code = "sp.if x > 0:\n    sp.for i in l:\n        pass\nsp.else:\n    sp.while y:\n        pass"
+    assert adapt(code) == (
+        "with sp.if_(x > 0):\n"
+        "    with sp.for_('i', l) as i:\n"
+        "        pass\n"
+        "with sp.else_():\n"
+        "    with sp.while_(y):\n"
+        "        pass\n"
+    )
+
+
+def test_carriage_returns_are_kept():
+    assert adapt("sp.if x:\r\n    pass\r") == "with sp.if_(x):\r\n    pass\r\n"
+
+
+def test_lines_keep_their_place():
+    code = "a = 1\nsp.if (x and\n      y):\n    pass"
+    adapted = adapt(code)
+    assert adapted.count("\n") == code.count("\n") + 1
+    assert [smartpyio.reverseLines.get(str(i)) for i in range(1, 6)] == ["1", "2", "3", "4", "5"]
+    assert smartpyio.reverseLines.get("6") is None
+
+
+# Intended changes from the line based rewriter, which left these lines as
+# they were (headers on several lines or followed by comments, then invalid
+# Python) or rewrote them (in strings).
+
+
+def test_headers_on_several_lines():
+    code = "sp.for i in range(\n        3):\n    sp.if (a and\n          b):\n        pass"
+    assert adapt(code) == (
+        "with sp.for_('i', range(\n"
+        "        3)) as i:\n"
+        "    with sp.if_((a and\n"
+        "          b)):\n"
+        "        pass\n"
+    )
+
+
+def test_comments_after_headers():
+    code = "sp.while x:  # loop\n    pass\nsp.else: # other\n    pass"
+    assert adapt(code) == "with sp.while_(x):  # loop\n    pass\nwith sp.else_(): # other\n    pass\n"
+
+
+def test_colons_in_conditions():
+    assert adapt("sp.if l[1:2] == d:\n    pass") == "with sp.if_(l[1:2] == d):\n    pass\n"
+
+
+def test_headers_in_strings_are_not_rewritten():
+    code = 'def f():\n    """\n    sp.if x:\n    """\n    s = \'\'\'\nsp.for i in l:\n\'\'\'\n    sp.if y:\n        pass'
+    assert adapt(code) == code.replace("    sp.if y:", "    with sp.if_(y):") + "\n"
+
+
+def test_headers_after_strings_on_one_line():
+    code = 'x = "sp.if a:"  # sp.if b:\nsp.if c:\n    pass'
+    assert adapt(code) == 'x = "sp.if a:"  # sp.if b:\nwith sp.if_(c):\n    pass\n'
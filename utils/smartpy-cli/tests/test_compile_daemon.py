@@ -0,0 +1,100 @@
+## compile_daemon.py: requests served one after the other as fresh smartpy_cli processes would. ##
+
+import os
+import subprocess
+import sys
+import time
+
+import browser
+import compile_daemon
+import smartpy_cli
+
+cli_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+alpha = """import smartpy as sp
+
+class Alpha(sp.Contract):
+    def __init__(self):
+        self.init(x = 0)
+
+    @sp.entry_point
+    def add(self, params):
+        self.data.x += params
+
+@sp.add_test(name = "Alpha")
+def test():
+    scenario = sp.test_scenario()
+    c = Alpha()
+    scenario += c
+    scenario += c.add(2)
+    scenario += c.add(-5).run(valid = False)
+"""
+
+beta = """import smartpy as sp
+
+class Beta(sp.Contract):
+    def __init__(self):
+        self.init(s = "", n = 0)
+
+    @sp.entry_point
+    def set(self, params):
+        sp.verify(params != "")
+        self.data.s = params
+        self.data.n += 1
+"""
+
+
+def scripts(tmp_path):
+    (tmp_path / "alpha.py").write_text(alpha)
+    (tmp_path / "beta.py").write_text(beta)
+    return [
+        ["alpha.py", "--no-cache", "--class_call", "Alpha()", "--sexprfile", "alpha.sexpr", "--scenario", "alpha.json"],
+        ["beta.py", "--no-cache", "--class_call", "Beta()", "--sexprfile", "beta.sexpr"],
+    ]
+
+
+def outputs(directory):
+    return {name: (directory / name).read_bytes() for name in ["alpha.sexpr", "alpha.json", "beta.sexpr"]}
+
+
+def fresh_outputs(tmp_path):
+    directory = tmp_path / "fresh"
+    directory.mkdir()
+    for argv in scripts(directory):
+        subprocess.run([sys.executable, os.path.join(cli_directory, "smartpy_cli.py")] + argv, cwd=directory, check=True, stdout=subprocess.DEVNULL)
+    return outputs(directory)
+
+
+def test_requests_do_not_share_state(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (alpha_argv, beta_argv) = scripts(tmp_path)
+    smartpy_cli.serve_request(alpha_argv, str(tmp_path))
+    assert browser.window.activeScenario is not None
+    assert [c.contract.__class__.__name__ for c in browser.window.contracts.values()] == ["Alpha"]
+    # An export without tests
+    smartpy_cli.serve_request(beta_argv, str(tmp_path))
+    assert browser.window.activeScenario is None
+    assert browser.window.validityErrors == []
+    assert [c.contract.__class__.__name__ for c in browser.window.contracts.values()] == ["Beta"]
+    assert outputs(tmp_path) == fresh_outputs(tmp_path)
+
+
+def test_daemon_serves_two_scripts(tmp_path):
+    socket_path = str(tmp_path / "daemon.sock")
+    daemon = subprocess.Popen([sys.executable, os.path.join(cli_directory, "smartpy_cli.py"), "--serve", socket_path])
+    try:
+        for _ in range(200):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        served = tmp_path / "served"
+        served.mkdir()
+        argvs = scripts(served)
+        # Twice in a row, each after the other script
+        for argv in argvs + argvs:
+            answer = compile_daemon.request(socket_path, argv, str(served))
+            assert answer["status"] == 0, answer["output"]
+        assert outputs(served) == fresh_outputs(tmp_path)
+    finally:
+        daemon.terminate()
+        daemon.wait()
@@ -0,0 +1,44 @@
+## smartpy_cli --finalize: contracts released once exported keep their export. ##
+
+import smartpy
+import smartpy_cli
+
+script = """import smartpy as sp
+
+class Names(sp.Contract):
+    def __init__(self):
+        self.init(x = 0)
+
+    @sp.entry_point
+    def exported(self, params):
+        self.data.x = params
+
+    @sp.entry_point
+    def finalize(self, params):
+        self.data.x += params
+
+@sp.add_test(name = "Names")
+def test():
+    scenario = sp.test_scenario()
+    c = Names()
+    scenario += c
+    scenario += c.exported(2)
+    scenario += c.finalize(3)
+"""
+
+
+def run(tmp_path, name, flags):
+    argv = ["names.py", "--no-cache", "--class_call", "Names()", "--sexprfile", name + ".sexpr", "--scenario", name + ".json"]
+    try:
+        smartpy_cli.serve_request(argv + flags, str(tmp_path))
+    finally:
+        smartpy.set_finalize(False)
+    return ((tmp_path / (name + ".sexpr")).read_text(), (tmp_path / (name + ".json")).read_text())
+
+
+def test_entry_points_named_like_attributes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "names.py").write_text(script)
+    (sexpr, scenario) = run(tmp_path, "kept", [])
+    assert "exported" in sexpr and "finalize" in sexpr
+    assert run(tmp_path, "released", ["--finalize"]) == (sexpr, scenario)
@@ -0,0 +1,32 @@
+## message_cache.Fingerprint: what an entry point depends on changes its digest. ##
+
+import message_cache
+
+script = """class Config:
+    FEE = %s
+
+class C:
+    def pay(self, params):
+        return params + Config.FEE + len(params)
+"""
+
+
+def digest(fee):
+    context = {}
+    exec(compile(script % fee, message_cache.script_filename, "exec"), context)
+    cls = context["C"]
+    return message_cache.Fingerprint(cls).value(cls.pay)
+
+
+def test_class_attributes():
+    assert digest(10) == digest(10)
+    assert digest(10) != digest(99)
+    assert digest("[]") != digest("()")
+
+
+def test_unfingerprintable_attributes():
+    try:
+        digest("object()")
+    except message_cache.Unfingerprintable:
+        return
+    raise AssertionError("object() has a fingerprint")
@@ -0,0 +1,105 @@
+## michelson_cli.py pp and compress, on files and on stdin and stdout. ##
+
+import io
+import sys
+
+import michelson_cli
+import smartpyio
+
+script = """parameter (or (unit %claim) (nat %vote));
+storage   (pair (address %admin) (nat %count));
+code
+  {
+    UNPAIR;     # @parameter : @storage
+    IF_LEFT
+      {
+        DROP;       # == claim ==
+        NIL operation
+      }
+      {
+        # == vote ==
+        DUP 2;
+        CDR;
+        ADD;
+        UPDATE 2;
+        NIL operation
+      };
+    PAIR
+  };"""
+
+
+def write(path, text):
+    path.write_text(text, encoding="utf8", newline="")
+    return str(path)
+
+
+def test_pp_leaves_stdout_open(tmp_path, capsys):
+    filename = write(tmp_path / "contract.tz", script)
+    michelson_cli.main(["pp", filename])
+    michelson_cli.main(["pp", "--no_comments", filename])
+    print("after")
+    out = capsys.readouterr().out
+    assert out == smartpyio.ppMichelson(script, True) + "\n" + smartpyio.ppMichelson(script, False) + "\n" + "after\n"
+
+
+def test_pp_to_file(tmp_path):
+    filename = write(tmp_path / "contract.tz", script)
+    target = tmp_path / "pp.tz"
+    michelson_cli.main(["pp", filename, "-o", str(target)])
+    assert target.read_text(encoding="utf8") == smartpyio.ppMichelson(script, True) + "\n"
+
+
+def test_pp_in_place(tmp_path):
+    filename = write(tmp_path / "contract.tz", script)
+    michelson_cli.main(["pp", "--no_comments", filename, "-o", filename])
+    assert (tmp_path / "contract.tz").read_text(encoding="utf8") == smartpyio.ppMichelson(script, False) + "\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["contract.tz"]
+
+
+def test_compress_to_stdout(tmp_path, capsys):
+    filename = write(tmp_path / "contract.tz", script)
+    michelson_cli.main(["compress", filename])
+    print("after")
+    captured = capsys.readouterr()
+    compressed = smartpyio.removeCommentsMichelson(script) + "\n"
+    assert captured.out == compressed + "after\n"
+    assert captured.err == "%s: %i -> %i bytes, %i saved (%.1f%%)\n" % (
+        filename,
+        len(script),
+        len(compressed),
+        len(script) - len(compressed),
+        100.0 * (len(script) - len(compressed)) / len(script),
+    )
+
+
+def test_compress_stdin_leaves_it_open(monkeypatch, capsys):
+    stdin = io.TextIOWrapper(io.BytesIO(script.encode("utf8")), encoding="utf8")
+    monkeypatch.setattr(sys, "stdin", stdin)
+    michelson_cli.main(["compress"])
+    assert not stdin.closed
+    assert capsys.readouterr().out == smartpyio.removeCommentsMichelson(script) + "\n"
+
+
+def test_compress_directory(tmp_path, capsys):
+    source = tmp_path / "output"
+    source.mkdir()
+    write(source / "a_compiled.tz", script)
+    write(source / "b_compiled.tz", script.replace("%count", "%total"))
+    target = tmp_path / "compressed"
+    michelson_cli.main(["compress", str(source), "--output_dir", str(target)])
+    for name in ["a_compiled.tz", "b_compiled.tz"]:
+        original = (source / name).read_text(encoding="utf8")
+        assert (target / name).read_text(encoding="utf8") == smartpyio.removeCommentsMichelson(original) + "\n"
+    assert capsys.readouterr().err.splitlines()[-1].startswith("total: ")
+
+
+def test_compress_in_place(tmp_path):
+    source = tmp_path / "output"
+    source.mkdir()
+    write(source / "a_compiled.tz", script)
+    write(source / "b_compiled.tz", script.replace("%count", "%total"))
+    michelson_cli.main(["compress", str(source), "--output_dir", str(source)])
+    michelson_cli.main(["compress", str(source / "a_compiled.tz"), "-o", str(source / "a_compiled.tz")])
+    assert (source / "a_compiled.tz").read_text(encoding="utf8") == smartpyio.removeCommentsMichelson(script) + "\n"
+    assert (source / "b_compiled.tz").read_text(encoding="utf8") == smartpyio.removeCommentsMichelson(script.replace("%count", "%total")) + "\n"
+    assert sorted(p.name for p in source.iterdir()) == ["a_compiled.tz", "b_compiled.tz"]
@@ -0,0 +1,129 @@
+## michelson_cost.py: sizes, entry points, loops and regressions of compiled contracts. ##
+
+import json
+
+import michelson_cli
+import michelson_cost
+
+address = '"tz1aoQSwjDU4pxSwT5AsBiK5Xk15FWgBJoYr"'
+
+script = """parameter (or (or (unit %disburse) (nat %sqrt)) (string %propose));
+storage   (pair (address %admin) (list %payees address));
+code
+  {
+    UNPAIR;     # @parameter : @storage
+    IF_LEFT
+      {
+        IF_LEFT
+          {
+            DROP;       # == disburse ==
+            DUP;
+            CDR;
+            NIL operation;
+            SWAP;
+            ITER
+              {
+                CONTRACT unit;
+                IF_NONE
+                  {
+                    PUSH int 12;
+                    FAILWITH
+                  }
+                  {};
+                PUSH mutez 1;
+                UNIT;
+                TRANSFER_TOKENS;
+                CONS
+              }
+          }
+          {
+            # == sqrt ==
+            PUSH nat 1;
+            DUP 2;
+            DUP 2;
+            COMPARE;
+            GT;
+            LOOP
+              {
+                PUSH nat 1;
+                ADD;
+                DUP 2;
+                DUP 2;
+                DUP;
+                MUL;
+                COMPARE;
+                GT
+              };
+            DROP 2;
+            NIL operation
+          }
+      }
+      {
+        DROP;       # == propose ==
+        NIL operation
+      };
+    PAIR
+  };"""
+
+
+def storage_bytes(storage):
+    return michelson_cost.contract_report(script, storage)["storage"]["initial_storage_bytes"]
+
+
+def test_storage_of_collections():
+    # A sequence is a tag and a 4 byte length, Elt 1 2 a tag, a primitive
+    # and two ints of 2 bytes, and the whole storage has a 4 byte length.
+    assert storage_bytes("{}") == 4 + 5
+    assert storage_bytes("{ Elt 1 2; Elt 3 4 }") == 4 + 5 + 2 * 6
+    assert storage_bytes("{ Elt 1 2; Elt 3 4 }\n") == storage_bytes("{ Elt 1 2 }") + 6
+
+
+def test_storage_of_pairs():
+    storage = "(Pair %s { %s })" % (address, address)
+    # Pair: a tag and a primitive, strings: a tag, a 4 byte length and their bytes
+    assert storage_bytes(storage) == 4 + 2 + (5 + 36) + (5 + 5 + 36)
+    report = michelson_cost.contract_report(script, storage)["storage"]
+    assert report["burn_mutez"] == (report["paid_bytes"] + michelson_cost.origination_size) * michelson_cost.cost_per_byte
+
+
+def test_storage_is_a_single_expression():
+    for storage in ["Unit; Unit", "{} {}"]:
+        try:
+            michelson_cost.parse_data(storage)
+        except ValueError:
+            continue
+        raise AssertionError(storage)
+
+
+def test_entry_points():
+    report = michelson_cost.contract_report(script)
+    entry_points = report["entry_points"]
+    assert sorted(entry_points) == ["disburse", "propose", "sqrt"]
+    assert entry_points["propose"]["bounded"]
+    assert entry_points["propose"]["loops"] == []
+    assert entry_points["disburse"]["unbounded_by"] == ["ITER"]
+    assert entry_points["disburse"]["loops"] == [{"instruction": "ITER", "depth": 0, "body_instructions": 8}]
+    assert entry_points["sqrt"]["unbounded_by"] == ["LOOP"]
+    # UNPAIR, PAIR and the two IF_LEFT of the dispatch
+    assert report["common"]["instructions"] == 4
+    assert report["code"]["instructions"] == 4 + sum(e["instructions"] for e in entry_points.values())
+    assert report["storage"]["initial_storage_bytes"] is None
+
+
+def test_baseline(tmp_path, capsys):
+    (tmp_path / "DAO_compiled.tz").write_text(script, encoding="utf8")
+    (tmp_path / "DAO_storage_init.tz").write_text("(Pair %s {})" % address, encoding="utf8")
+    baseline = tmp_path / "baseline.json"
+    michelson_cli.main(["cost", str(tmp_path), "-o", str(baseline)])
+    report = json.loads(baseline.read_text(encoding="utf8"))
+    assert list(report["contracts"]) == ["DAO"]
+    assert michelson_cost.compare(report, report) == []
+    (tmp_path / "DAO_compiled.tz").write_text(script.replace("DROP 2;", "DROP;\n            DROP;"), encoding="utf8")
+    try:
+        michelson_cli.main(["cost", str(tmp_path), "--baseline", str(baseline)])
+    except SystemExit as e:
+        assert e.code == 1
+    else:
+        raise AssertionError("no regression")
+    assert "Regression: contracts/DAO/entry_points/sqrt/instructions: 16 -> 17" in capsys.readouterr().err
+    michelson_cli.main(["cost", str(tmp_path), "--baseline", str(baseline), "--tolerance", "10"])